@@ -22,7 +22,7 @@ Encoder filamentEncoder(2, 3);
 
 // Constant vars
 const char compile_date[] = __DATE__ " " __TIME__;
-const float compile_version = 1.1;
+const float compile_version = 1.4;
 
 // Diameter of the gear or wheel attached to the encoder, this can be
 // tweaked as necessary to achieve accurate results. The official diameter
@@ -42,6 +42,10 @@ float encoderCountPerMM = 0.00;
 String serialData = "";
 bool serialDataComplete = false;
 
+// The request ID sent with the current command, e.g. "MEASURE 12". It is
+// echoed ahead of the reply as "12|" so the host can match the two up.
+String requestId = "";
+
 // Used to track extruded amount
 unsigned long currentMeasurement = 0;
 unsigned long previousMeasurement = 0;
@@ -50,6 +54,7 @@ void setup() {
   // Open the serial port at 9600 baud.
   Serial.begin(9600);
   serialData.reserve(32);
+  requestId.reserve(12);
 
   // Check the EEPROM for the calibrated value, use that if
   // it exists and is valid.
@@ -60,12 +65,7 @@ void setup() {
   }
 
   // Output a welcome message
-  Serial.print("NXE|");
-  Serial.print(String(compile_version));
-  Serial.print("|");
-  Serial.print(String(compile_date));
-  Serial.print("|");
-  Serial.println(gearDiameter, 6);
+  printHandshake();
 
   // Calculate the encoder pulses required for 1mm of movement.
   encoderCountPerMM = encoderRotationCount / (gearDiameter * PI);
@@ -77,6 +77,13 @@ void loop() {
 
   // Handle incoming serial data
   if (serialDataComplete) {
+    requestId = "";
+    int separator = serialData.indexOf(' ');
+    if (separator > 0) {
+      requestId = serialData.substring(separator + 1);
+      requestId.trim();
+    }
+
     if (serialData.startsWith("CAL")) {
       serialData = serialData.substring(3);
       if (serialData.toFloat()) {
@@ -93,13 +100,14 @@ void loop() {
           Serial.print("ERROR SAVING TO EEPROM. EXPECTED: ");
           Serial.print(calDiameter);
           Serial.print(" RETRIEVED: ");
-          Serial.print(calEEPROM);
+          Serial.println(calEEPROM);
         } else {
           Serial.println("CALIBRATION SAVED TO EEPROM");
         }
         encoderCountPerMM = encoderRotationCount / (calDiameter * PI);
       }
     } else if (serialData.startsWith("MEASURE")) {
+      printRequestId();
       if (currentMeasurement > 4290000000) {
         // We have underflowed the 32bit long (or somehow extruded 18km of filament... I think
         // assuming the former of those two scenarios is the wiser choice :P )
@@ -121,6 +129,16 @@ void loop() {
         Serial.println(0, 4);
       }
       previousMeasurement = currentMeasurement;
+    } else if (serialData.startsWith("COUNT")) {
+      // Report the raw signed encoder count. The host keeps the running
+      // position and does the conversion to millimetres, including any
+      // wrap around of the count.
+      printRequestId();
+      Serial.println((long)currentMeasurement);
+    } else if (serialData.startsWith("VERSION")) {
+      // Repeat the welcome message, for boards which do not reset when
+      // the port is opened.
+      printHandshake();
     } else if (serialData.startsWith("RESET")) {
         // Reset the encoder to 0
         filamentEncoder.write(0);
@@ -128,6 +146,13 @@ void loop() {
         // Reset our tracking variables
         currentMeasurement = 0;
         previousMeasurement = 0;
+
+        // Only acknowledge when the host sent a request ID, as older
+        // versions of the utility do not expect a reply.
+        if (requestId.length() > 0) {
+          printRequestId();
+          Serial.println("OK");
+        }
     }
 
     // Clear serial data and flag
@@ -136,6 +161,24 @@ void loop() {
   }
 }
 
+// Print the welcome message, which identifies the encoder to the host
+void printHandshake() {
+  Serial.print("NXE|");
+  Serial.print(String(compile_version));
+  Serial.print("|");
+  Serial.print(String(compile_date));
+  Serial.print("|");
+  Serial.println(gearDiameter, 6);
+}
+
+// Print the request ID of the current command, if it had one
+void printRequestId() {
+  if (requestId.length() > 0) {
+    Serial.print(requestId);
+    Serial.print("|");
+  }
+}
+
 // Handle incoming serial data
 void serialEvent() {
   while (Serial.available()) {
@@ -19,25 +19,42 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from PyQt5.QtCore import QState, QStateMachine, QThread, pyqtSignal, QCoreApplication, QUrl
+from PyQt5.QtCore import Qt, QState, QStateMachine, QThread, QTimer, pyqtSignal, QCoreApplication, QUrl
 from PyQt5.QtGui import QPainter, QIcon, QDesktopServices
 from PyQt5.QtSerialPort import QSerialPortInfo
-from PyQt5.QtWidgets import QApplication, QDialog, QFileDialog, QLineEdit, QMainWindow, QMessageBox
-
+from PyQt5.QtWidgets import QApplication, QCompleter, QDialog, QFileDialog, QInputDialog, QLineEdit, QMainWindow, QMessageBox
+
+from helpers.backend_process import BackendProcess
+from helpers.batch_runner import BatchRunner
+from helpers.cache import checkpoint_cache, printer_config_cache
+from helpers.connection_manager import ConnectionManager
+from helpers.control_api import ControlError, ControlServer
+from helpers.metrics import metrics, MetricsServer
+from helpers.printer_discovery import (FIRMWARE_KLIPPER, FIRMWARE_RRF3, FIRMWARE_RRF3_SBC, PrinterDiscovery,
+                                       load_known_printers, local_subnet, parse_hosts, save_known_printers)
 from helpers.printer_klipper import Klipper
+from helpers.printer_klipper_socket import default_socket_path, KlipperSocket
 from helpers.printer_marlin import Marlin
 from helpers.printer_reprapfirmware import RepRapFirmware3
 from helpers.printer_reprapfirmware_sbc import RepRapFirmware3_SBC
 from helpers.serial_encoder import SerialEncoder
+from helpers.serial_probe import SerialPortWatcher, SerialProbe
+from helpers.trace import tracer
 from helpers.worker_consistency import WorkerConsistency
+from helpers.worker_diameter import WorkerDiameter
 from helpers.worker_esteps import WorkerEsteps
 from helpers.worker_volumetric import WorkerVolumetric
 from resources.ui_about import Ui_About
 from resources.ui_mainwindow import Ui_MainWindow
 
 from os import path
+import multiprocessing
 import time
 
+# Index of each firmware in cbx_printer_fwtype
+FIRMWARE_INDEX = {FIRMWARE_RRF3: 0, FIRMWARE_RRF3_SBC: 1, FIRMWARE_KLIPPER: 2}
+FIRMWARE_NAMES = {FIRMWARE_RRF3: 'RepRapFirmware3', FIRMWARE_RRF3_SBC: 'RepRapFirmware3 (SBC)', FIRMWARE_KLIPPER: 'Klipper'}
+
 __author__ = "Simon Davie <nexx@nexxdesign.co.uk>"
 __version__ = 1.0
 
@@ -46,6 +63,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     sig_serial_enable = pyqtSignal()
     sig_encoder_connect = pyqtSignal()
     sig_encoder_disconnect = pyqtSignal()
+    sig_encoder_close = pyqtSignal()
     sig_printer_connect = pyqtSignal()
     sig_printer_disconnect = pyqtSignal()
     sig_chart_const_finished = pyqtSignal()
@@ -57,14 +75,56 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.setWindowIcon(QIcon(path.dirname(__file__) + '/resources/icon.svg'))
         self.current_tool = 0
-        self.thread_printer = QThread()
+        self.heat_started = None
+        self.batch = None
+        self.batch_heater_limit = 2
+        self.encoder = None
+        self.encoder_port = None
+        self.printer = None
+        self.printer_attempt = None
+        self.printer_target = None
+        self.printer_isolated = False
+        self.printer_targets = []
+        self.printer_steps = {}
+        self.printer_heaters = {}
+        self.serial_ports = []
+        self.encoder_ports = {}
+        self.encoder_boards = set()
+        self.probe = None
+        self.discovery = None
+        self.known_printers = load_known_printers()
+        self.worker = None
+        self.estop_channel = None
+        self.printer_status = None
+        self.metrics_server = None
+        self.control_server = None
+        self.control_timer = QTimer(self)
+        self.control_timer.timeout.connect(self.control_update)
+        self.test_remote = False
+        self.test_resume = None
+        self.thread_printer = None
+        self.thread_printer_attempt = None
+        self.connections = ConnectionManager(self)
+        self.connections.sig_attempt.connect(self.connection_attempt)
+        self.connections.sig_abandon.connect(self.connection_abandon)
+        self.connections.sig_gave_up.connect(self.connection_gave_up)
+        self.connections.sig_log_event.connect(self.log_event)
+        QThread.currentThread().setObjectName('GUI')
         self.dlg_about = AboutDialog()
 
         self.actn_save.triggered.connect(self.log_save)
         self.actn_about.triggered.connect(self.dlg_about.exec_)
+        self.actn_metrics_export.triggered.connect(self.metrics_export)
+        self.actn_metrics_server.triggered.connect(self.metrics_server_toggle)
+        self.actn_control_server.triggered.connect(self.control_server_toggle)
+        self.actn_trace_record.triggered.connect(self.trace_record_toggle)
+        self.actn_batch_heater_limit.triggered.connect(self.batch_set_heater_limit)
+        self.actn_encoder_calibrate.triggered.connect(self.encoder_calibrate)
+        self.actn_printer_discover.triggered.connect(self.printer_discover)
+        self.actn_printer_cache_clear.triggered.connect(self.printer_cache_clear)
         self.btn_encoder_connect.clicked.connect(self.encoder_connect)
         self.btn_encoder_disconnect.clicked.connect(self.encoder_disconnect)
-        self.btn_encoder_refresh.clicked.connect(self.populate_serial_ports)
+        self.btn_encoder_refresh.clicked.connect(self.encoder_detect)
         self.btn_printer_connect.clicked.connect(self.printer_connect)
         self.btn_printer_disconnect.clicked.connect(self.printer_disconnect)
         self.btn_tool_home.clicked.connect(self.printer_move_home)
@@ -73,6 +133,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.btn_tool_run.clicked.connect(self.printer_run)
         self.btn_estop.clicked.connect(self.printer_estop)
         self.cbx_printer_fwtype.currentIndexChanged.connect(self.fwtype_update)
+        self.txt_printer_hostname.textChanged.connect(self.printer_host_changed)
         self.cbx_tool.currentIndexChanged.connect(self.gui_tool_update)
         self.tabMain.currentChanged.connect(self.gui_tab_update)
 
@@ -168,6 +229,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.populate_serial_ports()
         self.cbx_printer_port.setHidden(True)
+        self.txt_printer_hostname.setCompleter(QCompleter(sorted(self.known_printers), self))
+
+        self.port_watcher = SerialPortWatcher(self)
+        self.port_watcher.sig_changed.connect(self.serial_ports_changed)
+        self.port_watcher.start()
 
     def init_charts(self):
         ''' Initialise the charts in the GUI. These are handled in an odd way
@@ -199,6 +265,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def log_event(self, event):
         ''' Log text to the GUI event log. '''
         self.pte_eventlog.appendPlainText('[{}] {}'.format(time.strftime('%H:%M:%S', time.localtime()), event))
+        if self.control_server is not None:
+            self.control_server.publish('log', {'time': time.time(), 'event': event})
 
     def log_debug(self, event):
         ''' Log debug event to the GUI event log if the verbose option is
@@ -214,6 +282,232 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         f.close()
         self.log_event('Log saved to {}'.format(log_filename))
 
+    def metrics_export(self):
+        ''' Save the collected timing metrics to a file chosen by QFileDialog,
+        in the Prometheus text format. '''
+        metrics_filename, _ = QFileDialog.getSaveFileName(self, 'Export Metrics as...', 'nxencoder.prom', 'Prometheus metrics (*.prom)')
+        if not metrics_filename:
+            return
+        metrics.write(metrics_filename)
+        self.log_event('Metrics saved to {}'.format(metrics_filename))
+
+    def metrics_server_toggle(self, enabled):
+        ''' Start or stop the local HTTP endpoint which serves the collected
+        metrics at /metrics for Prometheus to scrape. '''
+        if not enabled:
+            self.metrics_server.stop()
+            self.metrics_server = None
+            self.log_event('Metrics endpoint stopped')
+            return
+
+        port, ok = QInputDialog.getInt(self, 'Metrics Endpoint', 'Port to serve /metrics on:', 9464, 1024, 65535)
+        if not ok:
+            self.actn_metrics_server.setChecked(False)
+            return
+        try:
+            self.metrics_server = MetricsServer(port)
+        except OSError as e:
+            self.actn_metrics_server.setChecked(False)
+            self.log_debug('[METRICS] Error: Unable to listen on port {}. Exception returned: {}'.format(port, e))
+            self.error_critical('Unable to start the metrics endpoint on port {}.'.format(port))
+            return
+        self.metrics_server.start()
+        self.log_event('Metrics endpoint started at http://127.0.0.1:{}/metrics'.format(port))
+
+    def control_server_toggle(self, enabled):
+        ''' Start or stop the control API, which lets another machine run
+        the same actions as the GUI. '''
+        if not enabled:
+            self.control_timer.stop()
+            self.control_server.stop()
+            self.control_server = None
+            self.log_event('Control API stopped')
+            return
+
+        address, ok = QInputDialog.getText(self, 'Control API', 'Address and port to listen on.\n'
+                                           'Use 0.0.0.0 to accept connections from other machines:', text='127.0.0.1:8765')
+        host, _, port = address.strip().rpartition(':')
+        if not ok or not host or not port.isdigit():
+            self.actn_control_server.setChecked(False)
+            return
+        try:
+            self.control_server = ControlServer(int(port), host)
+        except OSError as e:
+            self.actn_control_server.setChecked(False)
+            self.log_debug('[CONTROL] Error: Unable to listen on {}. Exception returned: {}'.format(address, e))
+            self.error_critical('Unable to start the control API on {}.'.format(address))
+            return
+        self.control_server.sig_command.connect(self.control_command)
+        self.control_server.start()
+        self.control_update()
+        self.control_timer.start(500)
+        self.log_event('Control API started at http://{}. Commands need the token {}'.format(address, self.control_server.token))
+
+    def control_update(self):
+        ''' Refresh the status served by the control API. '''
+        tools = []
+        if self.printer_status is not None:
+            tools = [{'temperature': tool.temperature, 'target': tool.target, 'steps_per_mm': tool.steps_per_mm,
+                      'rotation_distance': tool.rotation_distance, 'stable': tool.stable, 'eta': tool.eta}
+                     for tool in self.printer_status.tools]
+        results = getattr(self.worker, 'cal_results', None)
+        self.control_server.set_status({
+            'printer': {
+                'connected': self.printer is not None,
+                'reconnecting': self.connections.interrupted('printer'),
+                'firmware': self.printer.fw_string if self.printer is not None and hasattr(self.printer, 'fw_string') else None,
+                'homed': self.printer_status.homed if self.printer_status is not None else False,
+                'idle': self.printer_status.idle if self.printer_status is not None else False,
+                'tools': tools
+            },
+            'encoder': {
+                'connected': self.encoder is not None,
+                'reconnecting': self.connections.interrupted('encoder'),
+                'port': self.encoder_port if self.encoder is not None or self.connections.interrupted('encoder') else None,
+                'calibration': self.encoder.calibration if self.encoder is not None else None
+            },
+            'tool': self.current_tool,
+            'temperature': self.dsbx_tool_temp.value(),
+            'test': {
+                'running': self.working,
+                'name': self.worker.name if self.worker is not None else None,
+                'batch': self.batch is not None,
+                'results': len(results) if results is not None else None
+            }
+        })
+
+    def control_measurement(self, measurement):
+        ''' Stream each encoder measurement to the control API. '''
+        if self.control_server is None:
+            return
+        self.control_server.publish('measurement', {
+            'value': measurement.value,
+            'request': measurement.request,
+            'tool': self.current_tool,
+            'test': self.worker.name if self.worker is not None else None
+        })
+
+    def control_command(self, command):
+        ''' Run a command from the control API, the way the GUI would. The
+        command is resolved with the handler's result, or with the
+        ControlError it raised. Anything else a handler raises is logged
+        and returned as a server error, as it must not escape the slot. '''
+        handler = getattr(self, 'control_' + command.name)
+        try:
+            command.future.set_result(handler(**command.params))
+        except ControlError as e:
+            command.future.set_exception(e)
+        except (TypeError, ValueError) as e:
+            command.future.set_exception(ControlError('Invalid parameters for {}: {}'.format(command.name, e), 400))
+        except Exception as e:
+            self.log_debug('[CONTROL] Error: {} failed. Exception returned: {}'.format(command.name, e))
+            command.future.set_exception(ControlError('{} failed: {}'.format(command.name, e), 500))
+        self.control_update()
+
+    def control_require(self, printer=False, encoder=False, idle=True):
+        if printer and (self.printer is None or self.connections.interrupted('printer')):
+            raise ControlError('The printer is not connected')
+        if encoder and self.encoder is None:
+            raise ControlError('The encoder is not connected')
+        if idle and self.working:
+            raise ControlError('A test is running')
+
+    def control_serial_port(self, port):
+        for index, info in enumerate(self.serial_ports):
+            if info.portName() == port:
+                return index
+        raise ControlError('There is no serial port {}'.format(port), 400)
+
+    def control_printer_connect(self, firmware, target, isolated=False):
+        firmwares = {'rrf3': 0, 'rrf3_sbc': 1, 'klipper': 2, 'marlin': 3, 'klipper_socket': 4}
+        if firmware not in firmwares:
+            raise ControlError('Unknown firmware {}, use one of {}'.format(firmware, ', '.join(firmwares)), 400)
+        if self.printer is not None or self.connections.reconnecting('printer'):
+            raise ControlError('A printer is already connected')
+        self.cbx_printer_fwtype.setCurrentIndex(firmwares[firmware])
+        if firmware == 'marlin':
+            self.cbx_printer_port.setCurrentIndex(self.control_serial_port(target))
+        else:
+            self.txt_printer_hostname.setText(target)
+        self.actn_printer_process.setChecked(bool(isolated))
+        self.printer_connect()
+
+    def control_printer_disconnect(self):
+        if self.printer is None:
+            raise ControlError('The printer is not connected')
+        self.control_require()
+        self.printer_disconnect()
+
+    def control_encoder_connect(self, port):
+        if self.encoder is not None or self.connections.reconnecting('encoder'):
+            raise ControlError('An encoder is already connected')
+        self.cbx_encoder_port.setCurrentIndex(self.control_serial_port(port))
+        self.encoder_connect()
+
+    def control_encoder_disconnect(self):
+        if self.encoder is None:
+            raise ControlError('The encoder is not connected')
+        self.control_require()
+        self.encoder_disconnect()
+
+    def control_home(self):
+        self.control_require(printer=True)
+        self.printer_move_home()
+
+    def control_heat(self, temperature, tool=None):
+        ''' Heat a tool, selecting it first if it is not the current tool,
+        which switches off the heater of the previous one as the GUI
+        does. '''
+        if not isinstance(temperature, int) or isinstance(temperature, bool):
+            raise ControlError('The temperature must be a whole number of degrees', 400)
+        self.control_require(printer=True)
+        if tool is not None and tool != self.current_tool:
+            if not 0 <= tool < self.cbx_tool.count():
+                raise ControlError('There is no tool {}'.format(tool), 400)
+            self.cbx_tool.setCurrentIndex(tool)
+        if not self.dsbx_tool_temp.minimum() <= temperature <= self.dsbx_tool_temp.maximum():
+            raise ControlError('{} C is outside the range of tool {}'.format(temperature, self.current_tool), 400)
+        self.dsbx_tool_temp.setValue(temperature)
+        self.printer_set_temperature()
+
+    def control_test(self, test, all_tools=False, resume=False):
+        ''' Run a test on the current tool, or on every tool. It is run
+        without any dialogs: a checkpoint of the same run is resumed only if
+        resume is set, and the results go to /results instead of a message
+        box. '''
+        tests = {'esteps': 0, 'consistency': 1, 'volumetric': 2}
+        if test not in tests:
+            raise ControlError('Unknown test {}, use one of {}'.format(test, ', '.join(tests)), 400)
+        self.control_require(printer=True, encoder=True)
+        if self.printer_status is None or not self.printer_status.tools[self.current_tool].target:
+            raise ControlError('Heat tool {} before running a test'.format(self.current_tool))
+        self.tabMain.setCurrentIndex(tests[test])
+        self.actn_batch_mode.setChecked(bool(all_tools))
+        self.test_remote = True
+        self.test_resume = bool(resume)
+        self.printer_run()
+
+    def control_abort(self):
+        if not self.working:
+            raise ControlError('No test is running')
+        self.printer_abort()
+
+    def trace_record_toggle(self, enabled):
+        ''' Start recording a timeline of the calibration run, or stop the
+        recording and save it as a Chrome trace / Perfetto JSON file. '''
+        if enabled:
+            tracer.start()
+            self.log_event('Trace recording started')
+            return
+
+        tracer.stop()
+        trace_filename, _ = QFileDialog.getSaveFileName(self, 'Save the Trace as...', 'nxencoder_trace.json', 'Trace files (*.json)')
+        if not trace_filename:
+            self.log_event('Trace recording discarded')
+            return
+        tracer.save(trace_filename)
+        self.log_event('Trace saved to {}'.format(trace_filename))
+
     def error_critical(self, error):
         ''' Handle a critical error. Show the user a QMessageBox and also log
         the error to the event log. Optionally handle a detailed error to log
@@ -239,7 +533,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             msg.setText('The extruder calibration completed successfully.')
             if hasattr(self.printer, 'isKlipper'):
                 msg.setInformativeText('The new rotation_distance value for extruder {} has been calculated to be {:.6f}.\n\n'
-                                       'You will need to update your printers configuration to use this new value.'.format(self.printer.cfg_tools[self.current_tool]['name'], result))
+                                       'You will need to update your printers configuration to use this new value.'.format(self.printer_status.tools[self.current_tool].name, result))
             else:
                 msg.setInformativeText('The new extruder steps/mm value for tool {} has been calculated to be {:.2f}.\n\n'
                                        'You will need to update your printers configuration to use this new value.'.format(self.current_tool, result))
@@ -259,12 +553,16 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             msg.setInformativeText('The maximum volumetric flow for tool {} is {}mm\u00b3/s.\n\n'
                                    'This was calculated using the currently loaded filament, a filament diameter of {}, a nozzle size of {}, and an extrusion temperature of {}C.\n\n'
                                    'Differing filaments, temperatures, and nozzle sizes, can all affect the maximum volumetric flow of the extruder and hotend.'
-                                   .format(self.current_tool, result, self.cbox_tool_filament.currentText(), round(self.dsbx_tool_nozzle.value(), 2), self.printer.cfg_tools[self.current_tool]['cur_temp']))
+                                   .format(self.current_tool, result, self.cbox_tool_filament.currentText(), round(self.dsbx_tool_nozzle.value(), 2), self.tool_temperature()))
         msg.exec_()
 
     def populate_serial_ports(self):
         ''' Populate the encoder combobox with available system serial ports.
-        Also called when the user hits the refresh button. '''
+        Ports identified as encoders are labelled with their firmware, and
+        the first of them is selected. Otherwise the selection is kept. '''
+        previous = None
+        if 0 <= self.cbx_encoder_port.currentIndex() < len(self.serial_ports):
+            previous = self.serial_ports[self.cbx_encoder_port.currentIndex()].portName()
         self.cbx_encoder_port.clear()
 
         # FIXME: This fixes a bug where no serial ports are available on launch
@@ -276,9 +574,104 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.sig_serial_disable.emit()
             return
         self.sig_serial_enable.emit()
-        for port in self.serial_ports:
+        selected = None
+        for index, port in enumerate(self.serial_ports):
             self.log_debug('[SERIAL] Found port: {} - {}'.format(port.portName(), port.description()))
+            info = self.encoder_ports.get(port.portName())
+            if info is not None:
+                self.cbx_encoder_port.addItem('{}: nxEncoder v{} ({:.4f}mm)'.format(port.portName(), info.firmware_version, info.calibration))
+                if selected is None or self.serial_ports[selected].portName() not in self.encoder_ports:
+                    selected = index
+                continue
             self.cbx_encoder_port.addItem('{}: {}'.format(port.portName(), port.description()))
+            if port.portName() == previous and selected is None:
+                selected = index
+        if selected is not None:
+            self.cbx_encoder_port.setCurrentIndex(selected)
+
+    def serial_ports_changed(self, added, removed):
+        ''' Signalled by the port watcher when serial ports come or go. The
+        port lists are refreshed, but new ports are not opened, as that
+        resets the board behind them, which may be a printer. Only a port
+        on the same USB device as an encoder found earlier in the session is
+        probed, while no encoder is connected. '''
+        for name in removed:
+            self.log_debug('[SERIAL] Port removed: {}'.format(name))
+            self.encoder_ports.pop(name, None)
+        self.populate_serial_ports()
+        if self.cbx_printer_fwtype.currentIndex() == 3 and self.printer is None:
+            self.populate_printer_ports()
+        if self.encoder_port in added and self.connections.reconnecting('encoder'):
+            self.connections.retry_now('encoder')
+            return
+        if self.printer_target is not None and self.printer_target[1] in added and self.connections.reconnecting('printer'):
+            self.connections.retry_now('printer')
+        known = [name for name in added if self.serial_port_identity(name) in self.encoder_boards]
+        if known and self.encoder is None:
+            self.encoder_probe(known)
+
+    def serial_port_identity(self, name):
+        ''' The USB vendor, product and serial number of a port, which
+        identify the device behind it wherever it is plugged in. None if the
+        device has no serial number, as many USB serial adapters do not,
+        so one board could not be told from another of the same kind. '''
+        for port in self.serial_ports:
+            if port.portName() == name and port.hasVendorIdentifier() and port.serialNumber():
+                return (port.vendorIdentifier(), port.productIdentifier(), port.serialNumber())
+        return None
+
+    def encoder_board_found(self, name):
+        ''' Note the USB device on a port as an encoder, so it is probed
+        when it is plugged in again. '''
+        identity = self.serial_port_identity(name)
+        if identity is not None:
+            self.encoder_boards.add(identity)
+
+    def encoder_detect(self):
+        ''' Probe the USB serial ports for an encoder. Opening a port resets
+        the board behind it, so the port selected for a Marlin printer is
+        left alone, and the user is asked before opening any device that has
+        not been seen as an encoder before. '''
+        ports = [port.portName() for port in self.serial_ports]
+        if self.cbx_printer_fwtype.currentIndex() == 3 and 0 <= self.cbx_printer_port.currentIndex() < len(self.serial_ports):
+            printer_port = self.serial_ports[self.cbx_printer_port.currentIndex()].portName()
+            ports = [name for name in ports if name != printer_port]
+        unknown = [name for name in ports if self.serial_port_identity(name) not in self.encoder_boards]
+        if unknown:
+            answer = QMessageBox.question(self, 'Search for Encoders',
+                                          'Searching opens {} and resets the boards on them. If one of them is a printer which '
+                                          'is not connected yet, choose No, select it as the printer port, and search again.\n\n'
+                                          'Search these ports?'.format(', '.join(unknown)))
+            if answer != QMessageBox.Yes:
+                ports = [name for name in ports if name not in unknown]
+        self.log_event('Searching for encoders')
+        self.encoder_probe(ports)
+
+    def encoder_probe(self, ports):
+        ''' Probe the given ports for encoders. Ports without a USB vendor ID
+        and the port of a connected Marlin printer are skipped, as opening
+        them could reset the device behind them. '''
+        if self.probe is not None:
+            return
+        usb = set(port.portName() for port in self.serial_ports if port.hasVendorIdentifier())
+        in_use = getattr(self.printer, 'portname', None)
+        candidates = [name for name in ports if name in usb and name != in_use]
+        if not candidates:
+            return
+        self.probe = SerialProbe(candidates)
+        self.probe.sig_log_debug.connect(self.log_debug)
+        self.probe.sig_finished.connect(self.encoder_probe_finished)
+        self.probe.start()
+
+    def encoder_probe_finished(self, found):
+        ''' The probe has finished, list the encoders it found. '''
+        self.probe = None
+        for info in found:
+            self.log_event('Found encoder v{} on {}'.format(info.firmware_version, info.port))
+            self.encoder_ports[info.port] = info
+            self.encoder_board_found(info.port)
+        if found:
+            self.populate_serial_ports()
 
     def populate_printer_ports(self):
         ''' Populate the printer combobox with available system serial ports.
@@ -294,11 +687,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.groupbox_esteps_klipper_results.setVisible(False)
         self.lbl_tool_esteps_static.setText('Extruder steps/mm')
 
-        if index == 2:
+        if index in (2, 4):
             self.groupbox_esteps_klipper_original.setVisible(True)
             self.groupbox_esteps_klipper_results.setVisible(True)
             self.lbl_tool_esteps_static.setText('Rotation Distance')
-            return
 
         if index == 3:
             self.txt_printer_hostname.setHidden(True)
@@ -309,128 +701,536 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.txt_printer_hostname.setHidden(False)
         self.cbx_printer_port.setHidden(True)
+        if index == 4:
+            self.lbl_printer_hostname_static.setText('Socket')
+            if not self.txt_printer_hostname.text():
+                self.txt_printer_hostname.setText(default_socket_path())
+            return
         self.lbl_printer_hostname_static.setText('Host or IP')
 
     def encoder_connect(self):
         ''' Connect to the serial encoder via the SerialEncoder class. '''
         port = self.serial_ports[self.cbx_encoder_port.currentIndex()].portName()
+        if self.probe is not None:
+            self.probe.close(port)
         self.log_event('Attempting connection to encoder on {}'.format(port))
-        self.encoder = SerialEncoder()
+        self.encoder_port = port
+        self.encoder_start(port)
+        self.sig_encoder_connect.emit()
+
+    def encoder_start(self, port):
+        ''' Create the encoder connection for port, and start its thread.
+        Used for the first connection and for each reconnection. The thread
+        is owned by the window, so it is not destroyed while the port is
+        still closing if a new connection replaces it. '''
+        self.thread_encoder = QThread(self)
+        self.thread_encoder.setObjectName('thread_encoder')
+        self.encoder = SerialEncoder(port, raw_counts=self.actn_encoder_raw_counts.isChecked())
         self.encoder.sig_log_event.connect(self.log_event)
         self.encoder.sig_log_debug.connect(self.log_debug)
         self.encoder.sig_handshake.connect(self.encoder_handshake)
-        self.encoder.sig_error.connect(self.error_critical)
-        self.encoder.sig_force_close.connect(self.encoder_disconnect)
-        self.sig_encoder_connect.emit()
-        self.encoder.connect(port)
+        self.encoder.sig_error.connect(self.encoder_error)
+        self.encoder.sig_force_close.connect(self.encoder_force_close)
+        self.encoder.sig_connection_lost.connect(self.encoder_connection_lost)
+        self.encoder.sig_measurement.connect(self.control_measurement)
+        self.encoder.moveToThread(self.thread_encoder)
+        self.thread_encoder.started.connect(self.encoder.run)
+        self.sig_encoder_close.connect(self.encoder.disconnect)
+        self.encoder.sig_closed.connect(self.thread_encoder.quit, Qt.DirectConnection)
+        self.thread_encoder.finished.connect(self.encoder.deleteLater)
+        self.thread_encoder.finished.connect(self.thread_encoder.deleteLater)
+        self.thread_encoder.start()
+
+    def encoder_release(self):
+        ''' Close the current encoder connection and forget it, without
+        touching the GUI. Anything it still signals is ignored, as it is no
+        longer self.encoder. '''
+        if self.encoder is None:
+            return
+        self.sig_encoder_close.emit()
+        self.encoder = None
 
     def encoder_disconnect(self):
-        ''' Disconnect from the serial encoder. '''
-        self.encoder.disconnect()
-        self.encoder = None
+        ''' Disconnect from the serial encoder. The port is closed from the
+        encoder thread, which then stops. '''
+        if self.encoder is None and not self.connections.reconnecting('encoder'):
+            return
+        self.connections.close('encoder')
+        self.encoder_release()
         self.log_event('Closed connection to encoder')
         self.sig_encoder_disconnect.emit()
 
+    def encoder_error(self, error):
+        ''' The encoder reported an error. While reconnecting, failed
+        attempts are expected, and only logged. '''
+        if self.sender() is not self.encoder:
+            return
+        if self.connections.reconnecting('encoder'):
+            self.log_debug('[SERIAL] {}'.format(error))
+            return
+        self.error_critical(error)
+
+    def encoder_force_close(self):
+        ''' The encoder connection failed. A failed reconnection attempt is
+        retried later, anything else closes the connection. '''
+        if self.sender() is not self.encoder:
+            return
+        if self.connections.reconnecting('encoder'):
+            self.encoder_release()
+            self.connections.failed('encoder')
+            return
+        self.encoder_disconnect()
+
+    def encoder_connection_lost(self, reason):
+        ''' The encoder's port went away. The encoder is reconnected, and a
+        running test waits for it, unless it never finished connecting. '''
+        if self.sender() is not self.encoder:
+            return
+        if not self.connections.lost('encoder', reason):
+            self.error_critical('The encoder connection reported an error and has been closed.')
+            self.encoder_disconnect()
+            return
+        self.encoder = None
+        if not self.working:
+            self.gui_settings_enabled(False)
+
+    def closeEvent(self, event):
+        ''' Close the encoder port and let its thread finish, and stop the
+        control API, before the application exits. '''
+        if self.encoder is not None:
+            thread = self.thread_encoder
+            self.encoder_disconnect()
+            thread.wait(1000)
+        if self.control_server is not None:
+            self.control_server.stop()
+        event.accept()
+
     def encoder_handshake(self):
         ''' The encoder returned a handshake, process and update the GUI with
-        the details '''
+        the details. After a reconnection the running worker is connected to
+        the new encoder and let carry on. '''
+        if self.sender() is not self.encoder:
+            return
+        reconnected = self.connections.reconnecting('encoder')
+        self.connections.connected('encoder')
+        if reconnected and self.worker is not None:
+            self.worker_connect_encoder(self.worker)
+        self.connections.restored('encoder')
+        if reconnected and not self.working and self.connections.gate.is_open():
+            self.gui_settings_enabled(True)
         self.sig_encoder_connect.emit()
         self.log_event('Connected to encoder')
+        self.encoder_board_found(self.encoder_port)
         self.log_debug('[SERIAL] Encoder Firmware: v{} - Built: {}'.format(self.encoder.firmware_version, self.encoder.firmware_date))
         self.lbl_encoder_fw.setText('v{} ({})'.format(self.encoder.firmware_version, self.encoder.firmware_date))
+        if self.encoder.raw:
+            self.log_debug('[SERIAL] Using raw encoder counts at {:.6f} counts/mm'.format(self.encoder.counts_per_mm))
+
+    def encoder_calibrate(self):
+        ''' Calibrate the encoder's gear diameter using the current tool.
+        The run button aborts the calibration while it is running. '''
+        if self.encoder is None or self.printer is None or self.working:
+            self.error_critical('Connect to the encoder and the printer, and wait for any running test to finish, before calibrating the encoder.')
+            return
+        answer = QMessageBox.question(self, 'Calibrate Encoder',
+                                      'This will extrude {}mm of filament using tool {}, and save a new calibration to the encoder.\n\n'
+                                      'The extruder must already be calibrated, and the tool must be at printing temperature.\n\n'
+                                      'Continue?'.format(WorkerDiameter.distance * WorkerDiameter.iterations, self.current_tool))
+        if answer != QMessageBox.Yes:
+            return
+        self.working = True
+        self.gui_settings_enabled(False)
+        self.btn_tool_run.setText('Abort')
+        self.btn_tool_run.setEnabled(True)
+        self.log_event('Beginning encoder calibration. The current diameter is {}'.format(self.encoder.calibration))
+        self.worker_diameter = WorkerDiameter(float(self.encoder.calibration))
+        self.worker_diameter.sig_finished.connect(self.encoder_calibrate_finished)
+        self.thread_diameter = self.worker_start(self.worker_diameter, 'thread_diameter')
+
+    def encoder_calibrate_finished(self):
+        ''' The encoder has saved its new diameter. '''
+        diameter = self.worker_diameter.diameter
+        self.worker = None
+        self.log_event('Encoder calibration complete! The new diameter is {:.6f}'.format(diameter))
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Information)
+        msg.setWindowTitle('Success!')
+        msg.setStandardButtons(QMessageBox.Ok)
+        msg.setText('The encoder calibration completed successfully.')
+        msg.setInformativeText('The effective diameter of the encoder gear has been calculated to be {:.6f}, and saved to the encoder.'.format(diameter))
+        msg.exec_()
+        self.gui_settings_enabled(True)
+        self.gui_tab_update(self.tabMain.currentIndex())
+        self.working = False
+
+    def printer_cache_clear(self):
+        ''' Forget the cached printer configurations, so the next connect to
+        each printer runs a full discovery. '''
+        printer_config_cache.clear()
+        self.log_event('Cleared the cached printer configurations')
+
+    def printer_discover(self):
+        ''' Ask for the hosts to search, then search them for printers in the
+        background. '''
+        if self.discovery is not None:
+            return
+        text, ok = QInputDialog.getText(self, 'Discover Printers', 'Hosts or subnets to search:', QLineEdit.Normal, local_subnet())
+        if not ok:
+            return
+        try:
+            hosts = parse_hosts(text)
+        except ValueError as e:
+            self.error_critical('Unable to search {}: {}'.format(text, e))
+            return
+        self.log_event('Searching {} host(s) for printers'.format(len(hosts)))
+        self.actn_printer_discover.setEnabled(False)
+        self.discovery = PrinterDiscovery(hosts)
+        self.discovery.sig_found.connect(self.printer_discovered)
+        self.discovery.sig_finished.connect(self.printer_discovery_finished)
+        self.discovery.start()
+
+    def printer_discovered(self, printer):
+        self.log_debug('[DISCOVERY] Found {} {} at {} ({:.0f} ms)'.format(printer.firmware, printer.version, printer.host, printer.latency * 1000))
+
+    def printer_discovery_finished(self, printers):
+        ''' Remember the printers found, and let the user pick one to connect
+        to. '''
+        self.discovery = None
+        self.actn_printer_discover.setEnabled(True)
+        self.log_event('Found {} printer(s)'.format(len(printers)))
+        if not printers:
+            return
+        for printer in printers:
+            self.known_printers[printer.host] = printer
+        try:
+            save_known_printers(self.known_printers)
+        except OSError as e:
+            self.log_debug('[DISCOVERY] Unable to save the printer cache: {}'.format(e))
+        self.txt_printer_hostname.setCompleter(QCompleter(sorted(self.known_printers), self))
+        if self.printer is not None:
+            return
+
+        labels = ['{} - {} {} at {}'.format(printer.name, FIRMWARE_NAMES[printer.firmware], printer.version, printer.host) for printer in printers]
+        label, ok = QInputDialog.getItem(self, 'Discover Printers', 'Select the printer to use:', labels, 0, False)
+        if not ok:
+            return
+        printer = printers[labels.index(label)]
+        self.cbx_printer_fwtype.setCurrentIndex(FIRMWARE_INDEX[printer.firmware])
+        self.txt_printer_hostname.setText(printer.host)
+
+    def printer_host_changed(self, host):
+        ''' Select the firmware type of a printer found by an earlier
+        discovery, so reconnecting needs no probing. '''
+        printer = self.known_printers.get(host.strip())
+        if printer is not None:
+            self.cbx_printer_fwtype.setCurrentIndex(FIRMWARE_INDEX[printer.firmware])
 
     def printer_connect(self):
         ''' Connect to the specified firmware '''
-        if self.cbx_printer_fwtype.currentIndex() == 0:
+        index = self.cbx_printer_fwtype.currentIndex()
+        if index == 0:
             self.log_event('Attempting connection to RepRapFirmware3 at {}'.format(self.txt_printer_hostname.text()))
-            self.printer = RepRapFirmware3(self.txt_printer_hostname.text())
-            self.printer_start_thread()
-        if self.cbx_printer_fwtype.currentIndex() == 1:
+        if index == 1:
             self.log_event('Attempting connection to RepRapFirmware3 via the SBC {}'.format(self.txt_printer_hostname.text()))
-            self.printer = RepRapFirmware3_SBC(self.txt_printer_hostname.text())
-            self.printer_start_thread()
-        if self.cbx_printer_fwtype.currentIndex() == 2:
+        if index == 2:
             self.log_event('Attempting connection to Klipper via Moonraker at {}'.format(self.txt_printer_hostname.text()))
-            self.printer = Klipper(self.txt_printer_hostname.text())
-            self.printer_start_thread()
-        if self.cbx_printer_fwtype.currentIndex() == 3:
+        if index == 3:
             self.log_event('Attempting connection to Marlin via serial port {}'.format(self.serial_ports[self.cbx_printer_port.currentIndex()].portName()))
-            self.printer = Marlin(self.serial_ports[self.cbx_printer_port.currentIndex()].portName())
-
-        self.printer.sig_log_event.connect(self.log_event)
-        self.printer.sig_log_debug.connect(self.log_debug)
-        self.printer.sig_connected.connect(self.printer_connected)
-        self.printer.sig_error.connect(self.error_critical)
-        self.printer.sig_force_close.connect(self.printer_force_close)
-        self.printer.sig_data_update.connect(self.printer_update)
-        self.printer.sig_temp_reached.connect(self.printer_temp_reached)
-        self.sig_printer_connect.emit()
+            self.printer_target = (index, self.serial_ports[self.cbx_printer_port.currentIndex()].portName())
+        else:
+            self.printer_target = (index, self.txt_printer_hostname.text())
+        if index == 4:
+            self.log_event('Attempting connection to Klipper via its API socket {}'.format(self.txt_printer_hostname.text()))
 
-    def printer_start_thread(self):
-        ''' Move the printer QObject to a new thread and start it. '''
-        self.printer.moveToThread(self.thread_printer)
-        self.thread_printer.started.connect(self.printer.run)
-        self.printer.sig_finished.connect(self.thread_printer.quit)
-        self.thread_printer.start()
+        self.printer_isolated = self.actn_printer_process.isChecked()
+        self.sig_printer_connect.emit()
+        self.printer_start(*self.printer_target)
+
+    def printer_start(self, index, target, attempt=False):
+        ''' Create the backend for the firmware at index in
+        cbx_printer_fwtype, connect it to the GUI and start it. target is
+        its host, socket or serial port. A reconnection attempt is kept in
+        printer_attempt, and only replaces the lost backend once it has
+        connected. With Tools > Run Printer Backend in a Separate Process
+        checked, the backend runs in a BackendProcess instead of
+        thread_printer. '''
+        if index == 0:
+            backend = RepRapFirmware3
+        if index == 1:
+            backend = RepRapFirmware3_SBC
+        if index == 2:
+            backend = Klipper
+        if index == 3:
+            backend = Marlin
+        if index == 4:
+            backend = KlipperSocket
+        if self.printer_isolated:
+            printer = BackendProcess.create(backend, target)
+        else:
+            printer = backend(target)
+
+        printer.sig_log_event.connect(self.log_event)
+        printer.sig_log_debug.connect(self.log_debug)
+        printer.sig_connected.connect(self.printer_connected)
+        printer.sig_error.connect(self.printer_error)
+        printer.sig_force_close.connect(self.printer_force_close)
+        printer.sig_connection_lost.connect(self.printer_connection_lost)
+        if hasattr(printer, 'sig_connection_restored'):
+            printer.sig_connection_restored.connect(self.printer_connection_restored)
+        printer.sig_data_update.connect(self.printer_update)
+        printer.sig_temp_reached.connect(self.printer_temp_reached)
+        printer.sig_temp_stable.connect(self.printer_temp_stable)
+
+        thread = None
+        if index != 3 and not self.printer_isolated:
+            thread = self.printer_start_thread(printer)
+        if attempt:
+            self.printer_attempt, self.thread_printer_attempt = printer, thread
+        else:
+            self.printer, self.thread_printer = printer, thread
+        if thread is None:
+            printer.run()
+            return
+        thread.start()
+
+    def printer_start_thread(self, printer):
+        ''' Move the printer QObject to a new thread, which is returned
+        ready to start. Each connection has a thread of its own, owned by
+        the window, which is deleted along with the backend once it
+        finishes. '''
+        thread = QThread(self)
+        thread.setObjectName('thread_printer')
+        printer.moveToThread(thread)
+        thread.started.connect(printer.run)
+        printer.sig_finished.connect(thread.quit)
+        thread.finished.connect(printer.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        return thread
+
+    def printer_stop(self, printer, thread):
+        ''' Stop a backend without switching off its heaters, as when its
+        connection has been lost. Its signals are blocked, so nothing it is
+        still doing reaches the GUI. '''
+        if printer is None:
+            return
+        printer.blockSignals(True)
+        printer.run_thread = False
+        if printer.estop_channel is not None:
+            printer.estop_channel.stop()
+        if hasattr(printer, 'close'):
+            printer.close()
+        if thread is not None:
+            thread.quit()
+
+    def printer_release_attempt(self):
+        self.printer_stop(self.printer_attempt, self.thread_printer_attempt)
+        self.printer_attempt = None
+        self.thread_printer_attempt = None
 
     def printer_connected(self):
         ''' The printer connection established sucessfully. '''
+        if self.sender() is self.printer_attempt:
+            self.printer_reconnected()
+            return
+        self.connections.connected('printer')
         self.sig_printer_connect.emit()
+        self.estop_channel = self.printer.estop_channel
+        self.estop_channel.sig_acknowledged.connect(self.printer_estop_acknowledged)
+        self.estop_channel.sig_failed.connect(self.printer_estop_failed)
         self.lbl_printer_fw.setText(self.printer.fw_string)
+        self.printer_steps = {}
+        self.printer_heaters = {}
         self.cbx_tool.clear()
-        for tool, data in enumerate(self.printer.cfg_tools):
+        for tool, _ in enumerate(self.printer_status.tools):
             self.cbx_tool.addItem('Tool {}'.format(tool))
         self.groupbox_settings.setEnabled(True)
 
+    def printer_reconnected(self):
+        ''' A new backend has connected in place of one whose connection was
+        lost. It takes over from the lost backend, keeping the tools in the
+        GUI as they are, the running worker and batch are connected to it,
+        and the printer is put back in the state it was left in. '''
+        lost = self.printer
+        self.printer, self.thread_printer = self.printer_attempt, self.thread_printer_attempt
+        self.printer_attempt = None
+        self.thread_printer_attempt = None
+        self.connections.connected('printer')
+        self.estop_channel = self.printer.estop_channel
+        self.estop_channel.sig_acknowledged.connect(self.printer_estop_acknowledged)
+        self.estop_channel.sig_failed.connect(self.printer_estop_failed)
+        self.lbl_printer_fw.setText(self.printer.fw_string)
+        if self.worker is not None:
+            self.worker_connect_printer(self.worker)
+        if self.batch is not None:
+            self.batch.sig_set_temperature.connect(self.printer_set_tool_temperature)
+        self.printer_resync()
+
+    def printer_resync(self):
+        ''' Restore the relative extrusion mode, the active tool, the steps
+        and the heater targets of the session, then let anything waiting on
+        the printer carry on. The steps are those of the last status from
+        before the connection dropped, apart from any set since, which it
+        may not have caught up with. '''
+        steps = [self.printer_steps.get(i, tool.steps_per_mm) for i, tool in enumerate(self.printer_status.tools)]
+        self.printer.resync(self.current_tool, steps, self.printer_targets)
+        self.connections.restored('printer')
+        if not self.working and self.connections.gate.is_open():
+            self.gui_settings_enabled(True)
+
+    def printer_connection_lost(self, reason):
+        ''' The connection to the printer dropped during the session. The
+        HTTP backends keep polling until the printer responds again. The
+        others are stopped, and stay in place for the GUI to read until the
+        connection manager has connected a replacement. Either way the
+        heater targets are kept for the resync, and a running test
+        waits. '''
+        if self.sender() is not self.printer:
+            return
+        recovers = hasattr(self.printer, 'sig_connection_restored')
+        if not self.connections.interrupted('printer') and self.printer_status is not None:
+            self.printer_targets = [self.printer_heaters.get(i, tool.target) for i, tool in enumerate(self.printer_status.tools)]
+        if not self.connections.lost('printer', reason, reconnect=not recovers):
+            if not recovers:
+                self.error_critical('Lost the connection to the printer: {}'.format(reason))
+                self.printer_force_close()
+            return
+        if not self.working:
+            self.gui_settings_enabled(False)
+        if not recovers:
+            self.printer_stop(self.printer, self.thread_printer)
+            self.thread_printer = None
+
+    def printer_connection_restored(self):
+        ''' An HTTP backend is reaching the printer again. '''
+        if self.sender() is not self.printer or not self.connections.interrupted('printer'):
+            return
+        self.connections.connected('printer')
+        self.printer_resync()
+
+    def printer_error(self, error):
+        ''' The printer reported an error. Failed reconnection attempts are
+        expected, and only logged. '''
+        if self.sender() is self.printer_attempt:
+            self.log_debug('[PRINTER] {}'.format(error))
+            return
+        self.error_critical(error)
+
     def printer_force_close(self):
         ''' A critical error occured in the printer class. Force
-        close the connection and clean up. '''
+        close the connection and clean up. A failed reconnection attempt is
+        retried later instead. '''
+        if self.sender() is self.printer_attempt and self.printer_attempt is not None:
+            self.printer_release_attempt()
+            self.connections.failed('printer')
+            return
         if self.printer is not None:
             self.printer.run_thread = False
-        self.thread_printer.quit()
-        self.thread_printer.started.disconnect()
+        if self.thread_printer is not None:
+            self.thread_printer.quit()
+            self.thread_printer = None
 
         self.log_event('Error connecting to printer')
+        self.connections.close('printer')
         self.printer = None
+        self.printer_status = None
         self.sig_printer_disconnect.emit()
         self.groupbox_settings.setEnabled(False)
 
-    def printer_update(self):
-        ''' The printer has signalled that updated data is available. '''
-        if self.printer is None:
+    def connection_attempt(self, link):
+        ''' The connection manager is ready to try reconnecting a link, with
+        the same settings as the session. '''
+        if link == ConnectionManager.ENCODER:
+            self.encoder_start(self.encoder_port)
+            return
+        self.printer_release_attempt()
+        self.printer_start(*self.printer_target, attempt=True)
+
+    def connection_abandon(self, link):
+        ''' A reconnection attempt has hung, such as a port which opened but
+        never handshook. '''
+        if link == ConnectionManager.ENCODER:
+            self.encoder_release()
+            return
+        self.printer_release_attempt()
+
+    def connection_gave_up(self, link):
+        ''' A link could not be reconnected. Close it as if the user had,
+        which aborts any running test. '''
+        self.error_critical('Unable to reconnect to the {}. The connection has been closed.'.format(link))
+        if self.worker is not None:
+            self.worker.abort()
+        if link == ConnectionManager.ENCODER:
+            self.encoder_disconnect()
             return
-        tool_data = self.printer.cfg_tools[self.current_tool]
-        self.txt_tool_curtemp.setText('{:.2f} C'.format(tool_data['cur_temp']))
+        self.printer_disconnect()
 
-        if hasattr(self.printer, 'isKlipper'):
-            self.txt_tool_curstep.setText('{:.6f}'.format(tool_data['rotation_distance']))
+    def printer_update(self, status):
+        ''' The printer has signalled that updated data is available. status
+        is a PrinterStatus snapshot, which is kept for the rest of the GUI to
+        read instead of the backend's own data. '''
+        if self.sender() is not self.printer:
+            return
+        self.printer_status = status
+        if self.current_tool >= len(status.tools):
+            return
+        tool = status.tools[self.current_tool]
+        if tool.eta:
+            self.txt_tool_curtemp.setText('{:.2f} C (stable in {:.0f} s)'.format(tool.temperature, tool.eta))
+        else:
+            self.txt_tool_curtemp.setText('{:.2f} C'.format(tool.temperature))
+
+        if tool.rotation_distance is not None:
+            self.txt_tool_curstep.setText('{:.6f}'.format(tool.rotation_distance))
         else:
-            self.txt_tool_curstep.setText('{:.2f}'.format(tool_data['stepsPerMm']))
+            self.txt_tool_curstep.setText('{:.2f}'.format(tool.steps_per_mm))
 
-        if self.printer.homed and not self.working:
+        if status.homed and not self.working:
             self.btn_tool_move.setEnabled(True)
 
+    def tool_temperature(self):
+        ''' The last reported temperature of the current tool. '''
+        if self.printer_status is None or self.current_tool >= len(self.printer_status.tools):
+            return 0.0
+        return self.printer_status.tools[self.current_tool].temperature
+
     def printer_disconnect(self):
         ''' Disconnect from the printer '''
+        self.connections.close('printer')
+        self.printer_release_attempt()
         self.cbx_tool.clear()
         self.printer.disconnect()
         self.printer = None
+        self.thread_printer = None
+        self.printer_status = None
         self.log_event('Closed connection to printer')
         self.sig_printer_disconnect.emit()
         self.groupbox_settings.setEnabled(False)
 
     def printer_temp_reached(self, tool):
         ''' The printer has signalled the tool has hit the
-        requested temperature. '''
+        requested temperature. During a batch run the batch decides what
+        happens next, as several tools are heated on purpose. '''
+        if self.batch is not None:
+            self.batch.temp_reached(tool)
+            return
         if self.working:
             return
         if tool != self.current_tool:
             self.log_event('WARNING: Tool {} is at temperature, but it is not the active tool. Setting its temperature to 0C'.format(tool))
-            self.printer.set_tool_temperature(0, tool)
+            self.printer_set_tool_temperature(0, tool)
             return
+        if self.heat_started is not None:
+            metrics.observe('nxencoder_heatup_seconds', time.perf_counter() - self.heat_started)
+            self.heat_started = None
         self.btn_tool_heat.setEnabled(True)
         self.btn_tool_run.setEnabled(True)
 
+    def printer_temp_stable(self, tool):
+        ''' The printer has signalled the tool temperature has settled at
+        its target. Any running test waits for this before priming. '''
+        if tool == self.current_tool:
+            self.log_event('Tool {} temperature is stable'.format(tool))
+
     def printer_move_home(self):
         ''' Attempt to home the printer '''
         self.log_event('Homing printer axes')
@@ -448,7 +1248,18 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.btn_tool_heat.setEnabled(False)
         self.btn_tool_run.setEnabled(False)
         self.log_event('Heating tool {} to {} C'.format(self.current_tool, self.dsbx_tool_temp.text()))
-        self.printer.set_tool_temperature(self.dsbx_tool_temp.text(), self.current_tool)
+        self.heat_started = time.perf_counter()
+        self.printer_set_tool_temperature(self.dsbx_tool_temp.value(), self.current_tool)
+
+    def printer_set_tool_temperature(self, temp, tool):
+        ''' Set the target of a heater, noting it for the resync after a
+        reconnect. The last status may not have caught up with it when the
+        connection drops, and while it is down the targets to restore are
+        updated directly. '''
+        self.printer_heaters[tool] = float(temp)
+        if tool < len(self.printer_targets):
+            self.printer_targets[tool] = float(temp)
+        self.printer.set_tool_temperature(temp, tool)
 
     def gui_tool_update(self, index):
         ''' Signalled when the tool combobox is altered. If we change tool, we
@@ -457,12 +1268,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if index != -1:
             self.log_event('Selecting tool {}'.format(index))
             if self.current_tool != index:
-                self.printer.set_tool_temperature(0, self.current_tool)
+                self.printer_set_tool_temperature(0, self.current_tool)
             self.current_tool = index
-            if self.printer.cfg_tools[index]['max_temp'] == 0:
-                self.dsbx_tool_temp.setMaximum(250)
-                return
-            self.dsbx_tool_temp.setMaximum(self.printer.cfg_tools[index]['max_temp'])
+            self.dsbx_tool_temp.setMaximum(int(self.printer_status.tools[index].max_temp) or 250)
 
     def gui_tab_update(self, index):
         ''' Signalled when the user changes tab on the bottom of the
@@ -480,16 +1288,45 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def printer_estop(self):
         ''' Trigger an immediate emergency stop and then close all printer
-        connections. '''
+        connections. The stop goes out on the printer's estop channel, and
+        is acknowledged through printer_estop_acknowledged. '''
+        pressed_at = time.perf_counter()
+        if self.printer is None:
+            return
+        self.printer.estop(pressed_at)
         self.log_event('**** EMERGENCY STOP TRIGGERED ****')
-        self.printer.estop()
+        if self.worker is not None:
+            self.worker.abort()
         self.printer_disconnect()
 
+    def printer_estop_acknowledged(self, latency):
+        ''' The printer acknowledged the emergency stop. '''
+        self.log_event('Emergency stop acknowledged by the printer after {:.0f} ms'.format(latency * 1000))
+        self.estop_channel = None
+
+    def printer_estop_failed(self, error):
+        ''' The emergency stop could not be delivered. '''
+        self.log_debug('[ESTOP] Error: {}'.format(error))
+        self.error_critical('The emergency stop could not be sent to the printer. Switch the printer off now.')
+
     def printer_run(self):
         ''' Triggered when the run button is pressed. We determine the correct
-        test to run based upon tabMain.currentIndex(). '''
+        test to run based upon tabMain.currentIndex(). While a test is
+        running the button aborts it instead. '''
+        if self.working:
+            self.printer_abort()
+            return
         self.working = True
         self.gui_settings_enabled(False)
+        self.btn_tool_run.setText('Abort')
+        self.btn_tool_run.setEnabled(True)
+        if self.actn_batch_mode.isChecked() and len(self.printer_status.tools) > 1:
+            self.batch_start()
+            return
+        self.printer_run_test()
+
+    def printer_run_test(self):
+        ''' Start the test for the current tool. '''
         if self.tabMain.currentIndex() == 0:
             self.printer_calibrate_esteps()
             return
@@ -505,30 +1342,32 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         for i in self.tab_esteps.findChildren(QLineEdit):
             i.clear()
 
-        self.txt_esteps_original.setText('{:.2f}'.format(self.printer.cfg_tools[self.current_tool]['stepsPerMm']))
-        if hasattr(self.printer, 'isKlipper'):
-            self.txt_esteps_klipper_original.setText('{:.6f}'.format(self.printer.cfg_tools[self.current_tool]['rotation_distance']))
-        self.thread_esteps = QThread()
         self.worker_esteps = WorkerEsteps()
-        self.worker_esteps.moveToThread(self.thread_esteps)
-        self.thread_esteps.started.connect(self.worker_esteps.run)
-        self.worker_esteps.sig_encoder_measure.connect(self.encoder.measure)
-        self.worker_esteps.sig_encoder_reset.connect(self.encoder.reset)
-        self.worker_esteps.sig_printer_send_gcode.connect(self.printer.send_gcode)
-        self.worker_esteps.sig_log_event.connect(self.log_event)
+        self.worker_esteps.esteps = self.printer_status.tools[self.current_tool].steps_per_mm
+        resumed = self.worker_checkpoint(self.worker_esteps)
+        if resumed and self.worker_esteps.esteps != self.printer_status.tools[self.current_tool].steps_per_mm:
+            self.printer_set_esteps(self.worker_esteps.esteps, self.current_tool)
+
+        esteps, rotation_distance = self.esteps_corrected(0)
+        self.txt_esteps_original.setText('{:.2f}'.format(esteps))
+        if hasattr(self.printer, 'isKlipper'):
+            self.txt_esteps_klipper_original.setText('{:.6f}'.format(rotation_distance))
+        if resumed:
+            # Replaying the results shows them again, and applies the
+            # coarse correction if the run had got that far.
+            for results_num in range(1, len(self.worker_esteps.cal_results) + 1):
+                self.esteps_data_ready(results_num)
         self.worker_esteps.sig_result_ready.connect(self.esteps_data_ready)
         self.worker_esteps.sig_finished.connect(self.esteps_finished)
-        self.worker_esteps.sig_finished.connect(self.worker_esteps.deleteLater)
-        self.worker_esteps.sig_finished.connect(self.thread_esteps.deleteLater)
-        self.encoder.sig_measurement.connect(self.worker_esteps.handle_measurement)
-        self.thread_esteps.start()
+        self.thread_esteps = self.worker_start(self.worker_esteps, 'thread_esteps')
 
-    def esteps_data_ready(self):
+    def esteps_data_ready(self, results_num=None):
         ''' Signalled when the esteps calibration worker has completed an
-        iteration and the data is ready for the GUI. '''
-        current_tool_esteps = self.printer.cfg_tools[self.current_tool]['stepsPerMm']
-
-        results_num = len(self.worker_esteps.cal_results)
+        iteration and the data is ready for the GUI. results_num is only
+        given when replaying the results of a resumed calibration. '''
+        if results_num is None:
+            results_num = len(self.worker_esteps.cal_results)
+        current_tool_esteps, rotation_distance = self.esteps_corrected(10 if results_num > 10 else 0)
         results_pct = round((results_num / 20) * 100)
         self.progress_esteps.setValue(results_pct)
 
@@ -546,15 +1385,15 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.txt_esteps_coarse_pct_avg.setText('{:.2f} %'.format(distance_pct * 100))
             self.txt_esteps_calculated.setText('{:.2f}'.format(current_tool_esteps / distance_pct))
             if hasattr(self.printer, 'isKlipper'):
-                self.txt_esteps_klipper_calculated.setText('{:.6f}'.format(self.printer.cfg_tools[self.current_tool]['rotation_distance'] * distance_pct))
+                self.txt_esteps_klipper_calculated.setText('{:.6f}'.format(rotation_distance * distance_pct))
 
         if results_num == 10:
             self.log_event('Calculated coarse eSteps: {:.2f}'.format(current_tool_esteps / distance_pct))
             if hasattr(self.printer, 'isKlipper'):
-                self.log_event('Calculated coarse rotation_distance: {:.6f}'.format(self.printer.cfg_tools[self.current_tool]['rotation_distance'] * distance_pct))
+                self.log_event('Calculated coarse rotation_distance: {:.6f}'.format(rotation_distance * distance_pct))
 
             current_tool_esteps = current_tool_esteps / distance_pct
-            self.printer.set_tool_esteps(current_tool_esteps)
+            self.printer_set_esteps(current_tool_esteps, self.current_tool)
 
         if results_num >= 11:
             qle = self.tab_esteps.findChild(QLineEdit, 'txt_esteps_{}'.format(results_num - 1))
@@ -567,79 +1406,189 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.txt_esteps_fine_pct_avg.setText('{:.2f} %'.format(distance_pct * 100))
             self.txt_esteps_calculated.setText('{:.2f}'.format(current_tool_esteps / distance_pct))
             if hasattr(self.printer, 'isKlipper'):
-                self.txt_esteps_klipper_calculated.setText('{:.6f}'.format(self.printer.cfg_tools[self.current_tool]['rotation_distance'] * distance_pct))
+                self.txt_esteps_klipper_calculated.setText('{:.6f}'.format(rotation_distance * distance_pct))
 
         if results_num == 20:
             self.log_event('Calculated final eSteps: {:.2f}'.format(current_tool_esteps / distance_pct))
             if hasattr(self.printer, 'isKlipper'):
-                self.log_event('Calculated final rotation_distance: {:.6f}'.format(self.printer.cfg_tools[self.current_tool]['rotation_distance'] * distance_pct))
+                self.log_event('Calculated final rotation_distance: {:.6f}'.format(rotation_distance * distance_pct))
                 
             current_tool_esteps = current_tool_esteps / distance_pct
-            self.printer.set_tool_esteps(current_tool_esteps)
+            self.printer_set_esteps(current_tool_esteps, self.current_tool)
+
+    def esteps_corrected(self, results_num):
+        ''' The steps/mm, and for Klipper the rotation_distance, of the tool
+        being calibrated once the corrections from its first results_num
+        results are applied: the coarse correction from 10 and the fine one
+        from 20. They are worked out from the results, as the printer status
+        may not have caught up with the last correction yet. '''
+        worker = self.worker_esteps
+        esteps = worker.esteps
+        if results_num >= 10:
+            esteps /= (sum(worker.cal_results[0:10]) / 10) / worker.distance_coarse
+        if results_num >= 20:
+            esteps /= (sum(worker.cal_results[10:20]) / 10) / worker.distance_fine
+        tool = self.printer_status.tools[self.current_tool]
+        rotation_distance = None
+        if tool.rotation_distance is not None:
+            # rotation_distance is inversely proportional to steps/mm
+            rotation_distance = tool.rotation_distance * tool.steps_per_mm / esteps
+        return esteps, rotation_distance
+
+    def printer_set_esteps(self, esteps, tool):
+        ''' Change the steps/mm of a tool, noting them for the resync after
+        a reconnect. '''
+        self.printer_steps[tool] = esteps
+        self.printer.set_tool_esteps(esteps, tool)
 
     def printer_check_consistency(self):
         ''' Run a consistency loop to check the extruder. '''
         self.log_event('Beginning extruder consistency test. Please wait whilst this completes.')
-        self.thread_consistency = QThread()
         self.worker_consistency = WorkerConsistency()
+        self.worker_checkpoint(self.worker_consistency)
         self.chart_const_widget.setChart(self.worker_consistency.chart)
         self.chart_const_widget.setRenderHint(QPainter.Antialiasing)
-        self.worker_consistency.moveToThread(self.thread_consistency)
-        self.thread_consistency.started.connect(self.worker_consistency.run)
-        self.worker_consistency.sig_encoder_measure.connect(self.encoder.measure)
-        self.worker_consistency.sig_encoder_reset.connect(self.encoder.reset)
-        self.worker_consistency.sig_printer_send_gcode.connect(self.printer.send_gcode)
-        self.worker_consistency.sig_log_event.connect(self.log_event)
         self.worker_consistency.sig_finished.connect(self.const_finished)
-        self.worker_consistency.sig_finished.connect(self.worker_consistency.deleteLater)
-        self.worker_consistency.sig_finished.connect(self.thread_consistency.deleteLater)
-        self.encoder.sig_measurement.connect(self.worker_consistency.handle_measurement)
-        self.thread_consistency.start()
+        self.thread_consistency = self.worker_start(self.worker_consistency, 'thread_consistency')
 
     def printer_volumetric_calc(self):
         ''' Calculate the maximum volumetric flow. '''
         self.log_event('Beginning maximum volumetric flow calculation. Please wait whilst this completes')
-        self.thread_volumetric = QThread()
         self.worker_volumetric = WorkerVolumetric()
+        self.worker_checkpoint(self.worker_volumetric)
         self.chart_vcal_widget.setChart(self.worker_volumetric.chart)
         self.chart_vcal_widget.setRenderHint(QPainter.Antialiasing)
-        self.worker_volumetric.moveToThread(self.thread_volumetric)
-        self.thread_volumetric.started.connect(self.worker_volumetric.run)
-        self.worker_volumetric.sig_encoder_measure.connect(self.encoder.measure)
-        self.worker_volumetric.sig_encoder_reset.connect(self.encoder.reset)
-        self.worker_volumetric.sig_printer_send_gcode.connect(self.printer.send_gcode)
-        self.worker_volumetric.sig_log_debug.connect(self.log_debug)
-        self.worker_volumetric.sig_log_event.connect(self.log_event)
         self.worker_volumetric.sig_finished.connect(self.volumetric_finished)
-        self.worker_volumetric.sig_finished.connect(self.worker_volumetric.deleteLater)
-        self.worker_volumetric.sig_finished.connect(self.thread_volumetric.deleteLater)
-        self.encoder.sig_measurement.connect(self.worker_volumetric.handle_measurement)
-        self.thread_volumetric.start()
+        self.thread_volumetric = self.worker_start(self.worker_volumetric, 'thread_volumetric')
+
+    def worker_checkpoint(self, worker):
+        ''' Have the worker checkpoint its progress, under the parameters of
+        this run. If a run with the same parameters was cut short, the user
+        is offered to resume it, unless a batch is running. A test started
+        from the control API has already been told whether to resume.
+        Returns True if the worker was restored from the checkpoint. '''
+        worker.checkpoint = {
+            'test': worker.name,
+            'printer': list(self.printer_target),
+            'tool': self.current_tool,
+            'temperature': self.dsbx_tool_temp.value(),
+            'encoder': self.encoder.calibration
+        }
+        entry = checkpoint_cache.lookup(worker.checkpoint)
+        resume, self.test_resume = self.test_resume, None
+        if entry is None or self.batch is not None:
+            return False
+
+        if resume is None:
+            saved = time.strftime('%H:%M on %d %b', time.localtime(entry.get('saved', 0)))
+            answer = QMessageBox.question(self, 'Resume Test',
+                                          'The {} test on tool {} was interrupted at {}.\n\n'
+                                          'Resume it from the last completed iteration? Choosing No starts the test again.'.format(worker.name, self.current_tool, saved))
+            resume = answer == QMessageBox.Yes
+        if not resume:
+            checkpoint_cache.clear()
+            return False
+        try:
+            worker.restore_checkpoint(entry['state'])
+        except (KeyError, TypeError, ValueError) as e:
+            self.log_debug('[WORKER] Unable to restore the checkpoint: {}'.format(e))
+            self.log_event('The saved progress could not be read, starting the test again')
+            checkpoint_cache.clear()
+            return False
+        self.log_event('Resuming the {} test from the last completed iteration'.format(worker.name))
+        return True
+
+    def worker_start(self, worker, name):
+        ''' Move a test worker to a new thread, connect it to the encoder and
+        printer, and start it. The thread is stopped and both are deleted
+        once the test has finished or been aborted. '''
+        thread = QThread()
+        thread.setObjectName(name)
+        worker.tool = self.current_tool
+        worker.temp_stable = self.printer_status is not None and self.printer_status.tools[self.current_tool].stable
+        worker.gate = self.connections.gate
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        self.worker_connect_encoder(worker)
+        self.worker_connect_printer(worker)
+        worker.sig_log_debug.connect(self.log_debug)
+        worker.sig_log_event.connect(self.log_event)
+        worker.sig_aborted.connect(self.worker_aborted)
+        worker.sig_finished.connect(thread.quit)
+        worker.sig_aborted.connect(thread.quit)
+        thread.finished.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        self.worker = worker
+        thread.start()
+        return thread
+
+    def worker_connect_encoder(self, worker):
+        ''' Connect a worker to the current encoder. Called again after the
+        encoder has reconnected. The connections to the old encoder go with
+        it. '''
+        worker.sig_encoder_measure.connect(self.encoder.measure)
+        worker.sig_encoder_reset.connect(self.encoder.reset)
+        self.encoder.sig_measurement.connect(worker.receive_measurement)
+        if hasattr(worker, 'sig_encoder_calibrate'):
+            worker.sig_encoder_calibrate.connect(self.encoder.calibrate)
+            self.encoder.sig_calibrated.connect(worker.receive_calibration)
+            self.encoder.sig_calibration_error.connect(worker.receive_calibration_error)
+
+    def worker_connect_printer(self, worker):
+        ''' Connect a worker to the current printer backend. Called again
+        after the printer has reconnected. '''
+        worker.sig_printer_send_gcode.connect(self.printer.send_gcode)
+        if hasattr(self.printer, 'sig_gcode_complete'):
+            worker.gcode_completion = True
+            worker.sig_printer_run_gcode.connect(self.printer.run_gcode, Qt.DirectConnection)
+            self.printer.sig_gcode_complete.connect(worker.handle_gcode_complete)
+        self.printer.sig_temp_stable.connect(worker.handle_temp_stable)
+        self.printer.sig_data_update.connect(worker.handle_status)
+
+    def printer_abort(self):
+        ''' Abort the running test. The worker stops at its next wait, which
+        is within a few milliseconds. '''
+        self.log_event('Aborting the test on tool {}'.format(self.current_tool))
+        self.btn_tool_run.setEnabled(False)
+        if self.worker is None:
+            self.worker_aborted()
+            return
+        self.worker.abort()
+
+    def worker_aborted(self):
+        ''' The running test stopped after being aborted, either by the user
+        or by the worker itself. Switch off the heaters it was using. '''
+        self.worker = None
+        self.test_remote = False
+        self.log_event('Test aborted')
+        heaters = [self.current_tool]
+        if self.batch is not None:
+            heaters = self.batch.abort()
+            self.batch = None
+        if self.printer is not None:
+            for tool in heaters:
+                self.printer_set_tool_temperature(0, tool)
+        self.gui_settings_enabled(self.connections.gate.is_open())
+        self.btn_tool_run.setEnabled(False)
+        self.gui_tab_update(self.tabMain.currentIndex())
+        self.working = False
 
     def esteps_finished(self):
         ''' Signalled when the esteps process has completed. We can now
         perform a report on the extruder steps. '''
-        self.thread_esteps.quit()
-        self.thread_esteps.wait()
+        esteps, rotation_distance = self.esteps_corrected(20)
         if hasattr(self.printer, 'isKlipper'):
-            self.results_popup(self.printer.cfg_tools[self.current_tool]['rotation_distance'])
+            self.test_finished(rotation_distance)
         else:
-            self.results_popup(self.printer.cfg_tools[self.current_tool]['stepsPerMm'])
-        self.gui_settings_enabled(True)
-        self.working = False
+            self.test_finished(esteps)
 
     def const_finished(self):
         ''' Signalled when the readings for the chart have completed. We can
         now perform a report on the extruder consistency. '''
-        self.thread_consistency.quit()
-        self.thread_consistency.wait()
-
         deviation_avg = round(sum(self.worker_consistency.cal_results) / len(self.worker_consistency.cal_results), 2)
         self.log_event('Extruder consistency test complete!')
         self.log_event('Average deviation: {:.2f}%'.format(deviation_avg))
-        self.results_popup(deviation_avg)
-        self.gui_settings_enabled(True)
-        self.working = False
+        self.test_finished(deviation_avg)
 
     def volumetric_finished(self):
         ''' Signalled when the readings for the chart have completed. We can
@@ -649,12 +1598,98 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         max_volumetric = (self.worker_volumetric.feedrate / 60) * cu_mm_per_mm
         max_volumetric = round(max_volumetric - 0.5, 2)
 
-        self.thread_volumetric.quit()
-        self.thread_volumetric.wait()
         self.log_event('Maximum volumetric flow calculation complete!')
-        self.log_event('The maximum flow for tool {} at {}C is {} mm\u00b3/s'.format(self.current_tool, self.printer.cfg_tools[self.current_tool]['cur_temp'], max_volumetric))
-        self.results_popup(max_volumetric)
+        self.log_event('The maximum flow for tool {} at {}C is {} mm\u00b3/s'.format(self.current_tool, self.tool_temperature(), max_volumetric))
+        self.test_finished(max_volumetric)
+
+    def test_finished(self, result):
+        ''' A test has completed. Hand the result to the batch if one is
+        running, otherwise show it to the user, unless the test was started
+        from the control API, whose clients read it from /results. '''
+        if self.control_server is not None:
+            self.control_server.add_result({'test': self.worker.name, 'tool': self.current_tool,
+                                            'result': result, 'time': time.time()})
+        self.worker = None
+        if self.batch is not None:
+            self.batch.test_finished(result)
+            return
+        if not self.test_remote:
+            self.results_popup(result)
+        self.test_remote = False
+        self.gui_settings_enabled(True)
+        self.gui_tab_update(self.tabMain.currentIndex())
+        self.working = False
+
+    def batch_set_heater_limit(self):
+        ''' Ask the user how many heaters a batch may have on at once. '''
+        limit, ok = QInputDialog.getInt(self, 'Batch Heater Limit', 'Maximum number of heaters on at once during a batch:',
+                                        self.batch_heater_limit, 1, 10)
+        if ok:
+            self.batch_heater_limit = limit
+            self.log_event('Batch heater limit set to {}'.format(limit))
+
+    def batch_start(self):
+        ''' Run the selected test on every tool, beginning with the current
+        tool, while pre-heating the tools that are next in line. '''
+        tools = [self.current_tool] + [tool for tool in range(len(self.printer_status.tools)) if tool != self.current_tool]
+        temperatures = {}
+        for tool in tools:
+            max_temp = self.printer_status.tools[tool].max_temp or 250
+            temperatures[tool] = min(self.dsbx_tool_temp.value(), max_temp)
+
+        self.batch = BatchRunner(tools, temperatures, self.batch_heater_limit)
+        self.batch.sig_set_temperature.connect(self.printer_set_tool_temperature)
+        self.batch.sig_select_tool.connect(self.batch_select_tool)
+        self.batch.sig_start_test.connect(self.batch_start_test)
+        self.batch.sig_log_event.connect(self.log_event)
+        self.batch.sig_finished.connect(self.batch_finished)
+        self.batch.start()
+
+    def batch_select_tool(self, tool):
+        ''' Make the batch's next tool the current tool and move it to a safe
+        location. The tool combobox signals are blocked, as the batch already
+        manages the heaters. '''
+        self.cbx_tool.blockSignals(True)
+        self.cbx_tool.setCurrentIndex(tool)
+        self.cbx_tool.blockSignals(False)
+        self.current_tool = tool
+        self.printer.move_to_safe(tool)
+
+    def batch_start_test(self, tool):
+        ''' The batch's current tool is at temperature, run the test. '''
+        self.log_event('Batch: tool {} is at temperature, starting the test'.format(tool))
+        self.printer_run_test()
+
+    def batch_finished(self):
+        ''' Every tool in the batch has been tested. Report all the results
+        together. '''
+        results = self.batch.results
+        self.batch = None
+        self.log_event('Batch complete for {} tool(s)'.format(len(results)))
+
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Information)
+        msg.setWindowTitle('Success!')
+        msg.setStandardButtons(QMessageBox.Ok)
+        msg.setText('The batch completed successfully on {} tools.'.format(len(results)))
+        lines = []
+        for tool, result in sorted(results.items()):
+            if self.tabMain.currentIndex() == 0 and hasattr(self.printer, 'isKlipper'):
+                lines.append('Extruder {}: rotation_distance {:.6f}'.format(self.printer_status.tools[tool].name, result))
+            elif self.tabMain.currentIndex() == 0:
+                lines.append('Tool {}: {:.2f} steps/mm'.format(tool, result))
+            elif self.tabMain.currentIndex() == 1:
+                lines.append('Tool {}: average deviation {:.2f}%'.format(tool, result))
+            elif self.tabMain.currentIndex() == 2:
+                lines.append('Tool {}: maximum volumetric flow {}mm\u00b3/s'.format(tool, result))
+            self.log_event(lines[-1])
+        msg.setInformativeText('\n'.join(lines) + '\n\nYou will need to update your printers configuration to use any new values.'
+                               if self.tabMain.currentIndex() == 0 else '\n'.join(lines))
+        if not self.test_remote:
+            msg.exec_()
+        self.test_remote = False
         self.gui_settings_enabled(True)
+        self.gui_tab_update(self.tabMain.currentIndex())
         self.working = False
 
 class AboutDialog(QDialog, Ui_About):
@@ -677,6 +1712,9 @@ class AboutDialog(QDialog, Ui_About):
 
 
 if __name__ == '__main__':
+    # A frozen build starts backend processes by running this executable
+    # again, which freeze_support() turns into the backend, not the GUI.
+    multiprocessing.freeze_support()
     app = QApplication([])
     window_main = MainWindow()
     app.exec_()
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+backend_process.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QCoreApplication, QObject, QThread, QTimer
+
+from helpers.metrics import metrics
+from helpers.trace import tracer
+
+from functools import partial
+
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+
+# The signals every backend forwards from its process, and those only some
+# of them have. MainWindow checks for the optional ones with hasattr, so a
+# BackendProcess only has those of the backend it runs.
+SIGNALS = ('sig_connected', 'sig_data_update', 'sig_temp_reached', 'sig_temp_stable', 'sig_finished',
+           'sig_log_event', 'sig_log_debug', 'sig_error', 'sig_force_close', 'sig_connection_lost')
+OPTIONAL_SIGNALS = {
+    'sig_gcode_complete': (int, bool),
+    'sig_connection_restored': ()
+}
+
+# The backend attributes the GUI reads, copied back with every status
+# update.
+MIRRORED = ('cfg_tools', 'fw_string', 'homed', 'idle', 'isKlipper', 'portname')
+
+# The backend methods the GUI and the workers call.
+COMMANDS = ('run', 'disconnect', 'close', 'resync', 'estop', 'move_homeaxes', 'move_to_safe',
+            'send_gcode', 'run_gcode', 'set_tool_temperature', 'set_tool_esteps')
+
+_call_ids = itertools.count(1)
+
+
+def serve(backend_class, args, conn):
+    ''' Entry point of a backend process. The backend is run as it would
+    be in the GUI, with its own event loop, until it finishes or the GUI
+    goes away. '''
+    app = QCoreApplication([])
+    # Record a timeline all along, as it is up to the GUI whether it is
+    # kept. Each telemetry message takes what has been recorded so far.
+    tracer.start()
+    host = BackendHost(backend_class(*args), conn)
+    host.sig_quit.connect(app.quit)
+    host.start()
+    app.exec_()
+    # Anything still running, such as the backend's thread or a gcode
+    # queue, is abandoned rather than waited on.
+    os._exit(0)
+
+
+class BackendHost(QObject):
+    ''' The child's side of a BackendProcess. Commands are read from the
+    pipe on a thread of their own and run on the event loop, and the
+    backend's signals are sent back with the state the GUI reads. Backends
+    with a status loop run it in a thread, as they do in the GUI, so the
+    event loop is always free for an emergency stop. The metrics and trace
+    events the backend records are sent every telemetry_interval ms, for
+    the GUI to add to its own. '''
+    sig_command = pyqtSignal(str, object, object)
+    sig_quit = pyqtSignal()
+
+    drain_timeout = 5.0
+    telemetry_interval = 1000
+
+    def __init__(self, backend, conn, parent=None):
+        super(BackendHost, self).__init__(parent)
+        self.backend = backend
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.thread = None
+        self.sig_command.connect(self.execute)
+        self.telemetry_timer = QTimer(self)
+        self.telemetry_timer.timeout.connect(self.send_telemetry)
+        for name in SIGNALS + tuple(OPTIONAL_SIGNALS):
+            if hasattr(backend, name):
+                getattr(backend, name).connect(partial(self.forward, name))
+
+    def start(self):
+        self.send(('state', self.state()))
+        self.telemetry_timer.start(self.telemetry_interval)
+        threading.Thread(target=self.read, name='backend_commands', daemon=True).start()
+
+    def state(self):
+        return {name: getattr(self.backend, name) for name in MIRRORED if hasattr(self.backend, name)}
+
+    def send(self, message):
+        with self.lock:
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                pass
+
+    def send_telemetry(self):
+        counters, gauges, histograms = metrics.drain()
+        events = tracer.drain()
+        if counters or gauges or histograms or events:
+            self.send(('telemetry', (counters, gauges, histograms), events))
+
+    def read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                self.sig_command.emit('quit', (), None)
+                return
+            self.sig_command.emit(*message)
+
+    def forward(self, name, *args):
+        if name == 'sig_connected' and self.backend.estop_channel is not None:
+            self.backend.estop_channel.sig_acknowledged.connect(partial(self.forward, 'estop_acknowledged'))
+            self.backend.estop_channel.sig_failed.connect(partial(self.forward, 'estop_failed'))
+        self.send(('signal', name, args, self.state()))
+        if name in ('sig_finished', 'sig_force_close'):
+            self.finish()
+
+    def execute(self, method, args, request):
+        ''' Run a command on the backend. A reply, with the state the
+        command left the backend in, is only sent to commands the GUI asked
+        for one with. '''
+        if method == 'quit':
+            self.stop()
+            return
+        if method not in COMMANDS:
+            return
+        try:
+            if method == 'run':
+                self.run()
+            elif method == 'disconnect' and not hasattr(self.backend, 'sig_finished'):
+                # Marlin has nothing to finish, and is closed straight away.
+                self.backend.close()
+                self.finish()
+            elif method == 'close':
+                if hasattr(self.backend, 'close'):
+                    self.backend.close()
+                self.stop()
+            else:
+                getattr(self.backend, method)(*args)
+        except Exception as e:
+            self.send(('signal', 'sig_log_debug', ('[BACKEND] Error: {} failed: {}'.format(method, e),), self.state()))
+        if request is not None:
+            self.send(('reply', request, self.state()))
+
+    def run(self):
+        if not hasattr(self.backend, 'sig_finished'):
+            self.backend.run()
+            return
+        self.thread = QThread()
+        self.thread.setObjectName('thread_printer')
+        self.backend.moveToThread(self.thread)
+        self.thread.started.connect(self.backend.run)
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop without switching the heaters off, as when the GUI has
+        given up on this process. '''
+        self.backend.run_thread = False
+        self.send_telemetry()
+        self.sig_quit.emit()
+
+    def finish(self):
+        ''' The backend is done. Gcode it has queued, such as switching the
+        heaters off as it disconnects, is given time to be sent. '''
+        queue = getattr(self.backend, 'gcode_queue', None)
+        if queue is not None:
+            queue.thread.join(self.drain_timeout)
+        if self.thread is not None:
+            self.thread.quit()
+            self.thread.wait(int(self.drain_timeout * 1000))
+        self.send_telemetry()
+        self.sig_quit.emit()
+
+
+class ProcessEstopChannel(QObject):
+    ''' Stands in for the estop channel of a backend in another process.
+    The stop itself is sent by the backend's own channel, and only the
+    outcome comes back here. '''
+    sig_acknowledged = pyqtSignal(float)
+    sig_failed = pyqtSignal(str)
+
+    def stop(self):
+        return
+
+
+class BackendProcess(QObject):
+    ''' Runs a printer backend in a process of its own, so its blocking
+    requests and parsing no longer compete with the GUI, or with the
+    backends of other printers, for the GIL. It is used in place of the
+    backend: commands are sent over a pipe, and the backend's signals come
+    back with the attributes the GUI reads, such as cfg_tools.
+
+    If the process dies after connecting, the connection is reported lost.
+    A backend which recovers in place is restarted here, with backoff, and
+    reports the connection restored once it has connected again. The rest
+    are left to MainWindow to reconnect, as when their own connection
+    drops. The metrics and trace events of the backend are sent back too,
+    and added to those of the GUI. Create one with
+    BackendProcess.create(). '''
+    sig_connected = pyqtSignal()
+    sig_data_update = pyqtSignal(object)
+    sig_temp_reached = pyqtSignal(int)
+    sig_temp_stable = pyqtSignal(int)
+    sig_finished = pyqtSignal()
+    sig_log_event = pyqtSignal(str)
+    sig_log_debug = pyqtSignal(str)
+    sig_error = pyqtSignal(str)
+    sig_force_close = pyqtSignal()
+    sig_connection_lost = pyqtSignal(str)
+    sig_message = pyqtSignal(object)
+
+    restart_initial = 1.0
+    restart_maximum = 30.0
+    stop_timeout = 3000
+
+    classes = {}
+
+    @classmethod
+    def create(cls, backend_class, *args):
+        ''' Return a BackendProcess for backend_class, which is created in
+        the process with args. '''
+        if backend_class not in cls.classes:
+            signals = {name: pyqtSignal(*types) for name, types in OPTIONAL_SIGNALS.items() if hasattr(backend_class, name)}
+            cls.classes[backend_class] = type(backend_class.__name__ + 'Process', (cls,), signals)
+        return cls.classes[backend_class](backend_class, args)
+
+    def __init__(self, backend_class, args, parent=None):
+        super(BackendProcess, self).__init__(parent)
+        self.backend_class = backend_class
+        self.args = args
+        self.name = backend_class.__name__
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+        self.cfg_tools = []
+        self.fw_string = ''
+        self.homed = False
+        self.idle = False
+        self.run_thread = False
+        self.connected = False
+        self.finished = False
+        self.closing = False
+        self.restarting = False
+        self.restart_delay = self.restart_initial
+        self.restart_timer = QTimer(self)
+        self.restart_timer.setSingleShot(True)
+        self.restart_timer.timeout.connect(self.start)
+        self.estop_channel = ProcessEstopChannel(self)
+        self.sig_message.connect(self.dispatch)
+
+    def run(self):
+        ''' Start the process and connect the backend. '''
+        self.start()
+
+    def start(self):
+        if self.closing:
+            return
+        self.conn, child = self.context.Pipe()
+        self.process = self.context.Process(target=serve, args=(self.backend_class, self.args, child),
+                                            name='nxencoder-' + self.name, daemon=True)
+        self.process.start()
+        child.close()
+        self.sig_log_debug.emit('[BACKEND] Started {} in process {}'.format(self.name, self.process.pid))
+        threading.Thread(target=self.read, args=(self.conn, self.process), name='backend_' + self.name, daemon=True).start()
+        self.command('run')
+
+    def read(self, conn, process):
+        ''' Receive the messages of one process, until it exits. '''
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'telemetry':
+                metrics.merge(*message[1])
+                tracer.merge(message[2])
+                continue
+            self.sig_message.emit(message)
+        process.join(1)
+        self.sig_message.emit(('exit', process.exitcode, process))
+
+    def command(self, method, *args, request=None):
+        ''' Send a command to the process. Returns False if it has gone. Safe
+        to call from any thread. '''
+        with self.lock:
+            if self.conn is None:
+                return False
+            try:
+                self.conn.send((method, args, request))
+            except (OSError, ValueError):
+                return False
+        return True
+
+    def call(self, method, *args):
+        ''' Send a command, asking the process to reply with the state it
+        left the backend in. Nothing waits for the reply, which is taken up
+        by dispatch() when it arrives. Returns False if the process has
+        gone. '''
+        return self.command(method, *args, request=next(_call_ids))
+
+    def mirror(self, state):
+        ''' Take up the state of the backend. While restarting, the state
+        from before the process died is kept, as it is what the printer is
+        resynced to once the new process has connected. '''
+        if self.restarting:
+            return
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def dispatch(self, message):
+        ''' Handle a message from the process, in the GUI thread. '''
+        if message[0] == 'exit':
+            self.exited(*message[1:])
+            return
+        if message[0] == 'state':
+            self.mirror(message[1])
+            return
+        if message[0] == 'reply':
+            self.mirror(message[2])
+            return
+        _, name, args, state = message
+        self.mirror(state)
+        if name == 'estop_acknowledged':
+            self.estop_channel.sig_acknowledged.emit(*args)
+            return
+        if name == 'estop_failed':
+            self.estop_channel.sig_failed.emit(*args)
+            return
+        if name in ('sig_finished', 'sig_force_close'):
+            self.finished = True
+        if self.restarting:
+            self.restart_signal(name, args)
+            return
+        if name == 'sig_connected':
+            self.connected = True
+        getattr(self, name).emit(*args)
+
+    def restart_signal(self, name, args):
+        ''' While restarting, the new process connecting restores the
+        connection, and failing to connect is retried later. '''
+        if name == 'sig_connected':
+            self.restarting = False
+            self.restart_delay = self.restart_initial
+            self.sig_log_event.emit('Restarted the {} backend'.format(self.name))
+            self.sig_connection_restored.emit()
+        elif name == 'sig_error':
+            self.sig_log_debug.emit('[BACKEND] {}'.format(args[0]))
+        elif name in ('sig_log_event', 'sig_log_debug'):
+            getattr(self, name).emit(*args)
+
+    def exited(self, code, process):
+        ''' A process has exited. Anything but the backend finishing is
+        treated as a lost connection. '''
+        if process is not self.process:
+            return
+        with self.lock:
+            self.conn = None
+        if self.closing or (self.finished and not self.restarting):
+            return
+        self.finished = False
+        if self.restarting:
+            self.restart()
+            return
+        reason = 'The {} backend process exited with code {}'.format(self.name, code)
+        if not self.connected:
+            self.sig_error.emit(reason)
+            self.sig_force_close.emit()
+            return
+        metrics.inc('nxencoder_backend_process_exits_total', backend=self.name)
+        self.sig_connection_lost.emit(reason)
+        if hasattr(self, 'sig_connection_restored'):
+            self.restarting = True
+            self.restart()
+
+    def restart(self):
+        self.sig_log_debug.emit('[BACKEND] Restarting {} in {:.0f} s'.format(self.name, self.restart_delay))
+        metrics.inc('nxencoder_backend_process_restarts_total', backend=self.name)
+        self.restart_timer.start(int(self.restart_delay * 1000))
+        self.restart_delay = min(self.restart_delay * 2, self.restart_maximum)
+
+    def close(self):
+        ''' Stop the process without switching off the heaters. It is killed
+        if it does not exit in time. '''
+        self.closing = True
+        self.restart_timer.stop()
+        self.command('quit')
+        process = self.process
+        if process is not None:
+            QTimer.singleShot(self.stop_timeout, partial(self.kill, process))
+
+    def kill(self, process):
+        if process.is_alive():
+            process.kill()
+
+    def disconnect(self):
+        ''' Disconnect the backend, which switches off the heaters, and let
+        the process exit. '''
+        self.closing = True
+        self.restart_timer.stop()
+        self.command('disconnect')
+
+    def estop(self, pressed_at=None):
+        ''' Emergency stop. The backend sends it on its own estop channel.
+        perf_counter() is a system-wide clock, so the latency it reports
+        still runs from the button press. '''
+        if not self.command('estop', time.perf_counter() if pressed_at is None else pressed_at):
+            self.estop_channel.sig_failed.emit('The {} backend process is not running'.format(self.name))
+
+    def resync(self, tool, steps, targets):
+        self.command('resync', tool, steps, targets)
+
+    def move_homeaxes(self):
+        self.command('move_homeaxes')
+
+    def move_to_safe(self, tool=0):
+        self.command('move_to_safe', tool)
+
+    def send_gcode(self, gcode):
+        self.command('send_gcode', gcode)
+
+    def run_gcode(self, request, gcode):
+        ''' Safe to call from any thread, as the backends' run_gcode is. If
+        the process has gone the command fails straight away. '''
+        if not self.command('run_gcode', request, gcode):
+            self.sig_gcode_complete.emit(request, False)
+
+    def set_tool_temperature(self, temp, tool=0):
+        self.command('set_tool_temperature', temp, tool)
+
+    def set_tool_esteps(self, esteps, tool=0):
+        ''' The copy here is updated straight away, and replaced with the
+        backend's own once the process replies. '''
+        self.cfg_tools[tool]['stepsPerMm'] = esteps
+        self.call('set_tool_esteps', esteps, tool)
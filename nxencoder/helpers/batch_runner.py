@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+batch_runner.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+
+class BatchRunner(QObject):
+    ''' Runs the selected test on several tools one after another. While
+    one tool is being tested the next tools in the queue are pre-heated,
+    up to heater_limit heaters switched on at once, so each tool is usually
+    at temperature by the time its test is due to start. '''
+    sig_set_temperature = pyqtSignal(float, int)
+    sig_select_tool = pyqtSignal(int)
+    sig_start_test = pyqtSignal(int)
+    sig_log_event = pyqtSignal(str)
+    sig_finished = pyqtSignal()
+
+    def __init__(self, tools, temperatures, heater_limit=2, parent=None):
+        super(BatchRunner, self).__init__(parent)
+        self.queue = list(tools)
+        self.temperatures = temperatures
+        self.heater_limit = max(1, heater_limit)
+        self.heating = []
+        self.active = None
+        self.testing = False
+        self.results = {}
+
+    def start(self):
+        ''' Begin heating the first tools and select the first one. '''
+        self.sig_log_event.emit('Running batch on tools {} with up to {} heater(s) on at once'.format(
+            ', '.join(str(tool) for tool in self.queue), self.heater_limit))
+        self.next_tool()
+
+    def preheat(self):
+        ''' Switch on heaters for the upcoming tools until the heater limit
+        is reached. The active tool always counts towards the limit. '''
+        for tool in self.queue:
+            if len(self.heating) >= self.heater_limit:
+                return
+            if tool not in self.heating:
+                self.heating.append(tool)
+                self.sig_log_event.emit('Pre-heating tool {} to {} C'.format(tool, self.temperatures[tool]))
+                self.sig_set_temperature.emit(self.temperatures[tool], tool)
+
+    def next_tool(self):
+        ''' Select the next tool in the queue, or finish if none remain. '''
+        if not self.queue:
+            self.active = None
+            self.sig_finished.emit()
+            return
+        self.active = self.queue.pop(0)
+        self.testing = False
+        if self.active not in self.heating:
+            self.heating.insert(0, self.active)
+            self.sig_set_temperature.emit(self.temperatures[self.active], self.active)
+        self.preheat()
+        self.sig_log_event.emit('Batch: selecting tool {}, waiting for it to reach temperature'.format(self.active))
+        self.sig_select_tool.emit(self.active)
+
+    def is_heating(self, tool):
+        ''' True if the batch has switched this tool's heater on. '''
+        return tool in self.heating
+
+    def temp_reached(self, tool):
+        ''' The printer reported a tool at temperature. Start the test once
+        the active tool is ready. '''
+        if tool != self.active or self.testing:
+            return
+        self.testing = True
+        self.sig_start_test.emit(tool)
+
+    def test_finished(self, result):
+        ''' Record the result for the active tool, switch its heater off and
+        move on to the next tool. '''
+        self.results[self.active] = result
+        self.heating.remove(self.active)
+        self.sig_set_temperature.emit(0, self.active)
+        self.next_tool()
+
+    def abort(self):
+        ''' Stop the batch. Returns the tools whose heaters are still on,
+        for the caller to switch off. '''
+        heating = list(self.heating)
+        self.queue.clear()
+        self.heating.clear()
+        self.active = None
+        return heating
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+cache.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import QStandardPaths
+
+import json
+import os
+import tempfile
+import time
+
+
+class JsonCache:
+    ''' A JSON file in the nxEncoder cache directory. Reading a missing or
+    damaged file returns the default, as anything kept here can be
+    regenerated, and writes replace the file atomically so a crash never
+    leaves a partial file behind. '''
+
+    def __init__(self, name):
+        self.name = name
+
+    @staticmethod
+    def directory():
+        return os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation), 'nxencoder')
+
+    @property
+    def path(self):
+        return os.path.join(self.directory(), self.name + '.json')
+
+    def load(self, default=None):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def save(self, data):
+        os.makedirs(self.directory(), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory(), prefix=self.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp, self.path)
+        except OSError:
+            os.unlink(temp)
+            raise
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class PrinterConfigCache(JsonCache):
+    ''' The configuration discovered from each printer, keyed by backend
+    and host or port. Each entry carries a fingerprint, built by the
+    backend from a request it makes on every connect anyway, and is only
+    used while the fingerprint still matches. '''
+
+    def lookup(self, key, fingerprint):
+        ''' Return the cached tools for key, or None if there are none or
+        the fingerprint has changed. '''
+        entry = self.load({}).get(key)
+        if not isinstance(entry, dict) or entry.get('fingerprint') != fingerprint:
+            return None
+        return entry.get('tools')
+
+    def store(self, key, fingerprint, tools):
+        ''' Cache the tools discovered for key. Failing to write the cache
+        is not an error, the next connect just discovers again. '''
+        data = self.load({})
+        data[key] = {'fingerprint': fingerprint, 'tools': tools}
+        try:
+            self.save(data)
+        except OSError:
+            pass
+
+
+class CheckpointCache(JsonCache):
+    ''' The progress of the last test, saved after each iteration it
+    completes so a run cut short by a crash or a lost connection can be
+    carried on. Only one test runs at a time, so there is a single
+    checkpoint, along with the parameters of the run that saved it. '''
+
+    def lookup(self, params):
+        ''' Return the checkpoint if it was saved by a run with exactly
+        these parameters, otherwise None. '''
+        entry = self.load({})
+        if not isinstance(entry, dict) or entry.get('params') != params or 'state' not in entry:
+            return None
+        return entry
+
+    def store(self, params, state):
+        ''' Replace the checkpoint. As with the printer configuration, a
+        failed write only means there is less to resume from. '''
+        try:
+            self.save({'params': params, 'state': state, 'saved': time.time()})
+        except OSError:
+            pass
+
+
+printer_config_cache = PrinterConfigCache('printer_config')
+checkpoint_cache = CheckpointCache('checkpoint')
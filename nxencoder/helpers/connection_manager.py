@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+connection_manager.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject, QTimer
+
+from helpers.metrics import metrics
+
+import random
+import threading
+import time
+
+
+class ConnectionInterrupted(Exception):
+    ''' Raised inside a worker when the connection to the printer or the
+    encoder has dropped, or a move could not be run, part way through a
+    step of the test. The step is repeated once the connection is back. '''
+    pass
+
+
+class ConnectionLost(ConnectionInterrupted):
+    ''' Raised by the ConnectionGate, as a link is down. '''
+    pass
+
+
+class ConnectionGate(QObject):
+    ''' Shared between the GUI and the running worker, in the same way as
+    the CancellationToken. A link is interrupted when its connection drops,
+    and restored once it has reconnected and been put back in the state the
+    test left it in. The gate is open while no link is interrupted.
+    sig_interrupted and sig_restored are connected to the worker's event
+    loop, so a pending wait returns as soon as either happens. '''
+    sig_interrupted = pyqtSignal()
+    sig_restored = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(ConnectionGate, self).__init__(parent)
+        self.lock = threading.Lock()
+        self.down = set()
+        self.event = threading.Event()
+        self.event.set()
+
+    def interrupt(self, link):
+        with self.lock:
+            self.down.add(link)
+            self.event.clear()
+        self.sig_interrupted.emit()
+
+    def restore(self, link):
+        with self.lock:
+            self.down.discard(link)
+            opened = not self.down and not self.event.is_set()
+            if opened:
+                self.event.set()
+        if opened:
+            self.sig_restored.emit()
+
+    def is_open(self):
+        return self.event.is_set()
+
+    def links(self):
+        with self.lock:
+            return sorted(self.down)
+
+    def check(self):
+        ''' Raise ConnectionInterrupted if any link is interrupted. '''
+        if not self.event.is_set():
+            raise ConnectionLost('The connection to the {} was lost'.format(' and '.join(self.links())))
+
+
+class Reconnector(QObject):
+    ''' Reconnects one link after its connection has been lost. Each
+    attempt is started with sig_attempt, and its outcome reported back with
+    succeeded() or failed(). The first attempt is made after initial
+    seconds, and the delay grows by factor after each failure up to
+    maximum, with some jitter so the encoder and a printer on the same USB
+    hub are not retried in lockstep. An attempt that has not reported back
+    within attempt_timeout, such as a port that opens but never handshakes,
+    is abandoned with sig_abandon and counted as a failure. If the link is
+    still down after give_up seconds, sig_gave_up is emitted and no more
+    attempts are made. '''
+    sig_attempt = pyqtSignal(str)
+    sig_abandon = pyqtSignal(str)
+    sig_gave_up = pyqtSignal(str)
+
+    initial = 1.0
+    factor = 2.0
+    maximum = 30.0
+    attempt_timeout = 20.0
+    give_up = 600.0
+
+    def __init__(self, link, parent=None):
+        super(Reconnector, self).__init__(parent)
+        self.link = link
+        self.lost_at = None
+        self.delay = self.initial
+        self.attempting = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.attempt)
+        self.watchdog = QTimer(self)
+        self.watchdog.setSingleShot(True)
+        self.watchdog.timeout.connect(self.abandon)
+        self.deadline = QTimer(self)
+        self.deadline.setSingleShot(True)
+        self.deadline.timeout.connect(self.expire)
+
+    def start(self, attempts=True):
+        ''' The link has gone down. Without attempts the link is expected to
+        come back by itself, and is only given up on if it does not. '''
+        if self.lost_at is not None:
+            return
+        self.lost_at = time.monotonic()
+        self.delay = self.initial
+        self.deadline.start(int(self.give_up * 1000))
+        if attempts:
+            self.timer.start(int(self.delay * 1000))
+
+    def active(self):
+        return self.lost_at is not None
+
+    def retry_now(self):
+        ''' Bring the next attempt forward, as when the port of the link has
+        just reappeared. '''
+        if self.timer.isActive():
+            self.timer.start(0)
+
+    def attempt(self):
+        metrics.inc('nxencoder_reconnect_attempts_total', link=self.link)
+        self.attempting = True
+        self.watchdog.start(int(self.attempt_timeout * 1000))
+        self.sig_attempt.emit(self.link)
+
+    def abandon(self):
+        self.sig_abandon.emit(self.link)
+        self.failed()
+
+    def succeeded(self):
+        if self.lost_at is None:
+            return
+        metrics.observe('nxencoder_reconnect_seconds', time.monotonic() - self.lost_at, link=self.link)
+        self.cancel()
+
+    def failed(self):
+        if not self.attempting:
+            return
+        self.attempting = False
+        self.watchdog.stop()
+        metrics.inc('nxencoder_reconnect_failures_total', link=self.link)
+        self.delay = min(self.maximum, self.delay * self.factor)
+        self.timer.start(int(self.delay * random.uniform(0.8, 1.2) * 1000))
+
+    def expire(self):
+        self.cancel()
+        self.sig_gave_up.emit(self.link)
+
+    def cancel(self):
+        self.timer.stop()
+        self.watchdog.stop()
+        self.deadline.stop()
+        self.attempting = False
+        self.lost_at = None
+
+
+class ConnectionManager(QObject):
+    ''' Keeps a session going through dropped connections to the printer
+    and the encoder. MainWindow reports each link as it connects and as it
+    is lost. A lost link is interrupted on the gate, which holds the
+    running worker, and is reconnected by its Reconnector: sig_attempt asks
+    MainWindow to create the backend or encoder again, with the settings of
+    the session. Once it is back, and MainWindow has put it in the state
+    the test left it in, restored() opens the gate and the worker carries
+    on. The HTTP backends ride out an outage by themselves, so their link
+    is only watched for giving up. '''
+    sig_attempt = pyqtSignal(str)
+    sig_abandon = pyqtSignal(str)
+    sig_gave_up = pyqtSignal(str)
+    sig_log_event = pyqtSignal(str)
+
+    PRINTER = 'printer'
+    ENCODER = 'encoder'
+
+    def __init__(self, parent=None):
+        super(ConnectionManager, self).__init__(parent)
+        self.gate = ConnectionGate(self)
+        self.established = set()
+        self.lost_at = {}
+        self.reconnectors = {}
+        for link in (self.PRINTER, self.ENCODER):
+            reconnector = Reconnector(link, self)
+            reconnector.sig_attempt.connect(self.attempt)
+            reconnector.sig_abandon.connect(self.sig_abandon)
+            reconnector.sig_gave_up.connect(self.gave_up)
+            self.reconnectors[link] = reconnector
+
+    def connected(self, link):
+        ''' The link has connected, for the first time or again. '''
+        self.established.add(link)
+        self.reconnectors[link].succeeded()
+
+    def lost(self, link, reason, reconnect=True):
+        ''' The connection of a link has dropped. Returns False if the link
+        never connected, as there is then no session to carry on with. '''
+        if link not in self.established:
+            return False
+        if link not in self.lost_at:
+            metrics.inc('nxencoder_connection_lost_total', link=link)
+            self.sig_log_event.emit('Lost the connection to the {} ({}), reconnecting'.format(link, reason))
+            self.lost_at[link] = time.perf_counter()
+        self.gate.interrupt(link)
+        self.reconnectors[link].start(attempts=reconnect)
+        return True
+
+    def reconnecting(self, link):
+        return self.reconnectors[link].active()
+
+    def interrupted(self, link):
+        return link in self.lost_at
+
+    def attempt(self, link):
+        self.sig_log_event.emit('Reconnecting to the {}'.format(link))
+        self.sig_attempt.emit(link)
+
+    def failed(self, link):
+        ''' A reconnection attempt did not succeed. '''
+        self.reconnectors[link].failed()
+
+    def retry_now(self, link):
+        self.reconnectors[link].retry_now()
+
+    def restored(self, link):
+        ''' The link has reconnected and is back in the state the test left
+        it in. '''
+        lost_at = self.lost_at.pop(link, None)
+        if lost_at is not None:
+            outage = time.perf_counter() - lost_at
+            metrics.observe('nxencoder_connection_outage_seconds', outage, link=link)
+            self.sig_log_event.emit('The connection to the {} was restored after {:.1f} s'.format(link, outage))
+        self.gate.restore(link)
+
+    def close(self, link):
+        ''' The link has been closed on purpose. Stop any reconnection, and
+        open the gate for it, so a worker still waiting finds it gone. '''
+        self.reconnectors[link].cancel()
+        self.established.discard(link)
+        self.lost_at.pop(link, None)
+        self.gate.restore(link)
+
+    def gave_up(self, link):
+        self.sig_log_event.emit('Unable to reconnect to the {} within {:.0f} minutes'.format(link, Reconnector.give_up / 60))
+        self.sig_gave_up.emit(link)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+control_api.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from helpers.metrics import metrics
+
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import asyncio
+import json
+import secrets
+import threading
+import time
+
+
+class ControlError(Exception):
+    ''' Raised by a command the GUI can not carry out in its current state.
+    status is the HTTP status returned to the client. '''
+
+    def __init__(self, message, status=409):
+        super(ControlError, self).__init__(message)
+        self.status = status
+
+
+@dataclass
+class Command:
+    ''' A request from a client, run in the GUI thread by
+    MainWindow.control_command(), which resolves future with the
+    result. '''
+    name: str
+    params: dict
+    future: Future = field(default_factory=Future)
+
+
+class ControlServer(QObject):
+    ''' Optional local HTTP/JSON API for driving the utility from another
+    machine. The server is an asyncio loop on a daemon thread of its own.
+    Reads never reach the GUI: /status and /results are served from
+    snapshots MainWindow keeps up to date, and /events streams them, along
+    with the log and every encoder measurement, as server-sent events.
+    Commands are posted to the GUI thread with sig_command, and run there by
+    the same methods the buttons use. They need the token shown when the
+    server starts, sent as a bearer token. '''
+    sig_command = pyqtSignal(object)
+
+    # Paths which post a command, and the command each runs.
+    commands = {
+        '/printer/connect': 'printer_connect',
+        '/printer/disconnect': 'printer_disconnect',
+        '/encoder/connect': 'encoder_connect',
+        '/encoder/disconnect': 'encoder_disconnect',
+        '/heat': 'heat',
+        '/home': 'home',
+        '/test': 'test',
+        '/abort': 'abort'
+    }
+
+    command_timeout = 10.0
+    keepalive = 15.0
+    # Events a slow client may fall behind by before the oldest are
+    # dropped.
+    backlog = 256
+    max_body = 65536
+
+    def __init__(self, port=8765, host='127.0.0.1', parent=None):
+        super(ControlServer, self).__init__(parent)
+        self.host = host
+        self.port = port
+        self.token = secrets.token_urlsafe(16)
+        self.lock = threading.Lock()
+        self.status = b'{}'
+        self.results = deque(maxlen=100)
+        self.clients = set()
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+        self.thread = threading.Thread(target=self.loop.run_forever, name='control_api', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.shutdown)
+        self.thread.join(2)
+
+    def shutdown(self):
+        ''' Stop listening, and end every event stream before the loop
+        stops. '''
+        self.server.close()
+        for queue in self.clients:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        self.loop.call_later(0.1, self.loop.stop)
+
+    def set_status(self, status):
+        ''' Replace the status snapshot, streaming it to /events if it has
+        changed. Called from the GUI thread. '''
+        body = json.dumps(status).encode()
+        with self.lock:
+            if body == self.status:
+                return
+            self.status = body
+        self.publish('status', status)
+
+    def add_result(self, result):
+        with self.lock:
+            self.results.append(result)
+        self.publish('result', result)
+
+    def publish(self, event, data):
+        ''' Send an event to every client of /events. Safe to call from any
+        thread. '''
+        if self.clients:
+            message = 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data)).encode()
+            self.loop.call_soon_threadsafe(self.broadcast, message)
+
+    def broadcast(self, message):
+        for queue in self.clients:
+            if queue.full():
+                queue.get_nowait()
+                metrics.inc('nxencoder_control_events_dropped_total')
+            queue.put_nowait(message)
+
+    async def handle(self, reader, writer):
+        ''' Serve one request. Connections are not kept alive, apart from
+        /events. '''
+        try:
+            method, path, headers, body = await self.read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        path = path.split('?')[0].rstrip('/') or '/'
+        started = time.perf_counter()
+        try:
+            if method == 'GET' and path == '/events':
+                await self.stream(writer)
+                return
+            status, data = await self.route(method, path, headers, body)
+            self.respond(writer, status, json.dumps(data).encode() if not isinstance(data, bytes) else data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            metrics.observe('nxencoder_control_request_seconds', time.perf_counter() - started, path=path)
+            writer.close()
+
+    async def read_request(self, reader):
+        line = (await reader.readline()).decode('latin-1').split()
+        if len(line) != 3:
+            raise ValueError('Malformed request line')
+        headers = {}
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            raise ValueError('Request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return line[0].upper(), line[1], headers, body
+
+    async def route(self, method, path, headers, body):
+        if method == 'GET' and path == '/status':
+            with self.lock:
+                return 200, self.status
+        if method == 'GET' and path == '/results':
+            with self.lock:
+                return 200, list(self.results)
+        if path not in self.commands:
+            return 404, {'error': 'Not found'}
+        if method != 'POST':
+            return 405, {'error': 'Use POST'}
+        if not secrets.compare_digest(headers.get('authorization', ''), 'Bearer ' + self.token):
+            return 401, {'error': 'A valid bearer token is required'}
+        try:
+            params = json.loads(body) if body else {}
+        except ValueError:
+            return 400, {'error': 'The body is not valid JSON'}
+        if not isinstance(params, dict):
+            return 400, {'error': 'The body must be a JSON object'}
+        return await self.run_command(self.commands[path], params)
+
+    async def run_command(self, name, params):
+        ''' Post the command to the GUI thread and wait for its result. '''
+        command = Command(name, params)
+        metrics.inc('nxencoder_control_commands_total', command=name)
+        self.sig_command.emit(command)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(command.future), self.command_timeout)
+        except asyncio.TimeoutError:
+            return 504, {'error': 'The GUI did not run the command in time'}
+        except ControlError as e:
+            return e.status, {'error': str(e)}
+        return 200, result if result is not None else {}
+
+    async def stream(self, writer):
+        ''' Stream events to a client until it goes away. It starts with
+        the current status. '''
+        queue = asyncio.Queue(self.backlog)
+        with self.lock:
+            queue.put_nowait(b'event: status\ndata: ' + self.status + b'\n\n')
+        self.clients.add(queue)
+        metrics.set('nxencoder_control_event_clients', len(self.clients))
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n')
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    message = b': keepalive\n\n'
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(queue)
+            metrics.set('nxencoder_control_event_clients', len(self.clients))
+
+    @staticmethod
+    def respond(writer, status, body):
+        reasons = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+                   405: 'Method Not Allowed', 409: 'Conflict', 500: 'Internal Server Error', 504: 'Gateway Timeout'}
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                     .format(status, reasons.get(status, ''), len(body)).encode() + body)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+estop.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from helpers.metrics import metrics
+from helpers.trace import tracer
+
+import json
+import queue
+import requests
+import socket
+import threading
+import time
+
+
+class EstopChannel(QObject):
+    ''' Sends the emergency stop for the HTTP backends. The channel has its
+    own thread and requests session, so the stop never waits for
+    thread_printer to return from a poll or a QTimer sleep, and it never
+    shares a connection with the polling. The connection is opened when the
+    channel starts, so pressing the button costs a single round trip.
+    sig_acknowledged reports the seconds from the button press to the
+    printer's response. '''
+    sig_acknowledged = pyqtSignal(float)
+    sig_failed = pyqtSignal(str)
+
+    timeout = 1.0
+
+    def __init__(self, backend, method, url, data=None, params=None, warmup=None, parent=None):
+        super(EstopChannel, self).__init__(parent)
+        self.backend = backend
+        self.method = method
+        self.url = url
+        self.data = data
+        self.params = params
+        self.warmup = warmup
+        self.session = requests.Session()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='estop_' + backend, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        ''' Close the channel once any pending stop has been sent. '''
+        self.queue.put(None)
+
+    def trigger(self, pressed_at=None):
+        ''' Queue the emergency stop and return immediately. pressed_at is
+        the time.perf_counter() value of the button press. '''
+        self.queue.put(time.perf_counter() if pressed_at is None else pressed_at)
+
+    def run(self):
+        if self.warmup is not None:
+            try:
+                self.session.get(self.warmup, timeout=self.timeout)
+            except requests.RequestException:
+                pass
+
+        while True:
+            pressed_at = self.queue.get()
+            if pressed_at is None:
+                break
+            try:
+                with tracer.span('emergency_stop', tracer.TRACK_PRINTER):
+                    response = self.session.request(self.method, self.url, data=self.data, params=self.params, timeout=self.timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                metrics.inc('nxencoder_backend_estop_errors_total', backend=self.backend)
+                self.sig_failed.emit(str(e))
+                continue
+            latency = time.perf_counter() - pressed_at
+            metrics.observe('nxencoder_backend_estop_seconds', latency, backend=self.backend)
+            self.sig_acknowledged.emit(latency)
+        self.session.close()
+
+
+class SerialEstopChannel(QObject):
+    ''' The Marlin equivalent of EstopChannel. M112 is written straight to
+    the serial port, ahead of anything query_printer may be waiting on, and
+    Marlin's emergency parser acts on it as it arrives. Marlin halts without
+    replying, so the stop is acknowledged once the bytes have left the
+    port. '''
+    sig_acknowledged = pyqtSignal(float)
+    sig_failed = pyqtSignal(str)
+
+    timeout = 1.0
+
+    def __init__(self, backend, port, parent=None):
+        super(SerialEstopChannel, self).__init__(parent)
+        self.backend = backend
+        self.port = port
+
+    def start(self):
+        return self
+
+    def stop(self):
+        return
+
+    def trigger(self, pressed_at=None):
+        if pressed_at is None:
+            pressed_at = time.perf_counter()
+        with tracer.span('emergency_stop', tracer.TRACK_PRINTER):
+            self.port.write(b'M112\n')
+            written = self.port.waitForBytesWritten(int(self.timeout * 1000))
+        if not written:
+            metrics.inc('nxencoder_backend_estop_errors_total', backend=self.backend)
+            self.sig_failed.emit('Timed out writing M112 to {}'.format(self.port.portName()))
+            return
+        latency = time.perf_counter() - pressed_at
+        metrics.observe('nxencoder_backend_estop_seconds', latency, backend=self.backend)
+        self.sig_acknowledged.emit(latency)
+
+
+class SocketEstopChannel(QObject):
+    ''' The EstopChannel for Klipper's API socket. Klipper serves each
+    client connection separately, so the channel opens a connection of its
+    own when it starts and the stop never queues behind a gcode script the
+    backend is waiting on. '''
+    sig_acknowledged = pyqtSignal(float)
+    sig_failed = pyqtSignal(str)
+
+    timeout = 1.0
+
+    def __init__(self, backend, path, parent=None):
+        super(SocketEstopChannel, self).__init__(parent)
+        self.backend = backend
+        self.path = path
+        self.socket = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='estop_' + backend, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.queue.put(None)
+
+    def trigger(self, pressed_at=None):
+        self.queue.put(time.perf_counter() if pressed_at is None else pressed_at)
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(self.path)
+
+    def send(self):
+        ''' Send emergency_stop and wait for Klipper's reply to it. '''
+        if self.socket is None:
+            self.connect()
+        self.socket.sendall(b'{"id":1,"method":"emergency_stop","params":{}}\x03')
+        buffer = b''
+        while b'\x03' not in buffer:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionError('Klipper closed the connection')
+            buffer += data
+        for raw in buffer.split(b'\x03'):
+            if not raw:
+                continue
+            reply = json.loads(raw)
+            if reply.get('id') == 1 and 'error' in reply:
+                raise OSError(reply['error'].get('message', 'emergency_stop failed'))
+
+    def run(self):
+        try:
+            self.connect()
+        except OSError:
+            self.socket = None
+
+        while True:
+            pressed_at = self.queue.get()
+            if pressed_at is None:
+                break
+            try:
+                with tracer.span('emergency_stop', tracer.TRACK_PRINTER):
+                    self.send()
+            except (OSError, ValueError) as e:
+                metrics.inc('nxencoder_backend_estop_errors_total', backend=self.backend)
+                self.sig_failed.emit(str(e))
+                if self.socket is not None:
+                    self.socket.close()
+                    self.socket = None
+                continue
+            latency = time.perf_counter() - pressed_at
+            metrics.observe('nxencoder_backend_estop_seconds', latency, backend=self.backend)
+            self.sig_acknowledged.emit(latency)
+        if self.socket is not None:
+            self.socket.close()
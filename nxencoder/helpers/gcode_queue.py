@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+gcode_queue.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from helpers.metrics import metrics
+from helpers.trace import tracer
+
+from concurrent.futures import Future
+
+import queue
+import threading
+import time
+
+
+class GcodeQueue(QObject):
+    ''' Sends gcode for a backend from a thread of its own, one command at
+    a time and in the order submitted. Moonraker does not reply to a script
+    until it has run, so a long move no longer holds up thread_printer and
+    its status polling. Each submission returns a Future, resolved with the
+    seconds the printer took once the reply arrives. Commands submitted
+    with a request ID also report completion with sig_gcode_complete,
+    which carries the ID and whether the command succeeded. '''
+    sig_gcode_complete = pyqtSignal(int, bool)
+    sig_log_event = pyqtSignal(str)
+
+    def __init__(self, backend, send, parent=None):
+        super(GcodeQueue, self).__init__(parent)
+        self.backend = backend
+        self.send = send
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='gcode_' + backend, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop once everything already submitted has been sent. '''
+        self.queue.put(None)
+
+    def submit(self, gcode, request=0):
+        ''' Queue gcode to be sent, returning its Future. Safe to call from
+        any thread. '''
+        future = Future()
+        self.queue.put((gcode, request, future, time.perf_counter()))
+        metrics.set('nxencoder_gcode_queue_depth', self.queue.qsize(), backend=self.backend)
+        return future
+
+    def busy(self):
+        ''' True while anything submitted has yet to finish. '''
+        return self.queue.unfinished_tasks > 0
+
+    def cancel_pending(self):
+        ''' Drop everything not yet sent, as after an emergency stop. The
+        command already with the printer is not affected. '''
+        stopping = False
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            if item is None:
+                stopping = True
+                continue
+            _, request, future, _ = item
+            future.cancel()
+            if request:
+                self.sig_gcode_complete.emit(request, False)
+        if stopping:
+            self.queue.put(None)
+        metrics.set('nxencoder_gcode_queue_depth', 0, backend=self.backend)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.process(*item)
+            finally:
+                self.queue.task_done()
+
+    def process(self, gcode, request, future, queued):
+        metrics.set('nxencoder_gcode_queue_depth', self.queue.qsize(), backend=self.backend)
+        if not future.set_running_or_notify_cancel():
+            return
+        started = time.perf_counter()
+        metrics.observe('nxencoder_gcode_queue_wait_seconds', started - queued, backend=self.backend)
+        try:
+            with tracer.span(gcode, tracer.TRACK_PRINTER):
+                self.send(gcode)
+        except Exception as e:
+            metrics.inc('nxencoder_backend_gcode_errors_total', backend=self.backend)
+            self.sig_log_event.emit('Failed to send {} to the printer: {}'.format(gcode.replace('\n', '; '), e))
+            future.set_exception(e)
+            if request:
+                self.sig_gcode_complete.emit(request, False)
+            return
+        elapsed = time.perf_counter() - started
+        metrics.observe('nxencoder_gcode_seconds', elapsed, backend=self.backend)
+        future.set_result(elapsed)
+        if request:
+            self.sig_gcode_complete.emit(request, True)
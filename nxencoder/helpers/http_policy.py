@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+http_policy.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from helpers.metrics import metrics
+
+from dataclasses import dataclass
+from typing import Tuple
+
+import random
+import requests
+import threading
+import time
+
+
+class CircuitOpen(requests.ConnectionError):
+    ''' Raised instead of making a request while the circuit is open. It
+    is a requests exception, so callers handle it as they would the
+    printer being unreachable. '''
+    pass
+
+
+@dataclass(frozen=True)
+class Operation:
+    ''' How one kind of request is made. timeout is the (connect, read)
+    timeout passed to requests. Only idempotent requests are given
+    retries, anything else is retried only if it timed out connecting, as
+    it was then never sent. '''
+    timeout: Tuple[float, float]
+    retries: int = 0
+
+
+class HttpPolicy(QObject):
+    ''' The HTTP client used by the printer backends. Every request is made
+    with a timeout, reads are retried with jittered exponential backoff,
+    and a circuit breaker stops a printer which has gone away from costing
+    a full timeout on every call. After failure_threshold consecutive
+    failures the circuit opens and requests fail straight away, until
+    reset_timeout has passed and a single request is let through to test
+    the printer again. sig_degraded and sig_recovered report the circuit
+    opening and closing.
+
+    A policy is only used from one thread, as requests.Session is not
+    thread-safe. Backends make their requests on the thread they poll from,
+    and queue calls from the GUI to it with queue_call, so the GUI never
+    waits on the printer either. A backend that also sends from another
+    thread, such as a gcode queue, gives that thread a policy of its own,
+    which also keeps slow moves from opening the circuit its polling relies
+    on. '''
+    sig_degraded = pyqtSignal(str)
+    sig_recovered = pyqtSignal()
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+    operations = {
+        'discover': Operation((2.0, 5.0), retries=3),
+        'poll': Operation((1.0, 2.0), retries=1),
+        'query': Operation((1.0, 3.0), retries=2),
+        # Moonraker only replies to a script once it has run, so the read
+        # timeout has to cover the longest move a test makes.
+        'gcode': Operation((2.0, 300.0)),
+    }
+
+    backoff_base = 0.2
+    backoff_max = 2.0
+    failure_threshold = 5
+    reset_timeout = 5.0
+
+    def __init__(self, backend, parent=None):
+        super(HttpPolicy, self).__init__(parent)
+        self.backend = backend
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        metrics.set('nxencoder_http_circuit_state', 0, backend=backend)
+
+    def get(self, operation, url, **kwargs):
+        return self.request(operation, 'GET', url, **kwargs)
+
+    def post(self, operation, url, **kwargs):
+        return self.request(operation, 'POST', url, **kwargs)
+
+    def request(self, operation, method, url, **kwargs):
+        ''' Make a request as the named operation allows. Returns the
+        response, or raises a requests exception once the retries are used
+        up. A 4xx response is returned to the caller, as the printer is
+        working and retrying would not help. '''
+        op = self.operations[operation]
+        attempt = 0
+        while True:
+            self.before_request()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=op.timeout, **kwargs)
+                if response.status_code >= 500:
+                    response.raise_for_status()
+            except requests.RequestException as e:
+                kind = type(e).__name__
+                metrics.inc('nxencoder_http_errors_total', backend=self.backend, operation=operation, kind=kind)
+                self.record_failure(kind)
+                retryable = op.retries > attempt or (attempt == 0 and isinstance(e, requests.ConnectTimeout))
+                if not retryable or self.state == self.OPEN:
+                    raise
+                attempt += 1
+                metrics.inc('nxencoder_http_retries_total', backend=self.backend, operation=operation)
+                time.sleep(min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5))
+                continue
+            metrics.observe('nxencoder_http_request_seconds', time.perf_counter() - started, backend=self.backend, operation=operation)
+            self.record_success()
+            return response
+
+    def before_request(self):
+        ''' Fail fast while the circuit is open. Once reset_timeout has
+        passed, one request is allowed through to test the printer. '''
+        with self.lock:
+            if self.state != self.OPEN:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen('{} is not responding, retrying in {:.0f}s'.format(
+                    self.backend, self.reset_timeout - (time.monotonic() - self.opened_at)))
+            self.set_state(self.HALF_OPEN)
+
+    def record_failure(self, kind):
+        opened = False
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                opened = self.state == self.CLOSED
+                self.opened_at = time.monotonic()
+                self.set_state(self.OPEN)
+        if opened:
+            self.sig_degraded.emit('The printer is not responding ({} failures, last: {})'.format(self.failures, kind))
+
+    def record_success(self):
+        with self.lock:
+            recovered = self.state != self.CLOSED
+            self.failures = 0
+            self.set_state(self.CLOSED)
+        if recovered:
+            self.sig_recovered.emit()
+
+    def set_state(self, state):
+        if state != self.state:
+            metrics.inc('nxencoder_http_circuit_transitions_total', backend=self.backend, state=state)
+        self.state = state
+        metrics.set('nxencoder_http_circuit_state', self.STATE_VALUES[state], backend=self.backend)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+metrics.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from helpers.trace import tracer
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import threading
+import time
+
+
+class Histogram:
+    ''' A cumulative latency histogram in the Prometheus style. '''
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    ''' Registry of counters, gauges and histograms. Every method may be
+    called from any thread, as the printer, encoder and worker objects all
+    live on different QThreads. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        ''' Increment a counter. '''
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        ''' Set a gauge to the given value. '''
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        ''' Add a value, in seconds, to a histogram. '''
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def span(self, name, **labels):
+        ''' Time the enclosed block and record it in the histogram
+        <name>_seconds. Exceptions are counted in <name>_errors_total and
+        then re-raised so the caller handles them as it did before. If a
+        trace is being recorded, the span is also added to the timeline. '''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(name + '_errors_total', **labels)
+            raise
+        finally:
+            end = time.perf_counter()
+            self.observe(name + '_seconds', end - start, **labels)
+            tracer.complete(labels.get('call', labels.get('phase', name)), start, end, cat=name, **labels)
+
+    def drain(self):
+        ''' Take everything recorded since the last drain, leaving the
+        registry empty. A backend process sends this to the GUI, which adds
+        it to its own with merge(). '''
+        with self.lock:
+            drained = (self.counters, self.gauges, self.histograms)
+            self.counters, self.gauges, self.histograms = {}, {}, {}
+        return drained
+
+    def merge(self, counters, gauges, histograms):
+        ''' Add metrics taken with drain() in another process. '''
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, hist in histograms.items():
+                total = self.histograms.setdefault(key, Histogram())
+                total.count += hist.count
+                total.sum += hist.sum
+                total.counts = [a + b for a, b in zip(total.counts, hist.counts)]
+
+    def reset(self):
+        ''' Discard everything recorded so far. '''
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in tuple(labels) + tuple(extra)]
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        ''' Return every metric in the Prometheus text exposition format. '''
+        lines = []
+        with self.lock:
+            for kind, table in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(table.items()):
+                    if name not in typed:
+                        lines.append('# TYPE {} {}'.format(name, kind))
+                        typed.add(name)
+                    lines.append('{}{} {}'.format(name, self.format_labels(labels), value))
+
+            typed = set()
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append('{}_bucket{} {}'.format(name, self.format_labels(labels, (('le', bound),)), count))
+                lines.append('{}_bucket{} {}'.format(name, self.format_labels(labels, (('le', '+Inf'),)), hist.count))
+                lines.append('{}_sum{} {:.6f}'.format(name, self.format_labels(labels), hist.sum))
+                lines.append('{}_count{} {}'.format(name, self.format_labels(labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        ''' Write the current metrics to a file, suitable for the node
+        exporter textfile collector. '''
+        with open(filename, 'w') as f:
+            f.write(self.render())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class MetricsServer:
+    ''' Optional local HTTP endpoint serving /metrics. The server runs on
+    its own daemon thread so scraping never touches the GUI. '''
+
+    def __init__(self, port=9464, host='127.0.0.1'):
+        self.httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+metrics = Metrics()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+poll_scheduler.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from helpers.metrics import metrics
+
+from collections import deque
+
+import time
+
+
+class PollScheduler(object):
+    ''' Decides how long a backend waits between status polls. While the
+    backend reports that it is busy, heating or moving, or for hold seconds
+    after request_fast(), polls are made every fast seconds, so the GUI and
+    the workers see changes as they happen. Once idle, the interval grows by
+    backoff after each poll up to slow seconds, to keep the load off a
+    controller with nothing to report. Each backend picks its own
+    intervals. The interval and the poll rate measured over the last
+    window seconds are published as metrics. '''
+    window = 10.0
+
+    def __init__(self, backend, fast=0.25, slow=2.0, backoff=1.5, hold=5.0):
+        self.backend = backend
+        self.fast = fast
+        self.slow = slow
+        self.backoff = backoff
+        self.hold = hold
+        self.interval = fast
+        self.fast_until = 0.0
+        self.polls = deque()
+
+    def request_fast(self, seconds=None):
+        ''' Poll fast for the next seconds, hold by default, as after
+        sending gcode. Safe to call from any thread. '''
+        self.fast_until = max(self.fast_until, time.monotonic() + (self.hold if seconds is None else seconds))
+
+    def next_interval(self, busy=False):
+        ''' Record a poll and return the seconds to wait before the next
+        one. '''
+        now = time.monotonic()
+        self.polls.append(now)
+        while self.polls[0] < now - self.window:
+            self.polls.popleft()
+
+        if busy or now < self.fast_until:
+            self.interval = self.fast
+        else:
+            self.interval = min(self.interval * self.backoff, self.slow)
+        metrics.set('nxencoder_backend_poll_interval_seconds', self.interval, backend=self.backend)
+        metrics.set('nxencoder_backend_poll_rate_hz', self.rate(), backend=self.backend)
+        return self.interval
+
+    def rate(self):
+        ''' Polls per second over the last window. '''
+        if len(self.polls) < 2 or self.polls[-1] == self.polls[0]:
+            return 0.0
+        return (len(self.polls) - 1) / (self.polls[-1] - self.polls[0])
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+printer_discovery.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from helpers.cache import JsonCache
+from helpers.metrics import metrics
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+
+import ipaddress
+import re
+import requests
+import socket
+import threading
+import time
+
+FIRMWARE_RRF3 = 'rrf3'
+FIRMWARE_RRF3_SBC = 'rrf3_sbc'
+FIRMWARE_KLIPPER = 'klipper'
+
+printer_cache = JsonCache('printers')
+
+
+@dataclass(frozen=True)
+class PrinterDescriptor:
+    ''' A printer found on the network. host is in the host[:port] form
+    used by the printer backends, and firmware is one of the FIRMWARE_
+    constants. '''
+    host: str
+    firmware: str
+    name: str
+    version: str
+    latency: float
+
+
+def parse_hosts(text, limit=1024):
+    ''' Expand a list of hosts and subnets, separated by commas or spaces,
+    into a list of hosts. Raises ValueError for an invalid subnet, or one
+    larger than limit addresses. '''
+    hosts = []
+    for part in re.split(r'[\s,]+', text.strip()):
+        if not part:
+            continue
+        if '/' in part:
+            network = ipaddress.ip_network(part, strict=False)
+            if network.num_addresses > limit:
+                raise ValueError('{} has more than {} addresses'.format(part, limit))
+            hosts.extend(str(address) for address in network.hosts())
+            continue
+        hosts.append(part)
+    return hosts
+
+
+def local_subnet():
+    ''' Guess the /24 subnet of this machine's LAN address. Connecting a UDP
+    socket sends nothing, it only picks the interface a packet would leave
+    from. '''
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('10.255.255.255', 1))
+            address = s.getsockname()[0]
+    except OSError:
+        return '192.168.1.0/24'
+    return str(ipaddress.ip_network(address + '/24', strict=False))
+
+
+def load_known_printers():
+    ''' Return the printers found by previous discoveries, by host. '''
+    known = {}
+    for host, data in printer_cache.load({}).items():
+        try:
+            known[host] = PrinterDescriptor(**data)
+        except TypeError:
+            continue
+    return known
+
+
+def save_known_printers(printers):
+    printer_cache.save({host: asdict(printer) for host, printer in printers.items()})
+
+
+class PrinterDiscovery(QObject):
+    ''' Searches a list of hosts for RepRapFirmware and Moonraker printers.
+    Each host and port is checked by its own task on a thread pool, first
+    with a TCP connect so that addresses with nothing listening cost no
+    more than connect_timeout, then by the endpoint each firmware answers:
+    /printer/info for Moonraker, /machine/status for the DSF on an SBC,
+    and /rr_config for standalone RepRapFirmware. The search runs on a
+    background thread, and the results are reported with signals. '''
+    sig_found = pyqtSignal(object)
+    sig_progress = pyqtSignal(int, int)
+    sig_finished = pyqtSignal(list)
+
+    ports = (80, 7125)
+    connect_timeout = 0.3
+    timeout = 1.5
+    workers = 64
+
+    def __init__(self, hosts, parent=None):
+        super(PrinterDiscovery, self).__init__(parent)
+        self.hosts = list(hosts)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='discovery', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def targets(self):
+        ''' Every host:port to check. A host given with a port is only
+        checked on that port. '''
+        targets = []
+        for host in self.hosts:
+            if ':' in host:
+                targets.append(host)
+                continue
+            targets.extend(host if port == 80 else '{}:{}'.format(host, port) for port in self.ports)
+        return targets
+
+    def run(self):
+        started = time.perf_counter()
+        targets = self.targets()
+        found = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='discovery') as pool:
+            futures = [pool.submit(self.probe, target) for target in targets]
+            for done, future in enumerate(as_completed(futures), 1):
+                printer = future.result()
+                if printer is not None:
+                    found[printer.host] = printer
+                    self.sig_found.emit(printer)
+                self.sig_progress.emit(done, len(targets))
+
+        # Moonraker is often reachable both directly and through a web
+        # server on port 80, keep only the port 80 entry.
+        printers = [printer for printer in found.values()
+                    if ':' not in printer.host or printer.host.rpartition(':')[0] not in found]
+        metrics.observe('nxencoder_discovery_seconds', time.perf_counter() - started)
+        metrics.inc('nxencoder_discovery_printers_total', len(printers))
+        self.sig_finished.emit(sorted(printers, key=lambda printer: printer.host))
+
+    def probe(self, target):
+        if self.cancelled.is_set():
+            return None
+        host, _, port = target.partition(':')
+        try:
+            socket.create_connection((host, int(port or 80)), self.connect_timeout).close()
+        except (OSError, ValueError):
+            return None
+        with requests.Session() as session:
+            return self.identify(session, target)
+
+    def identify(self, session, target):
+        ''' Ask the host each firmware's identifying endpoint in turn,
+        returning a PrinterDescriptor for the first which answers. '''
+        address = 'http://' + target
+        checks = (
+            ('/printer/info', self.identify_klipper),
+            ('/machine/status', self.identify_rrf3_sbc),
+            ('/rr_config', self.identify_rrf3),
+        )
+        for endpoint, check in checks:
+            if self.cancelled.is_set():
+                return None
+            started = time.perf_counter()
+            try:
+                r = session.get(address + endpoint, timeout=self.timeout)
+                if not r.ok:
+                    continue
+                printer = check(target, r.json(), time.perf_counter() - started)
+            except (requests.RequestException, ValueError, AttributeError, KeyError, IndexError, TypeError):
+                continue
+            if printer is not None:
+                return printer
+        return None
+
+    @staticmethod
+    def identify_klipper(target, data, latency):
+        info = data['result']
+        return PrinterDescriptor(target, FIRMWARE_KLIPPER, info.get('hostname', target), info['software_version'], latency)
+
+    @staticmethod
+    def identify_rrf3_sbc(target, data, latency):
+        version = data['boards'][0]['firmwareVersion']
+        return PrinterDescriptor(target, FIRMWARE_RRF3_SBC, data['network'].get('name') or target, version, latency)
+
+    @staticmethod
+    def identify_rrf3(target, data, latency):
+        return PrinterDescriptor(target, FIRMWARE_RRF3, data.get('firmwareElectronics', target), data['firmwareVersion'], latency)
@@ -20,22 +20,98 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject, QTimer
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QEventLoop, QObject, QThread, QTimer
+
+from helpers.estop import EstopChannel
+from helpers.gcode_queue import GcodeQueue
+from helpers.http_policy import HttpPolicy
+from helpers.metrics import metrics
+from helpers.poll_scheduler import PollScheduler
+from helpers.printer_status import PrinterStatus
+from helpers.temperature_monitor import TemperatureMonitor
+from helpers.trace import tracer
+
+from functools import partial
 
 import json
 import requests
 import socket
 
+# The extruder objects queried at discovery. Klipper names them extruder,
+# extruder1, extruder2 and so on, and leaves any that do not exist out of
+# its reply.
+EXTRUDER_OBJECTS = ['extruder'] + ['extruder{}'.format(i) for i in range(1, 10)]
+
+
+def discovery_objects():
+    ''' The objects query made at discovery: the parsed configuration,
+    and the step distance each extruder is using. '''
+    objects = {'configfile': ['settings']}
+    for name in EXTRUDER_OBJECTS:
+        objects[name] = ['rotation_distance', 'step_distance']
+    return objects
+
+
+def status_objects(tools):
+    ''' The objects and attributes making up a status update, for the
+    configured tools. '''
+    objects = {'toolhead': ['homed_axes'], 'print_stats': ['state']}
+    for data in tools:
+        objects[data['name']] = ['temperature', 'target']
+    return objects
+
+
+def extruder_config(status):
+    ''' Build the configuration of each tool from the reply to the
+    discovery_objects() query. The rotation distance is taken from the
+    extruder's status where Klipper reports the value in use, either
+    directly or as a step distance, and otherwise from the configuration.
+    Returns the tools, and the names of any whose value in use differs
+    from the configuration. '''
+    settings = status['configfile']['settings']
+    tools = []
+    changed = []
+    for name in EXTRUDER_OBJECTS:
+        if name not in settings:
+            break
+        config = settings[name]
+        steps = int(config['full_steps_per_rotation']) * int(config['microsteps'])
+        configured = float(config['rotation_distance'])
+        extruder = status.get(name) or {}
+        if extruder.get('rotation_distance'):
+            rotation_distance = float(extruder['rotation_distance'])
+        elif extruder.get('step_distance'):
+            rotation_distance = float(extruder['step_distance']) * steps
+        else:
+            rotation_distance = configured
+        if round(rotation_distance, 2) != round(configured, 2):
+            changed.append(name)
+        tools.append({
+            'name': name,
+            'rotation_distance': rotation_distance,
+            'full_steps_per_rotation': int(config['full_steps_per_rotation']),
+            'microsteps': int(config['microsteps']),
+            'stepsPerMm': round(steps / rotation_distance, 6),
+            'cur_temp': 0,
+            'max_temp': int(config['max_temp'])
+        })
+    return tools, changed
+
 
 class Klipper(QObject):
     sig_connected = pyqtSignal()
-    sig_data_update = pyqtSignal()
+    sig_data_update = pyqtSignal(object)
     sig_temp_reached = pyqtSignal(int)
+    sig_temp_stable = pyqtSignal(int)
+    sig_gcode_complete = pyqtSignal(int, bool)
     sig_finished = pyqtSignal()
     sig_log_event = pyqtSignal(str)
     sig_log_debug = pyqtSignal(str)
     sig_error = pyqtSignal(str)
     sig_force_close = pyqtSignal()
+    sig_connection_lost = pyqtSignal(str)
+    sig_connection_restored = pyqtSignal()
+    sig_call = pyqtSignal(object)
 
     def __init__(self, host, parent=None):
         super(Klipper, self).__init__(parent)
@@ -43,9 +119,26 @@ class Klipper(QObject):
         self.idle = False
         self.homed = False
         self.cfg_tools = []
+        self.status = None
         self.cfg_board = []
         self.run_thread = False
         self.isKlipper = True
+        self.estop_channel = None
+        self.gcode_queue = None
+        self.temp_monitor = TemperatureMonitor(self)
+        self.temp_monitor.sig_temp_stable.connect(self.sig_temp_stable)
+        self.scheduler = PollScheduler('klipper', fast=0.25, slow=2.0)
+        self.http = HttpPolicy('klipper', self)
+        self.http.sig_degraded.connect(self.sig_log_event)
+        self.http.sig_recovered.connect(self.http_recovered)
+        self.http.sig_degraded.connect(self.sig_connection_lost)
+        self.http.sig_recovered.connect(self.sig_connection_restored)
+        # Used by the gcode queue's thread once it has started. A printer
+        # that has gone away is reported by polling, so this only logs.
+        self.gcode_http = HttpPolicy('klipper_gcode', self)
+        self.gcode_http.sig_degraded.connect(self.sig_log_event)
+        self.gcode_http.sig_recovered.connect(self.http_recovered)
+        self.sig_call.connect(self.run_call)
 
     def run(self):
         ''' Main thread used for connection, thruough to retrieving
@@ -57,44 +150,19 @@ class Klipper(QObject):
         self.loop = QEventLoop()
 
         try:
-            self.address = 'http://' + socket.gethostbyname(self.host)
-
-            cfg_json = json.loads(requests.get(self.address + '/printer/info').text)['result']
-            self.cfg_board.append({
-                'firmware': cfg_json['software_version']
-            })
-
-            self.cfg_tools.clear()
-            cfg_json = self.get_objectmodel('configfile')['settings']
-
-            for i in range((sum(1 for x in cfg_json if x.startswith('extruder')))):
-                if i == 0:
-                    tool = 'extruder'
-                if i != 0:
-                    tool = 'extruder{}'.format(i)
-
-                self.cfg_tools.append({
-                    'name': tool,
-                    'rotation_distance': float(cfg_json[tool]['rotation_distance']),
-                    'full_steps_per_rotation': int(cfg_json[tool]['full_steps_per_rotation']),
-                    'microsteps': int(cfg_json[tool]['microsteps']),
-                    'stepsPerMm': round((int(cfg_json[tool]['full_steps_per_rotation']) * int(cfg_json[tool]['microsteps'])) / float(cfg_json[tool]['rotation_distance']), 6),
-                    'cur_temp': 0,
-                    'max_temp': int(cfg_json[tool]['max_temp'])
-                })
-
-                fw_rotation_distance = (self.cfg_tools[i]['full_steps_per_rotation'] * self.cfg_tools[i]['microsteps']) * self.get_tool_stepdistance(tool)
-                if (round(fw_rotation_distance, 2) != round(self.cfg_tools[i]['rotation_distance'], 2)):
-                    self.sig_log_debug.emit('[KLIPPER] The rotation_distance value returned from Klipper ({}) does not match the value returned from Moonraker ({}).'
-                                            'Using the value from Klipper.'.format(round(fw_rotation_distance, 2), round(self.cfg_tools[i]['rotation_distance'], 2)))
-                    self.cfg_tools[i]['rotation_distance'] = fw_rotation_distance
-                    self.cfg_tools[i]['stepsPerMm'] = round((int(cfg_json[tool]['full_steps_per_rotation']) * int(cfg_json[tool]['microsteps'])) / fw_rotation_distance, 6)
+            self.discover()
         except Exception as e:
             self.sig_error.emit('Connection to {} failed.'.format(self.host))
             self.sig_log_debug.emit('[KLIPPER] Error: Connection to {} failed. Exception returned: {}'.format(self.host, e))
             self.sig_force_close.emit()
             return
 
+        self.estop_channel = EstopChannel('klipper', 'POST', self.address + '/printer/emergency_stop',
+                                          warmup=self.address + '/printer/info').start()
+        self.gcode_queue = GcodeQueue('klipper', self.post_gcode)
+        self.gcode_queue.sig_gcode_complete.connect(self.sig_gcode_complete)
+        self.gcode_queue.sig_log_event.connect(self.sig_log_event)
+        self.gcode_queue.start()
         self.sig_log_event.emit('Connected to Klipper at {}'.format(self.host))
         self.sig_log_debug.emit('[KLIPPER] Printer Firmware: {}'.format(self.cfg_board[0]['firmware']))
         self.sig_log_debug.emit('[KLIPPER] Found {} tool(s)'.format(len(self.cfg_tools)))
@@ -102,38 +170,133 @@ class Klipper(QObject):
         self.sig_log_event.emit('Switching to relative extrusion mode.')
         self.send_gcode('M83')
 
+        self.status = PrinterStatus.build(self, [0] * len(self.cfg_tools))
+        self.sig_data_update.emit(self.status)
         self.sig_connected.emit()
         self.run_thread = True
 
-        ''' The main status update pulls from /rr_status as this returns
-        faster, and causes less load on RRF, than querying the object
-        model. '''
+        ''' Each status update is a single objects query, filtered to the
+        attributes poll() uses. '''
         while self.run_thread:
+            try:
+                self.poll()
+            except (requests.RequestException, ValueError) as e:
+                self.sig_log_debug.emit('[KLIPPER] Error: Status update failed: {}'.format(e))
+            interval = int(self.scheduler.next_interval(self.busy()) * 1000)
+            with tracer.span('QTimer wait', ms=interval):
+                QTimer.singleShot(interval, self.loop.quit)
+                self.loop.exec_()
+
+        self.sig_finished.emit()
 
-            self.homed = True if len(self.get_objectmodel('toolhead')['homed_axes']) >= 3 else False
-            self.idle = True if self.get_objectmodel('print_stats')['state'] == 'standby' else False
+    def discover(self):
+        ''' Resolve the host, then retrieve the firmware details and the
+        configuration of each tool. A port may be given as host:port.
+        Exceptions are left to the caller. '''
+        with metrics.span('nxencoder_backend_phase', backend='klipper', phase='connect'):
+            host, _, port = self.host.partition(':')
+            self.address = 'http://' + socket.gethostbyname(host) + (':' + port if port else '')
 
+            cfg_json = json.loads(self.http.get('discover', self.address + '/printer/info').text)['result']
+            self.cfg_board.append({
+                'firmware': cfg_json['software_version']
+            })
+
+        with metrics.span('nxencoder_backend_phase', backend='klipper', phase='discovery'):
+            tools, changed = extruder_config(self.query_objects(discovery_objects(), 'discover'))
+            self.cfg_tools[:] = tools
+            for name in changed:
+                self.sig_log_debug.emit('[KLIPPER] {} is using a rotation_distance which differs from its configuration'.format(name))
+
+    def poll(self):
+        ''' Retrieve the status of the printer once, updating the homed and
+        idle state and the temperature of each tool. toolhead, print_stats
+        and every extruder are read in one request. '''
+        with metrics.span('nxencoder_backend_call', backend='klipper', call='poll'):
+            status = self.query_objects(status_objects(self.cfg_tools), 'poll')
+            self.homed = True if len(status['toolhead']['homed_axes']) >= 3 else False
+            self.idle = True if status['print_stats']['state'] == 'standby' else False
+
+            targets = []
             for tool, data in enumerate(self.cfg_tools):
-                extruder = self.get_objectmodel(self.cfg_tools[tool]['name'])
-                self.cfg_tools[tool]['cur_temp'] = round(extruder['temperature'], 2)
-                if extruder['target'] != 0 and extruder['temperature'] >= extruder['target']:
+                extruder = status[data['name']]
+                current, target = extruder['temperature'], extruder['target']
+                data['cur_temp'] = round(current, 2)
+                targets.append(target)
+                self.temp_monitor.update(tool, current, target)
+                if target != 0 and current >= target:
                     self.sig_temp_reached.emit(tool)
-            self.sig_data_update.emit()
-            QTimer.singleShot(1000, self.loop.quit)
-            self.loop.exec_()
+            self.status = PrinterStatus.build(self, targets)
+        metrics.inc('nxencoder_backend_polls_total', backend='klipper')
+        self.sig_data_update.emit(self.status)
+
+    def http_recovered(self):
+        self.sig_log_event.emit('The printer at {} is responding again'.format(self.host))
+
+    def queue_call(self, method, *args):
+        ''' Requests go through self.http, which belongs to the thread this
+        backend runs on. A call made from any other thread, such as the
+        GUI's, is queued to run there instead. Returns True if it was
+        queued, in which case the caller returns. '''
+        if QThread.currentThread() is self.thread():
+            return False
+        self.sig_call.emit(partial(method, *args))
+        return True
 
-        self.sig_finished.emit()
+    @pyqtSlot(object)
+    def run_call(self, call):
+        ''' Run a call queued by queue_call. Nothing is waiting on it, so
+        a failure is logged. '''
+        try:
+            call()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.sig_log_event.emit('{} failed: {}'.format(call.func.__name__, e))
+
+    def busy(self):
+        ''' Poll fast while a heater is settling or gcode is still
+        running. print_stats only covers printing a file, so moves are
+        tracked through the gcode queue. '''
+        return self.temp_monitor.settling() or (self.gcode_queue is not None and self.gcode_queue.busy())
 
     def disconnect(self):
         ''' Clean up prior to clearing the class '''
         self.run_thread = False
+        if self.estop_channel is not None:
+            self.estop_channel.stop()
         for tool, _ in enumerate(self.cfg_tools):
             self.set_tool_temperature(0, tool)
+        if self.gcode_queue is not None:
+            self.gcode_queue.stop()
         return
 
-    def estop(self):
-        ''' Emergency stop. '''
-        requests.post(self.address + '/printer/emergency_stop')
+    def resync(self, tool, steps, targets):
+        ''' Put the printer back in the state a running test relies on once
+        the connection is restored. Klipper may have restarted in the
+        meantime, so relative extrusion, the step distances and the heater
+        targets are all set again. A tool is only selected on a printer
+        with several, as Klipper has no T commands of its own. Tools still
+        stable at their target are reported stable again. '''
+        self.sig_log_event.emit('Restoring the printer state after reconnecting')
+        self.send_gcode('M83')
+        if len(self.cfg_tools) > 1:
+            self.send_gcode('T{}'.format(tool))
+        for i, esteps in enumerate(steps[:len(self.cfg_tools)]):
+            self.set_tool_esteps(esteps, i)
+        for i, target in enumerate(targets[:len(self.cfg_tools)]):
+            if target:
+                self.set_tool_temperature(target, i)
+        for i, _ in enumerate(self.cfg_tools):
+            if self.temp_monitor.is_stable(i):
+                self.sig_temp_stable.emit(i)
+
+    def estop(self, pressed_at=None):
+        ''' Emergency stop, sent on the estop channel rather than from this
+        thread. '''
+        metrics.inc('nxencoder_backend_estops_total', backend='klipper')
+        if self.estop_channel is not None:
+            self.estop_channel.trigger(pressed_at)
+        if self.gcode_queue is not None:
+            self.gcode_queue.cancel_pending()
         self.run_thread = False
 
     def move_homeaxes(self):
@@ -142,6 +305,8 @@ class Klipper(QObject):
 
     def move_to_safe(self, tool=0):
         ''' Move the selected tool to the center of the bed. '''
+        if self.queue_call(self.move_to_safe, tool):
+            return
         self.send_gcode('T{}'.format(tool))
         cfg_json = self.get_objectmodel('toolhead')
         x_mid = (cfg_json['axis_minimum'][0] + cfg_json['axis_maximum'][0]) / 2
@@ -150,26 +315,54 @@ class Klipper(QObject):
         self.send_gcode('G1 Z50 F1200')
 
     def send_gcode(self, gcode):
-        ''' Transmit gcode to the printer via the HTTP interface. '''
-        requests.get(self.address + '/printer/gcode/script?', {'script': gcode})
-
-    def get_tool_stepdistance(self, tool):
-        ''' Query Klipper directly for the current tool step distance. '''
-        requests.get(self.address + '/printer/gcode/script?', {'script': 'SET_EXTRUDER_STEP_DISTANCE EXTRUDER={}'.format(tool)})
-        r = requests.get(self.address + '/server/gcode_store?count=1')
-        __, *__, step_distance = json.loads(r.text)['result']['gcode_store'][0]['message'].split()
+        ''' Transmit gcode to the printer via the HTTP interface. Once
+        connected the gcode goes through the gcode queue, and this returns
+        straight away. A failure is logged rather than raised, as this is
+        called from signals. '''
+        metrics.inc('nxencoder_backend_gcode_total', backend='klipper')
+        self.scheduler.request_fast()
+        if self.gcode_queue is not None:
+            self.gcode_queue.submit(gcode)
+            return
         try:
-            step_distance = float(step_distance)
-            return step_distance
-        except ValueError:
-            return False
+            with tracer.span(gcode, tracer.TRACK_PRINTER):
+                self.post_gcode(gcode)
+        except requests.RequestException as e:
+            metrics.inc('nxencoder_backend_gcode_errors_total', backend='klipper')
+            self.sig_log_event.emit('Failed to send {} to the printer: {}'.format(gcode, e))
+
+    def run_gcode(self, request, gcode):
+        ''' Queue gcode, reporting with sig_gcode_complete once Moonraker
+        replies. Safe to call from any thread. '''
+        metrics.inc('nxencoder_backend_gcode_total', backend='klipper')
+        if self.gcode_queue is None:
+            self.sig_gcode_complete.emit(request, False)
+            return
+        self.gcode_queue.submit(gcode, request)
+
+    def post_gcode(self, gcode):
+        ''' Run a script on the printer, returning once Moonraker replies
+        that it has run. Exceptions are left to the caller. This runs on the
+        gcode queue's thread, so it has an HttpPolicy of its own. '''
+        with metrics.span('nxencoder_backend_call', backend='klipper', call='send_gcode'):
+            self.gcode_http.get('gcode', self.address + '/printer/gcode/script?', params={'script': gcode}).raise_for_status()
 
-    def get_objectmodel(self, key=''):
+    def get_objectmodel(self, key='', operation='query'):
         ''' Read the object model, returning a json object containing
-        the resulting data. '''
-        r = requests.get(self.address + '/printer/objects/query?' + key)
+        the resulting data. operation selects the HttpPolicy timeouts. '''
+        with metrics.span('nxencoder_backend_call', backend='klipper', call='get_objectmodel'), tracer.span('query ' + key, tracer.TRACK_PRINTER):
+            r = self.http.get(operation, self.address + '/printer/objects/query?' + key)
         return json.loads(r.text)['result']['status'][key]
 
+    def query_objects(self, objects, operation='query'):
+        ''' Read several objects in one request. objects maps each object
+        name to the attributes wanted, or to None for all of them. Returns
+        the status of each object Klipper has. '''
+        query = '&'.join(name if attrs is None else '{}={}'.format(name, ','.join(attrs)) for name, attrs in objects.items())
+        with metrics.span('nxencoder_backend_call', backend='klipper', call='query_objects'), tracer.span('query ' + ','.join(objects), tracer.TRACK_PRINTER):
+            r = self.http.get(operation, self.address + '/printer/objects/query?' + query)
+        return json.loads(r.text)['result']['status']
+
     def set_tool_temperature(self, temp, tool=0):
         ''' Begins heating the specified tool on the printer. '''
         self.send_gcode('M104 S{} T{}'.format(temp, tool))
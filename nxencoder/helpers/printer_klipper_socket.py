@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+printer_klipper_socket.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject, QTimer
+
+from helpers.estop import SocketEstopChannel
+from helpers.gcode_queue import GcodeQueue
+from helpers.printer_klipper import discovery_objects, extruder_config, status_objects
+from helpers.metrics import metrics
+from helpers.printer_status import PrinterStatus
+from helpers.temperature_monitor import TemperatureMonitor
+from helpers.trace import tracer
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+# Where Klipper's API socket is usually found, newest layout first
+SOCKET_PATHS = ('~/printer_data/comms/klippy.sock', '/tmp/klippy_uds')
+
+
+def default_socket_path():
+    ''' The first of SOCKET_PATHS that exists on this host, otherwise the
+    first of them. '''
+    for path in SOCKET_PATHS:
+        if os.path.exists(os.path.expanduser(path)):
+            return path
+    return SOCKET_PATHS[0]
+
+
+class KlipperError(Exception):
+    ''' Klipper replied to a request with an error. '''
+    pass
+
+
+class KlipperSocket(QObject):
+    ''' Klipper through its API socket, started with klippy -a <path>, for
+    when the utility runs on the same host as Klipper. Requests and replies
+    are JSON messages each terminated by 0x03, matched up by their id. A
+    reader thread takes the replies off the socket, along with the status
+    updates of the objects/subscribe subscription, so the printer state is
+    pushed as it changes instead of being polled. '''
+    sig_connected = pyqtSignal()
+    sig_data_update = pyqtSignal(object)
+    sig_temp_reached = pyqtSignal(int)
+    sig_temp_stable = pyqtSignal(int)
+    sig_gcode_complete = pyqtSignal(int, bool)
+    sig_finished = pyqtSignal()
+    sig_log_event = pyqtSignal(str)
+    sig_log_debug = pyqtSignal(str)
+    sig_error = pyqtSignal(str)
+    sig_force_close = pyqtSignal()
+    sig_connection_lost = pyqtSignal(str)
+
+    timeout = 2.0
+    gcode_timeout = 300.0
+    quiet_interval = 1.0
+
+    def __init__(self, path, parent=None):
+        super(KlipperSocket, self).__init__(parent)
+        self.host = path
+        self.path = os.path.expanduser(path)
+        self.idle = False
+        self.homed = False
+        self.cfg_tools = []
+        self.status = None
+        self.cfg_board = []
+        self.run_thread = False
+        self.isKlipper = True
+        self.estop_channel = None
+        self.gcode_queue = None
+        self.socket = None
+        self.reader = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.write_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.objects = {}
+        self.subscribed = {}
+        self.updated = 0.0
+        self.temp_monitor = TemperatureMonitor(self)
+        self.temp_monitor.sig_temp_stable.connect(self.sig_temp_stable)
+
+    def run(self):
+        ''' Main thread used for connection. Status updates arrive on the
+        reader thread, so the loop here only keeps the event loop running
+        for queued calls, and polls if the subscription has been quiet. '''
+        self.loop = QEventLoop()
+
+        try:
+            self.discover()
+        except Exception as e:
+            self.close()
+            self.sig_error.emit('Connection to Klipper at {} failed.'.format(self.host))
+            self.sig_log_debug.emit('[KLIPPER] Error: Connection to {} failed. Exception returned: {}'.format(self.host, e))
+            self.sig_force_close.emit()
+            return
+
+        self.estop_channel = SocketEstopChannel('klipper_socket', self.path).start()
+        self.gcode_queue = GcodeQueue('klipper_socket', self.post_gcode)
+        self.gcode_queue.sig_gcode_complete.connect(self.sig_gcode_complete)
+        self.gcode_queue.sig_log_event.connect(self.sig_log_event)
+        self.gcode_queue.start()
+        self.sig_log_event.emit('Connected to Klipper on {}'.format(self.host))
+        self.sig_log_debug.emit('[KLIPPER] Printer Firmware: {}'.format(self.cfg_board[0]['firmware']))
+        self.sig_log_debug.emit('[KLIPPER] Found {} tool(s)'.format(len(self.cfg_tools)))
+        self.fw_string = 'Klipper {}'.format(self.cfg_board[0]['firmware'])
+        self.sig_log_event.emit('Switching to relative extrusion mode.')
+        self.send_gcode('M83')
+
+        self.status = PrinterStatus.build(self, [0] * len(self.cfg_tools))
+        self.sig_data_update.emit(self.status)
+        self.sig_connected.emit()
+        self.run_thread = True
+
+        while self.run_thread:
+            if not self.reader.is_alive():
+                self.sig_connection_lost.emit('Klipper closed the connection on {}'.format(self.host))
+                break
+            if time.monotonic() - self.updated >= self.quiet_interval:
+                try:
+                    self.poll()
+                except (OSError, KlipperError) as e:
+                    self.sig_log_debug.emit('[KLIPPER] Error: Status update failed: {}'.format(e))
+            with tracer.span('QTimer wait', ms=1000):
+                QTimer.singleShot(1000, self.loop.quit)
+                self.loop.exec_()
+
+        if self.gcode_queue is not None:
+            self.gcode_queue.stop()
+            self.gcode_queue.thread.join(self.timeout)
+        self.close()
+        self.sig_finished.emit()
+
+    def connect(self):
+        ''' Open the socket and start the reader thread. '''
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(self.path)
+        self.reader = threading.Thread(target=self.read, name='klipper_socket', daemon=True)
+        self.reader.start()
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+    def discover(self):
+        ''' Connect, then retrieve the firmware details and the
+        configuration of each tool, and subscribe to the status of the
+        printer. Exceptions are left to the caller. '''
+        with metrics.span('nxencoder_backend_phase', backend='klipper_socket', phase='connect'):
+            self.connect()
+            info = self.call('info')
+            if info['state'] != 'ready':
+                raise KlipperError('Klipper is not ready: {}'.format(info.get('state_message', info['state'])))
+            self.cfg_board.append({
+                'firmware': info['software_version']
+            })
+
+        with metrics.span('nxencoder_backend_phase', backend='klipper_socket', phase='discovery'):
+            tools, changed = extruder_config(self.call('objects/query', objects=discovery_objects())['status'])
+            self.cfg_tools[:] = tools
+            for name in changed:
+                self.sig_log_debug.emit('[KLIPPER] {} is using a rotation_distance which differs from its configuration'.format(name))
+            self.subscribe()
+
+    def subscribe(self):
+        ''' Subscribe to the objects making up the printer status. Klipper
+        replies with their current values, then sends the attributes that
+        change as they do. '''
+        self.subscribed = status_objects(self.cfg_tools)
+        self.update(self.call('objects/subscribe', objects=self.subscribed, response_template={'key': 'status'})['status'])
+
+    def call(self, method, timeout=None, **params):
+        ''' Send a request and wait for its reply, returning the result.
+        Safe to call from any thread. Raises KlipperError for an error
+        reply or no reply within timeout seconds, and OSError if the socket
+        fails. '''
+        request = next(self.ids)
+        future = Future()
+        self.pending[request] = future
+        data = json.dumps({'id': request, 'method': method, 'params': params}, separators=(',', ':')).encode() + b'\x03'
+        try:
+            with self.write_lock:
+                self.socket.sendall(data)
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            raise KlipperError('No reply to {} within {} s'.format(method, self.timeout if timeout is None else timeout))
+        finally:
+            self.pending.pop(request, None)
+
+    def read(self):
+        ''' The reader thread. Replies complete the Future of their
+        request, and subscription updates are handed to update(). '''
+        buffer = b''
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            *messages, buffer = (buffer + data).split(b'\x03')
+            for raw in messages:
+                try:
+                    self.dispatch(json.loads(raw))
+                except (ValueError, KeyError) as e:
+                    self.sig_log_debug.emit('[KLIPPER] Error: Unreadable message from Klipper: {}'.format(e))
+        for future in list(self.pending.values()):
+            if not future.done():
+                future.set_exception(ConnectionError('Klipper closed the connection'))
+
+    def dispatch(self, message):
+        request = message.get('id')
+        if request is not None:
+            future = self.pending.get(request)
+            if future is None or future.done():
+                return
+            if 'error' in message:
+                future.set_exception(KlipperError(message['error'].get('message', str(message['error']))))
+            else:
+                future.set_result(message.get('result'))
+            return
+        if message.get('key') == 'status':
+            self.update(message['params']['status'])
+
+    def update(self, status):
+        ''' Merge status into the cached objects and publish the result.
+        Called from the reader thread as updates arrive, and from
+        thread_printer by poll(). '''
+        with self.state_lock:
+            for name, values in status.items():
+                self.objects.setdefault(name, {}).update(values)
+            self.homed = len(self.objects.get('toolhead', {}).get('homed_axes', '')) >= 3
+            self.idle = self.objects.get('print_stats', {}).get('state') == 'standby'
+
+            targets = []
+            for tool, data in enumerate(self.cfg_tools):
+                extruder = self.objects.get(data['name'], {})
+                current, target = extruder.get('temperature', 0.0), extruder.get('target', 0.0)
+                data['cur_temp'] = round(current, 2)
+                targets.append(target)
+                self.temp_monitor.update(tool, current, target)
+                if target != 0 and current >= target:
+                    self.sig_temp_reached.emit(tool)
+            self.status = PrinterStatus.build(self, targets)
+            self.updated = time.monotonic()
+        metrics.inc('nxencoder_backend_polls_total', backend='klipper_socket')
+        self.sig_data_update.emit(self.status)
+
+    def poll(self):
+        ''' Query the subscribed objects once. Klipper only sends the
+        attributes which change, so this keeps the temperature history
+        going while a heater holds steady. '''
+        with metrics.span('nxencoder_backend_call', backend='klipper_socket', call='poll'):
+            self.update(self.call('objects/query', objects=self.subscribed)['status'])
+
+    def disconnect(self):
+        ''' Clean up prior to clearing the class. The socket is closed by
+        run() once the gcode queue has sent the heater commands. '''
+        self.run_thread = False
+        if self.estop_channel is not None:
+            self.estop_channel.stop()
+        for tool, _ in enumerate(self.cfg_tools):
+            self.set_tool_temperature(0, tool)
+        return
+
+    def resync(self, tool, steps, targets):
+        ''' Put the printer back in the state a running test relies on after
+        reconnecting. This is a new connection, and Klipper has usually
+        restarted, so the configuration just discovered is brought back to
+        the step distances the test was using, and the heater targets are
+        set again. '''
+        self.sig_log_event.emit('Restoring the printer state after reconnecting')
+        self.send_gcode('M83')
+        if len(self.cfg_tools) > 1:
+            self.send_gcode('T{}'.format(tool))
+        for i, esteps in enumerate(steps[:len(self.cfg_tools)]):
+            if round(self.cfg_tools[i]['stepsPerMm'], 4) != round(esteps, 4):
+                self.set_tool_esteps(esteps, i)
+        for i, target in enumerate(targets[:len(self.cfg_tools)]):
+            if target:
+                self.set_tool_temperature(target, i)
+
+    def estop(self, pressed_at=None):
+        ''' Emergency stop, sent on the estop channel's own connection. '''
+        metrics.inc('nxencoder_backend_estops_total', backend='klipper_socket')
+        if self.estop_channel is not None:
+            self.estop_channel.trigger(pressed_at)
+        if self.gcode_queue is not None:
+            self.gcode_queue.cancel_pending()
+        self.run_thread = False
+
+    def move_homeaxes(self):
+        ''' Home all axes on the printer. '''
+        self.send_gcode('G28')
+
+    def move_to_safe(self, tool=0):
+        ''' Move the selected tool to the center of the bed. '''
+        self.send_gcode('T{}'.format(tool))
+        cfg_json = self.query('toolhead')['toolhead']
+        x_mid = (cfg_json['axis_minimum'][0] + cfg_json['axis_maximum'][0]) / 2
+        y_mid = (cfg_json['axis_minimum'][1] + cfg_json['axis_maximum'][1]) / 2
+        self.send_gcode('G1 X{} Y{} F6000'.format(x_mid, y_mid))
+        self.send_gcode('G1 Z50 F1200')
+
+    def send_gcode(self, gcode):
+        ''' Transmit gcode to the printer. Once connected the gcode goes
+        through the gcode queue, and this returns straight away. '''
+        metrics.inc('nxencoder_backend_gcode_total', backend='klipper_socket')
+        if self.gcode_queue is not None:
+            self.gcode_queue.submit(gcode)
+            return
+        try:
+            with tracer.span(gcode, tracer.TRACK_PRINTER):
+                self.post_gcode(gcode)
+        except (OSError, KlipperError) as e:
+            metrics.inc('nxencoder_backend_gcode_errors_total', backend='klipper_socket')
+            self.sig_log_event.emit('Failed to send {} to the printer: {}'.format(gcode, e))
+
+    def run_gcode(self, request, gcode):
+        ''' Queue gcode, reporting with sig_gcode_complete once Klipper
+        replies. Safe to call from any thread. '''
+        metrics.inc('nxencoder_backend_gcode_total', backend='klipper_socket')
+        if self.gcode_queue is None:
+            self.sig_gcode_complete.emit(request, False)
+            return
+        self.gcode_queue.submit(gcode, request)
+
+    def post_gcode(self, gcode):
+        ''' Run a script, returning once Klipper replies that it has run.
+        Exceptions are left to the caller. '''
+        with metrics.span('nxencoder_backend_call', backend='klipper_socket', call='send_gcode'):
+            self.call('gcode/script', self.gcode_timeout, script=gcode)
+
+    def query(self, *objects):
+        ''' Query the current values of every attribute of the objects. '''
+        with metrics.span('nxencoder_backend_call', backend='klipper_socket', call='get_objectmodel'), tracer.span('query ' + ','.join(objects), tracer.TRACK_PRINTER):
+            return self.call('objects/query', objects={name: None for name in objects})['status']
+
+    def set_tool_temperature(self, temp, tool=0):
+        ''' Begins heating the specified tool on the printer. '''
+        self.send_gcode('M104 S{} T{}'.format(temp, tool))
+
+    def set_tool_esteps(self, esteps, tool=0):
+        ''' As with the Moonraker backend, esteps are converted to the
+        extruder step distance Klipper configures at runtime. '''
+        step_distance = round(1 / esteps, 6)
+        self.cfg_tools[tool]['stepsPerMm'] = esteps
+        self.cfg_tools[tool]['rotation_distance'] = round((self.cfg_tools[tool]['full_steps_per_rotation'] * self.cfg_tools[tool]['microsteps']) / esteps, 6)
+        self.sig_log_debug.emit('[KLIPPER] Setting step distance of {} to {}'.format(self.cfg_tools[tool]['name'], step_distance))
+        self.send_gcode('SET_EXTRUDER_STEP_DISTANCE EXTRUDER={} DISTANCE={}'.format(self.cfg_tools[tool]['name'], step_distance))
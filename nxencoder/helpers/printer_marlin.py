@@ -23,15 +23,27 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject, QTimer, QCoreApplication
 from PyQt5.QtSerialPort import QSerialPort
 
+from helpers.cache import printer_config_cache
+from helpers.estop import SerialEstopChannel
+from helpers.metrics import metrics
+from helpers.poll_scheduler import PollScheduler
+from helpers.printer_status import PrinterStatus
+from helpers.temperature_monitor import TemperatureMonitor
+from helpers.trace import tracer
+
+import re
+
 
 class Marlin(QObject):
     sig_connected = pyqtSignal()
-    sig_data_update = pyqtSignal()
+    sig_data_update = pyqtSignal(object)
     sig_temp_reached = pyqtSignal(int)
+    sig_temp_stable = pyqtSignal(int)
     sig_log_event = pyqtSignal(str)
     sig_log_debug = pyqtSignal(str)
     sig_error = pyqtSignal(str)
     sig_force_close = pyqtSignal()
+    sig_connection_lost = pyqtSignal(str)
 
     def __init__(self, port, baudrate=115200, parent=None):
         super(Marlin, self).__init__(parent)
@@ -41,15 +53,27 @@ class Marlin(QObject):
         self.idle = False
         self.homed = False
         self.cfg_tools = []
+        self.status = None
         self.serial_log = False
         self.serial_buffer = []
+        self.estop_channel = None
+        self.printer = QSerialPort()
+        self.scheduler = PollScheduler('marlin', fast=1, slow=5)
+        self.report_interval = 2
+        self.temp_monitor = TemperatureMonitor(self)
+        self.temp_monitor.sig_temp_stable.connect(self.sig_temp_stable)
+
+    def run(self):
+        ''' Marlin is handled from the GUI thread, driven by the signals of
+        QSerialPort, so run() only opens the port. It is called once the
+        GUI has connected to the signals, so a port that fails to open is
+        reported. '''
         self.connect()
 
     def connect(self):
         ''' Connect to Marlin via the specified serial port, check
         the connection is open, and then return. Handling of the incoming
         data is handled via Qt signals. '''
-        self.printer = QSerialPort()
         self.printer.setPortName(self.portname)
         self.printer.setBaudRate(self.baudrate)
         self.printer.setDataBits(QSerialPort.Data8)
@@ -58,11 +82,29 @@ class Marlin(QObject):
         self.printer.setFlowControl(QSerialPort.NoFlowControl)
         self.printer.open(QSerialPort.ReadWrite)
         self.printer.readyRead.connect(self.receive)
-        # self.printer.errorOccurred.connect(self.error)
+        self.printer.errorOccurred.connect(self.error)
 
         if not self.printer.isOpen():
             self.sig_error.emit('Connection to {} failed.'.format(self.portname))
             self.sig_force_close.emit()
+            return
+
+        self.estop_channel = SerialEstopChannel('marlin', self.printer)
+
+    def error(self, error):
+        ''' QSerialPort signalled an error. Only the port going away, as when
+        the USB cable is pulled or the board resets and enumerates again, is
+        acted on. The port is closed, and the GUI decides whether to
+        reconnect. '''
+        if error != QSerialPort.ResourceError or not self.printer.isOpen():
+            return
+        self.sig_log_debug.emit('[MARLIN] Error: QSerialPort reported error code: {}'.format(error))
+        self.close()
+        self.sig_connection_lost.emit('{} is no longer available'.format(self.portname))
+
+    def close(self):
+        if self.printer.isOpen():
+            self.printer.close()
 
     def receive(self):
         ''' Handle incoming data. '''
@@ -71,18 +113,7 @@ class Marlin(QObject):
             data = raw_data.data().decode().rstrip('\r\n')
 
             if data[:3] == ' T:':
-                for i in range(len(self.cfg_tools)):
-                    tool = 'T{}'.format(i)
-                    start = data.find(tool) + len(tool) + 1
-                    end = data.find(' ', start)
-                    self.cfg_tools[i]['cur_temp'] = float(data[start:end])
-
-                    start = data.find('/', end) + 1
-                    end = data.find(' ', start)
-                    set_temp = float(data[start:end])
-                    if set_temp > 0 and self.cfg_tools[i]['cur_temp'] >= set_temp:
-                        self.sig_temp_reached.emit(i)
-                self.sig_data_update.emit()
+                self.parse_temperature_report(data)
 
             if self.serial_log:
                 self.serial_buffer.append(data)
@@ -93,32 +124,158 @@ class Marlin(QObject):
                 self.sig_log_debug.emit('[MARLIN] Printer Firmware: v{}'.format(version))
                 self.fw_string = 'Marlin v{}'.format(version)
 
-                # Send T0 to make sure Marlin is fully ready
-                self.query_printer('T0')
-                self.cfg_tools.clear()
+                with metrics.span('nxencoder_backend_phase', backend='marlin', phase='discovery'):
+                    # Send T0 to make sure Marlin is fully ready
+                    self.query_printer('T0')
 
-                for i in range(0,10):
-                    self.query_printer('T{}'.format(i))
-                    if 'Invalid extruder' in self.serial_buffer[0]:
-                        break
+                    fingerprint = self.query_fingerprint(version)
+                    if not self.load_cached_tools(fingerprint):
+                        self.cfg_tools.clear()
+                        complete = True
+                        for i in range(0,10):
+                            self.query_printer('T{}'.format(i))
+                            if 'Invalid extruder' in self.serial_buffer[0]:
+                                break
 
-                    self.query_printer('M92 T{}'.format(i))
-                    if len(self.serial_buffer) == 1:
-                        stepsPerMm = float(self.serial_buffer[0][self.serial_buffer[0].find('E') + 1:])
-                    else:
-                        stepsPerMm = float(self.serial_buffer[1][self.serial_buffer[1].find('E') + 1:])
+                            # A tool without steps/mm cannot be calibrated,
+                            # so it and any after it are left out, and the
+                            # partial list is not cached.
+                            steps = self.query_steps(i)
+                            if steps is None:
+                                self.sig_log_debug.emit('[MARLIN] Tool {} on {} did not report its steps/mm'.format(i, self.portname))
+                                complete = False
+                                break
 
-                    self.cfg_tools.append({
-                        'stepsPerMm': stepsPerMm,
-                        'cur_temp': 0,
-                        'max_temp': 260
-                    })
+                            self.cfg_tools.append({
+                                'stepsPerMm': steps,
+                                'cur_temp': 0,
+                                'max_temp': 260
+                            })
+                        if not self.cfg_tools:
+                            self.sig_error.emit('The printer on {} did not report the steps/mm of any tool.'.format(self.portname))
+                            self.close()
+                            self.sig_force_close.emit()
+                            return
+                        if complete:
+                            printer_config_cache.store('marlin:' + self.portname, fingerprint,
+                                                       [{'max_temp': tool['max_temp']} for tool in self.cfg_tools])
 
                 self.connected = True
+                self.status = PrinterStatus.build(self, [0] * len(self.cfg_tools))
+                self.sig_data_update.emit(self.status)
                 self.sig_connected.emit()
                 self.sig_log_event.emit('Switching to relative extrusion mode.')
                 self.send_gcode('M83')
-                self.send_gcode('M155 S2')
+                self.send_gcode('M155 S{}'.format(self.report_interval))
+
+    def query_fingerprint(self, version):
+        ''' Identify the printer on this port for the configuration cache.
+        Printers running the same Marlin release are often swapped on the
+        same port, so the machine UUID and extruder count reported by M115
+        are included with the version. Either may be missing from older
+        builds. '''
+        self.query_printer('M115')
+        report = ' '.join(self.serial_buffer)
+        uuid = re.search(r'UUID:(\S+)', report)
+        extruders = re.search(r'EXTRUDER_COUNT:(\d+)', report)
+        return [version, uuid.group(1) if uuid else None, int(extruders.group(1)) if extruders else None]
+
+    def load_cached_tools(self, fingerprint):
+        ''' Take the tools from the configuration cache if this port was
+        last used by the same printer, which saves selecting each tool in
+        turn to find how many there are. The steps/mm are always read from
+        the printer, and the cache is not used if any tool does not report
+        them. Returns True if the cache was used. '''
+        cached = printer_config_cache.lookup('marlin:' + self.portname, fingerprint)
+        tools = []
+        for i, tool in enumerate(cached or []):
+            steps = self.query_steps(i)
+            if steps is None:
+                self.sig_log_debug.emit('[MARLIN] Tool {} in the cached configuration of {} did not report its steps/mm'.format(i, self.portname))
+                cached = None
+                break
+            tools.append({
+                'stepsPerMm': steps,
+                'cur_temp': 0,
+                'max_temp': tool.get('max_temp', 260)
+            })
+        metrics.inc('nxencoder_printer_config_cache_total', backend='marlin', result='hit' if cached else 'miss')
+        if not cached:
+            return False
+        self.cfg_tools.clear()
+        self.cfg_tools.extend(tools)
+        self.sig_log_debug.emit('[MARLIN] Using the cached tool configuration of {}'.format(self.portname))
+        return True
+
+    def query_steps(self, tool):
+        ''' Read the steps/mm of the extruder of a tool, from a reply such as
+        "echo: M92 X80.00 Y80.00 Z400.00 E93.00". Returns None if there is
+        no E value, as for "echo:M92 Invalid extruder 1". '''
+        self.query_printer('M92 T{}'.format(tool))
+        for line in reversed(self.serial_buffer):
+            steps = re.search(r' E(-?[\d.]+)', line)
+            if steps:
+                return float(steps.group(1))
+        return None
+
+    def parse_temperature_report(self, data):
+        ''' Parse an M105 auto-report line, such as
+        ' T:200.00 /200.00 B:60.00 /60.00 T0:200.00 /200.00 T1:25.00 /0.00 @:0',
+        and update the current temperature of each tool. '''
+        targets = []
+        for i, cfg in enumerate(self.cfg_tools):
+            tool = 'T{}'.format(i)
+            start = data.find(tool) + len(tool) + 1
+            end = data.find(' ', start)
+            cur_temp = float(data[start:end])
+            cfg['cur_temp'] = cur_temp
+
+            start = data.find('/', end) + 1
+            end = data.find(' ', start)
+            set_temp = float(data[start:end])
+            targets.append(set_temp)
+            self.temp_monitor.update(i, cur_temp, set_temp)
+            if set_temp > 0 and cur_temp >= set_temp:
+                self.sig_temp_reached.emit(i)
+        self.status = PrinterStatus.build(self, targets)
+        metrics.inc('nxencoder_backend_polls_total', backend='marlin')
+        tracer.instant('temperature report', tracer.TRACK_PRINTER)
+        self.sig_data_update.emit(self.status)
+        self.schedule_reports()
+
+    def schedule_reports(self):
+        ''' Marlin sends its temperature reports unprompted, every M155
+        interval, so the scheduler sets that interval instead of a poll
+        timer. M155 takes whole seconds, and is only sent when the rounded
+        interval changes and no query is waiting on an ok. '''
+        seconds = max(1, int(round(self.scheduler.next_interval(self.temp_monitor.settling()))))
+        if seconds == self.report_interval or self.serial_log or not self.printer.isOpen():
+            return
+        self.report_interval = seconds
+        self.printer.write('M155 S{}\n'.format(seconds).encode())
+
+    def resync(self, tool, steps, targets):
+        ''' Put the printer back in the state a running test relies on after
+        reconnecting. Opening the port resets most boards, so this is a
+        fresh start: the steps/mm read back from the EEPROM are brought back
+        to the ones the test was using, and the heater targets set again. '''
+        self.sig_log_event.emit('Restoring the printer state after reconnecting')
+        self.send_gcode('M83')
+        self.send_gcode('T{}'.format(tool))
+        for i, esteps in enumerate(steps[:len(self.cfg_tools)]):
+            if round(self.cfg_tools[i]['stepsPerMm'], 2) != round(esteps, 2):
+                self.set_tool_esteps(esteps, i)
+        for i, target in enumerate(targets[:len(self.cfg_tools)]):
+            if target:
+                self.set_tool_temperature(target, i)
+        self.send_gcode('M155 S{}'.format(self.report_interval))
+
+    def estop(self, pressed_at=None):
+        ''' Emergency stop. M112 bypasses send_gcode and is written
+        directly to the port. '''
+        metrics.inc('nxencoder_backend_estops_total', backend='marlin')
+        if self.estop_channel is not None:
+            self.estop_channel.trigger(pressed_at)
 
     def move_homeaxes(self):
         ''' Home all axes on the printer. '''
@@ -137,9 +294,16 @@ class Marlin(QObject):
         self.send_gcode('M104 S{} T{}'.format(temp, tool))
 
     def send_gcode(self, gcode):
-        ''' Transmit gcode to the printer via the QSerialPort interface. '''
-        self.printer.write('{}\n'.format(gcode).encode())
-        self.printer.waitForBytesWritten(-1)
+        ''' Transmit gcode to the printer via the QSerialPort interface.
+        Nothing is sent once the port has gone away. '''
+        if not self.printer.isOpen():
+            self.sig_log_debug.emit('[MARLIN] Port closed, not sending {}'.format(gcode))
+            return
+        metrics.inc('nxencoder_backend_gcode_total', backend='marlin')
+        self.scheduler.request_fast()
+        with tracer.span(gcode, tracer.TRACK_PRINTER):
+            self.printer.write('{}\n'.format(gcode).encode())
+            self.printer.waitForBytesWritten(-1)
 
     def query_printer(self, gcode):
         ''' Transmit gcode to the printer via the QSerialPort interface,
@@ -147,11 +311,13 @@ class Marlin(QObject):
         loop = QEventLoop()
         self.serial_buffer.clear()
         self.serial_log = True
-        self.send_gcode(gcode)
+        with metrics.span('nxencoder_backend_call', backend='marlin', call='query_printer'):
+            self.send_gcode(gcode)
 
-        while len(self.serial_buffer) == 0 or self.serial_buffer[len(self.serial_buffer) - 1][:2] != 'ok':
-            QTimer.singleShot(100, loop.quit)
-            loop.exec_()
+            while len(self.serial_buffer) == 0 or self.serial_buffer[len(self.serial_buffer) - 1][:2] != 'ok':
+                with tracer.span('QTimer wait', ms=100):
+                    QTimer.singleShot(100, loop.quit)
+                    loop.exec_()
         self.serial_log = False
         self.serial_buffer.pop()
 
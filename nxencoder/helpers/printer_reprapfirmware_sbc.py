@@ -20,7 +20,17 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject, QTimer
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QEventLoop, QObject, QThread, QTimer
+
+from helpers.estop import EstopChannel
+from helpers.http_policy import HttpPolicy
+from helpers.metrics import metrics
+from helpers.poll_scheduler import PollScheduler
+from helpers.printer_status import PrinterStatus
+from helpers.temperature_monitor import TemperatureMonitor
+from helpers.trace import tracer
+
+from functools import partial
 
 import json
 import requests
@@ -29,13 +39,17 @@ import socket
 
 class RepRapFirmware3_SBC(QObject):
     sig_connected = pyqtSignal()
-    sig_data_update = pyqtSignal()
+    sig_data_update = pyqtSignal(object)
     sig_temp_reached = pyqtSignal(int)
+    sig_temp_stable = pyqtSignal(int)
     sig_finished = pyqtSignal()
     sig_log_event = pyqtSignal(str)
     sig_log_debug = pyqtSignal(str)
     sig_error = pyqtSignal(str)
     sig_force_close = pyqtSignal()
+    sig_connection_lost = pyqtSignal(str)
+    sig_connection_restored = pyqtSignal()
+    sig_call = pyqtSignal(object)
 
     def __init__(self, host, parent=None):
         super(RepRapFirmware3_SBC, self).__init__(parent)
@@ -43,8 +57,19 @@ class RepRapFirmware3_SBC(QObject):
         self.idle = False
         self.homed = False
         self.cfg_tools = []
+        self.status = None
         self.cfg_board = []
         self.run_thread = False
+        self.estop_channel = None
+        self.temp_monitor = TemperatureMonitor(self)
+        self.temp_monitor.sig_temp_stable.connect(self.sig_temp_stable)
+        self.scheduler = PollScheduler('rrf3_sbc', fast=0.5, slow=3.0)
+        self.http = HttpPolicy('rrf3_sbc', self)
+        self.http.sig_degraded.connect(self.sig_log_event)
+        self.http.sig_recovered.connect(self.http_recovered)
+        self.http.sig_degraded.connect(self.sig_connection_lost)
+        self.http.sig_recovered.connect(self.sig_connection_restored)
+        self.sig_call.connect(self.run_call)
 
     def run(self):
         ''' Main thread used for connection, thruough to retrieving
@@ -56,67 +81,156 @@ class RepRapFirmware3_SBC(QObject):
         self.loop = QEventLoop()
 
         try:
-            self.rrf_address = 'http://' + socket.gethostbyname(self.rrf_host)
-
-            boards = self.get_objectmodel('boards')
-            self.cfg_board.append({
-                'board': boards[0]['name'],
-                'firmware': boards[0]['firmwareVersion']
-            })
-
-            self.cfg_tools.clear()
-            for tool in self.get_objectmodel('tools'):
-                self.cfg_tools.append({
-                    'extruder': tool['extruders'][0],
-                    'heater': tool['heaters'][0],
-                    'stepsPerMm': float(self.get_objectmodel('move')['extruders'][tool['extruders'][0]]['stepsPerMm']),
-                    'cur_temp': 0,
-                    'max_temp': int(self.get_objectmodel('heat')['heaters'][tool['heaters'][0]]['max'])
-                })
+            self.discover()
         except Exception as e:
             self.sig_error.emit('Connection to {} failed.'.format(self.rrf_host))
             self.sig_log_debug.emit('[RRF3] Error: Connection to {} failed. Exception returned: {}'.format(self.rrf_host, e))
             self.sig_force_close.emit()
             return
 
+        self.estop_channel = EstopChannel('rrf3_sbc', 'POST', self.rrf_address + '/machine/code', data='M112',
+                                          warmup=self.rrf_address + '/machine/status').start()
         self.sig_log_event.emit('Connected to RepRapFirmware v3 via the SBC at {}'.format(self.rrf_host))
         self.sig_log_debug.emit('[RRF3] Printer Firmware: v{} running on: {}'.format(self.cfg_board[0]['firmware'], self.cfg_board[0]['board']))
         self.sig_log_debug.emit('[RRF3] Found {} tool(s)'.format(len(self.cfg_tools)))
         self.fw_string = 'v{} ({})'.format(self.cfg_board[0]['firmware'], self.cfg_board[0]['board'])
 
+        self.status = PrinterStatus.build(self, [0] * len(self.cfg_tools))
+        self.sig_data_update.emit(self.status)
         self.sig_connected.emit()
         self.run_thread = True
 
         while self.run_thread:
+            try:
+                self.poll()
+            except (requests.RequestException, ValueError) as e:
+                self.sig_log_debug.emit('[RRF3] Error: Status update failed: {}'.format(e))
+            interval = int(self.scheduler.next_interval(self.busy()) * 1000)
+            with tracer.span('QTimer wait', ms=interval):
+                QTimer.singleShot(interval, self.loop.quit)
+                self.loop.exec_()
+
+        self.sig_finished.emit()
+
+    def discover(self):
+        ''' Resolve the host, then retrieve the firmware details and the
+        configuration of each tool. A port may be given as host:port.
+        /machine/status returns the whole object model, so it is read once
+        and everything is taken from that. Exceptions are left to the
+        caller. '''
+        with metrics.span('nxencoder_backend_phase', backend='rrf3_sbc', phase='connect'):
+            host, _, port = self.rrf_host.partition(':')
+            self.rrf_address = 'http://' + socket.gethostbyname(host) + (':' + port if port else '')
+
+            model = self.get_machine_status('discover')
+            boards = model['boards']
+            self.cfg_board.append({
+                'board': boards[0]['name'],
+                'firmware': boards[0]['firmwareVersion']
+            })
+
+        with metrics.span('nxencoder_backend_phase', backend='rrf3_sbc', phase='discovery'):
+            self.cfg_tools.clear()
+            for tool in model['tools']:
+                self.cfg_tools.append({
+                    'extruder': tool['extruders'][0],
+                    'heater': tool['heaters'][0],
+                    'stepsPerMm': float(model['move']['extruders'][tool['extruders'][0]]['stepsPerMm']),
+                    'cur_temp': 0,
+                    'max_temp': int(model['heat']['heaters'][tool['heaters'][0]]['max'])
+                })
+
+    def poll(self):
+        ''' Retrieve the status of the printer once, updating the homed and
+        idle state and the temperature of each tool. '''
+        with metrics.span('nxencoder_backend_call', backend='rrf3_sbc', call='poll'):
             self.homed = True
-            axes = self.get_objectmodel('move')['axes']
+            axes = self.get_objectmodel('move', 'poll')['axes']
             for axis in axes:
-                if axes[axis]['homed'] == False:
+                if axis['homed'] == False:
                     self.homed = False
 
-            self.idle = True if self.get_objectmodel('state')['status'] == 'idle' else False
+            self.idle = True if self.get_objectmodel('state', 'poll')['status'] == 'idle' else False
 
+            heaters = self.get_objectmodel('heat', 'poll')['heaters']
+            targets = []
             for tool, data in enumerate(self.cfg_tools):
-                heater = self.get_objectmodel('heat')['heaters'][self.cfg_tools[tool]['heater']]
-                self.cfg_tools[tool]['cur_temp'] = heater['current']
-                if heater['active'] != 0 and heater['current'] >= heater['active']:
+                heater = heaters[data['heater']]
+                current, target = heater['current'], heater['active']
+                data['cur_temp'] = current
+                targets.append(target)
+                self.temp_monitor.update(tool, current, target)
+                if target != 0 and current >= target:
                     self.sig_temp_reached.emit(tool)
-            self.sig_data_update.emit()
-            QTimer.singleShot(1000, self.loop.quit)
-            self.loop.exec_()
+            self.status = PrinterStatus.build(self, targets)
+        metrics.inc('nxencoder_backend_polls_total', backend='rrf3_sbc')
+        self.sig_data_update.emit(self.status)
 
-        self.sig_finished.emit()
+    def http_recovered(self):
+        self.sig_log_event.emit('The printer at {} is responding again'.format(self.rrf_host))
+
+    def queue_call(self, method, *args):
+        ''' Requests go through self.http, which belongs to the thread this
+        backend runs on. A call made from any other thread, such as the
+        GUI's, is queued to run there instead. Returns True if it was
+        queued, in which case the caller returns. '''
+        if QThread.currentThread() is self.thread():
+            return False
+        self.sig_call.emit(partial(method, *args))
+        return True
+
+    @pyqtSlot(object)
+    def run_call(self, call):
+        ''' Run a call queued by queue_call. Nothing is waiting on it, so
+        a failure is logged. '''
+        try:
+            call()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.sig_log_event.emit('{} failed: {}'.format(call.func.__name__, e))
+
+    def busy(self):
+        ''' Poll fast while a heater is settling or the machine is not idle. '''
+        return self.temp_monitor.settling() or not self.idle
 
     def disconnect(self):
         ''' Clean up prior to clearing the class '''
+        if self.queue_call(self.disconnect):
+            return
         self.run_thread = False
+        if self.estop_channel is not None:
+            self.estop_channel.stop()
         for tool, _ in enumerate(self.cfg_tools):
             self.set_tool_temperature(0, tool)
         return
 
-    def estop(self):
-        ''' Emergency stop. '''
-        self.send_gcode('M112')
+    def resync(self, tool, steps, targets):
+        ''' Put the printer back in the state a running test relies on once
+        the connection is restored. The board may have been reset in the
+        meantime, so relative extrusion, the tool, the steps/mm and the
+        heater targets are all set again. M92 sets every extruder at once.
+        Tools still stable at their target are reported stable again. '''
+        if self.queue_call(self.resync, tool, steps, targets):
+            return
+        self.sig_log_event.emit('Restoring the printer state after reconnecting')
+        self.send_gcode('M83')
+        self.send_gcode('T{}'.format(tool))
+        for i, esteps in enumerate(steps[:len(self.cfg_tools)]):
+            self.cfg_tools[i]['stepsPerMm'] = float(esteps)
+        if self.cfg_tools:
+            self.set_tool_esteps(self.cfg_tools[tool]['stepsPerMm'], tool)
+        for i, target in enumerate(targets[:len(self.cfg_tools)]):
+            if target:
+                self.set_tool_temperature(target, i)
+        for i, _ in enumerate(self.cfg_tools):
+            if self.temp_monitor.is_stable(i):
+                self.sig_temp_stable.emit(i)
+
+    def estop(self, pressed_at=None):
+        ''' Emergency stop, sent on the estop channel rather than from this
+        thread. '''
+        metrics.inc('nxencoder_backend_estops_total', backend='rrf3_sbc')
+        if self.estop_channel is not None:
+            self.estop_channel.trigger(pressed_at)
         self.run_thread = False
 
     def move_homeaxes(self):
@@ -125,6 +239,8 @@ class RepRapFirmware3_SBC(QObject):
 
     def move_to_safe(self, tool=0):
         ''' Move the selected tool to the center of the bed. '''
+        if self.queue_call(self.move_to_safe, tool):
+            return
         axes = self.get_objectmodel('move')['axes']
         x_mid = (axes[0]['min'] + axes[0]['max']) / 2
         y_mid = (axes[1]['min'] + axes[1]['max']) / 2
@@ -133,17 +249,30 @@ class RepRapFirmware3_SBC(QObject):
         self.send_gcode('G1 Z50 F1200')
 
     def send_gcode(self, gcode):
-        ''' Transmit gcode to the printer via the HTTP interface. '''
-        requests.post(self.rrf_address + '/machine/code', gcode)
+        ''' Transmit gcode to the printer via the HTTP interface. A failure
+        is logged rather than raised, as this is called from signals. '''
+        if self.queue_call(self.send_gcode, gcode):
+            return
+        metrics.inc('nxencoder_backend_gcode_total', backend='rrf3_sbc')
+        self.scheduler.request_fast()
+        try:
+            with metrics.span('nxencoder_backend_call', backend='rrf3_sbc', call='send_gcode'), tracer.span(gcode, tracer.TRACK_PRINTER):
+                self.http.post('gcode', self.rrf_address + '/machine/code', data=gcode)
+        except requests.RequestException as e:
+            metrics.inc('nxencoder_backend_gcode_errors_total', backend='rrf3_sbc')
+            self.sig_log_event.emit('Failed to send {} to the printer: {}'.format(gcode, e))
 
-    def get_objectmodel(self, key=''):
+    def get_objectmodel(self, key='', operation='query'):
         ''' Read the object model, returning a json object containing
-        the resulting data. '''
-        r = requests.get(self.rrf_address + '/machine/status')
-        if not r.status_code == 200:
-            r.raise_for_status()
-        else:
-            return json.loads(r.text)[key]
+        the resulting data. operation selects the HttpPolicy timeouts. '''
+        with metrics.span('nxencoder_backend_call', backend='rrf3_sbc', call='get_objectmodel'), tracer.span('machine/status ' + key, tracer.TRACK_PRINTER):
+            return self.get_machine_status(operation)[key]
+
+    def get_machine_status(self, operation='query'):
+        ''' Read the whole object model. '''
+        r = self.http.get(operation, self.rrf_address + '/machine/status')
+        r.raise_for_status()
+        return json.loads(r.text)
 
     def set_tool_temperature(self, temp, tool=0):
         ''' Begins heating the specified tool on the printer. '''
@@ -153,6 +282,8 @@ class RepRapFirmware3_SBC(QObject):
         ''' Change the esteps of the extruder configured to the
         specified tool. Internally update our configuration with
         the new value as well. '''
+        if self.queue_call(self.set_tool_esteps, esteps, tool):
+            return
         self.cfg_tools[tool]['stepsPerMm'] = float(esteps)
         gcode = 'M92 E'
         esteps_list = []
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+printer_status.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import time
+
+
+@dataclass(frozen=True)
+class ToolStatus:
+    ''' The state of one tool at the time of a status update. name is the
+    Klipper extruder the tool drives, and max_temp is 0 where the printer
+    does not report a limit. '''
+    temperature: float
+    target: float
+    steps_per_mm: float
+    rotation_distance: Optional[float]
+    stable: bool
+    eta: Optional[float]
+    max_temp: float
+    name: Optional[str]
+
+
+@dataclass(frozen=True)
+class PrinterStatus:
+    ''' A snapshot of the printer, built by the backend once per status
+    update and sent with sig_data_update. It is immutable, so the GUI can
+    read it while the backend carries on polling in thread_printer. The
+    first is sent just before sig_connected, so the GUI has the tools
+    before it needs them. '''
+    homed: bool
+    idle: bool
+    tools: Tuple[ToolStatus, ...]
+    timestamp: float
+
+    @classmethod
+    def build(cls, printer, targets):
+        ''' Build a snapshot from a backend's current state. targets holds
+        the target temperature of each tool, as reported in the same status
+        update. '''
+        monitor = printer.temp_monitor
+        tools = tuple(ToolStatus(
+            temperature=float(data['cur_temp']),
+            target=float(targets[tool]),
+            steps_per_mm=data['stepsPerMm'],
+            rotation_distance=data.get('rotation_distance'),
+            stable=monitor.is_stable(tool),
+            eta=monitor.eta(tool),
+            max_temp=float(data.get('max_temp', 0)),
+            name=data.get('name')
+        ) for tool, data in enumerate(printer.cfg_tools))
+        return cls(printer.homed, printer.idle, tools, time.monotonic())
@@ -20,20 +20,94 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from PyQt5.QtCore import pyqtSignal, QObject
+from PyQt5.QtCore import pyqtSignal, QObject, QTimer
 from PyQt5.QtSerialPort import QSerialPort
 
+from helpers.metrics import metrics
+from helpers.trace import tracer
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+import itertools
+import math
+import time
+
+
+_request_ids = itertools.count(1)
+
+
+def next_request_id():
+    ''' Return a request ID that has not been used by this process. IDs are
+    shared by every encoder connection, so a reply still in flight from an
+    earlier test can never be mistaken for a reply to the current one. '''
+    return next(_request_ids)
+
+
+@dataclass(frozen=True)
+class Measurement:
+    ''' A measurement reported by the encoder. received is the
+    time.perf_counter() value taken as the bytes arrived, and sent is the
+    time the MEASURE command was written, if it was requested by this
+    connection. request is the ID of the MEASURE command it answers. In raw
+    count mode, total is the distance in mm since the last RESET. '''
+    value: float
+    received: float
+    sent: Optional[float] = None
+    request: Optional[int] = None
+    total: Optional[float] = None
+
 
 class SerialEncoder(QObject):
-    sig_measurement = pyqtSignal(float)
+    ''' The serial connection to the encoder. It is moved to its own thread
+    by MainWindow, so incoming data is handled and timestamped as it
+    arrives rather than when the GUI is next free.
+
+    Each MEASURE and RESET is sent with a request ID, e.g. "MEASURE 12".
+    Firmware 1.2 and later echo the ID ahead of the reply as "12|20.0125",
+    and acknowledge a RESET with "12|OK". Older firmware ignores the ID and
+    replies in order, so its replies are matched to the oldest outstanding
+    MEASURE. A request without a reply after `timeout` seconds is reported
+    with sig_timeout, but is kept for a while longer so that a late reply
+    is still matched to it rather than to the next request.
+
+    With raw_counts, and firmware 1.3 or later, MEASURE is replaced by
+    COUNT, which returns the raw signed 32-bit encoder count. The counts
+    are unwrapped into a running position here, and converted to mm in
+    double precision using the calibrated diameter from the handshake. '''
+    sig_measurement = pyqtSignal(object)
+    sig_timeout = pyqtSignal(int)
+    sig_calibrated = pyqtSignal(float)
+    sig_calibration_error = pyqtSignal(str)
     sig_handshake = pyqtSignal()
+    sig_closed = pyqtSignal()
     sig_log_event = pyqtSignal(str)
     sig_log_debug = pyqtSignal(str)
     sig_error = pyqtSignal(str)
     sig_force_close = pyqtSignal()
+    sig_connection_lost = pyqtSignal(str)
+
+    timeout = 1.0
+    expiry = 10.0
+    rotation_count = 8192
 
-    def __init__(self, parent=None):
+    def __init__(self, port=None, raw_counts=False, parent=None):
         super(SerialEncoder, self).__init__(parent)
+        self.portname = port
+        self.pending = OrderedDict()
+        self.echo = False
+        self.raw_counts = raw_counts
+        self.raw = False
+        self.counts_per_mm = None
+        self.calibrated = None
+        self.zero_position()
+
+    def run(self):
+        ''' Open the port from the encoder's own thread, so QSerialPort
+        belongs to that thread. '''
+        self.connect(self.portname)
 
     def connect(self, portName):
         ''' Connect to the encoder via the specified serial port, check
@@ -50,42 +124,220 @@ class SerialEncoder(QObject):
         self.encoder.readyRead.connect(self.receive)
         self.encoder.errorOccurred.connect(self.error)
 
+        self.timeout_timer = QTimer()
+        self.timeout_timer.timeout.connect(self.check_timeouts)
+        self.timeout_timer.start(100)
+
         if not self.encoder.isOpen():
             self.sig_error.emit('Connection to {} failed.'.format(portName))
             self.sig_force_close.emit()
 
     def receive(self):
-        ''' Handle incoming data. '''
-        while self.encoder.canReadLine():
-            raw_data = self.encoder.readLine()
-            data = raw_data.data().decode().rstrip('\r\n')
-            try:
-                float(data)
-                self.sig_measurement.emit(float(data))
-            except ValueError:
-                if data[:3] == 'NXE':
-                    _, self.firmware_version, self.firmware_date, self.calibration = data.strip().split('|')
-                    self.sig_handshake.emit()
+        ''' Handle incoming data. The timestamp is taken before anything
+        else, and applies to every line that arrived together. '''
+        received = time.perf_counter()
+        with metrics.span('nxencoder_encoder_receive'):
+            while self.encoder.canReadLine():
+                if not self.parse_line(self.encoder.readLine().data(), received):
                     return
-                self.sig_log_event.emit('Warning: Invalid data received from encoder. Raw: {}'.format(raw_data))
+
+    def parse_line(self, raw_data, received=None):
+        ''' Parse one line of raw bytes from the encoder and emit the
+        matching signal. Returns False after the handshake so that receive()
+        discards anything else already buffered. '''
+        if received is None:
+            received = time.perf_counter()
+        data = raw_data.decode().rstrip('\r\n')
+        request = None
+        prefix, separator, reply = data.partition('|')
+        if separator and prefix.isdigit():
+            request, data = int(prefix), reply
+            if data == 'OK':
+                metrics.inc('nxencoder_encoder_lines_total', kind='ack')
+                if self.complete(request, 'RESET', received) is not None and self.raw:
+                    self.zero_position()
+                return True
+            if data.lstrip('-').isdigit():
+                # Only COUNT is answered with a whole number, MEASURE always
+                # has four decimal places. A count whose request has been
+                # forgotten is dropped rather than taken for a measurement.
+                if request in self.pending and self.pending[request][0] == 'COUNT':
+                    return self.parse_count(request, data, raw_data, received)
+                metrics.inc('nxencoder_encoder_lines_total', kind='stale')
+                self.sig_log_debug.emit('[SERIAL] Dropped the count {} for expired request {}'.format(data, request))
+                return True
+        try:
+            measurement = float(data)
+        except ValueError:
+            if data[:3] == 'NXE':
+                metrics.inc('nxencoder_encoder_lines_total', kind='handshake')
+                tracer.instant('handshake', tracer.TRACK_ENCODER, raw=data)
+                _, self.firmware_version, self.firmware_date, self.calibration = data.strip().split('|')
+                self.echo = self.version_at_least(self.firmware_version, '1.2')
+                self.raw = self.raw_counts and self.version_at_least(self.firmware_version, '1.3')
+                if self.raw_counts and not self.raw:
+                    self.sig_log_event.emit('Encoder firmware v{} does not report raw counts, using its measurements instead'.format(self.firmware_version))
+                self.counts_per_mm = self.rotation_count / (float(self.calibration) * math.pi)
+                self.pending.clear()
+                self.zero_position()
+                self.sig_handshake.emit()
+                return False
+            if data.startswith('CALIBRATED DIAMETER:'):
+                self.calibrated = data.split(':')[1].strip()
+                return True
+            if data == 'CALIBRATION SAVED TO EEPROM' and self.calibrated is not None:
+                metrics.inc('nxencoder_encoder_lines_total', kind='calibration')
+                self.calibration, self.calibrated = self.calibrated, None
+                self.counts_per_mm = self.rotation_count / (float(self.calibration) * math.pi)
+                self.sig_calibrated.emit(float(self.calibration))
+                return True
+            if data.startswith('ERROR SAVING TO EEPROM'):
+                metrics.inc('nxencoder_encoder_lines_total', kind='calibration')
+                self.calibrated = None
+                self.sig_calibration_error.emit('The encoder failed to save the new calibration. Response: {}'.format(data))
+                return True
+            metrics.inc('nxencoder_encoder_lines_total', kind='invalid')
+            self.sig_log_event.emit('Warning: Invalid data received from encoder. Raw: {}'.format(raw_data))
+            return True
+
+        if request is None:
+            request = next((r for r, p in self.pending.items() if p[0] == 'MEASURE'), None)
+        sent = self.complete(request, 'MEASURE', received, value=measurement)
+        metrics.inc('nxencoder_encoder_lines_total', kind='measurement')
+        self.sig_measurement.emit(Measurement(measurement, received, sent, request))
+        return True
+
+    def parse_count(self, request, data, raw_data, received):
+        ''' Handle the reply to a COUNT request. The distance since the
+        previous COUNT is emitted as the measurement, as MEASURE would. '''
+        try:
+            count = int(data)
+        except ValueError:
+            metrics.inc('nxencoder_encoder_lines_total', kind='invalid')
+            self.sig_log_event.emit('Warning: Invalid data received from encoder. Raw: {}'.format(raw_data))
+            return True
+
+        position = self.unwrap(count)
+        measurement = (position - self.measured_position) / self.counts_per_mm
+        self.measured_position = position
+        sent = self.complete(request, 'COUNT', received, count=count)
+        metrics.inc('nxencoder_encoder_lines_total', kind='count')
+        self.sig_measurement.emit(Measurement(measurement, received, sent, request, position / self.counts_per_mm))
+        return True
+
+    def unwrap(self, count):
+        ''' Add the change since the previous count to the running position.
+        The firmware count is a signed 32-bit value, so the change is taken
+        modulo 2^32, which is correct across a wrap as long as the encoder
+        moves less than 2^31 counts (about 6km of filament) between
+        reads. '''
+        delta = (count - self.last_count + 0x80000000) % 0x100000000 - 0x80000000
+        self.last_count = count
+        self.position += delta
+        return self.position
+
+    def zero_position(self):
+        ''' Match a RESET of the firmware's count. '''
+        self.last_count = 0
+        self.position = 0
+        self.measured_position = 0
+
+    @staticmethod
+    def version_at_least(version, minimum):
+        ''' The firmware prints its version with String() of a float, so
+        v1.1 reports itself as "1.10". Versions are compared as decimal
+        numbers, not as dotted parts, or "1.10" would be newer than 1.2. '''
+        try:
+            return Decimal(version) >= Decimal(minimum)
+        except InvalidOperation:
+            return False
+
+    def complete(self, request, command, received, **args):
+        ''' Remove an answered request from the pending requests, recording
+        its round trip. Returns the time the request was sent, or None if
+        the reply does not match a request sent by this connection. '''
+        pending = self.pending.pop(request, None)
+        if pending is None:
+            if request is not None:
+                self.sig_log_debug.emit('[SERIAL] Reply to unknown {} request {}'.format(command, request))
+            return None
+        _, sent, expired = pending
+        metrics.observe('nxencoder_encoder_roundtrip_seconds', received - sent, command=command)
+        tracer.complete(command, sent, received, tracer.TRACK_ENCODER, request=request, **args)
+        if expired:
+            metrics.inc('nxencoder_encoder_late_replies_total', command=command)
+            self.sig_log_debug.emit('[SERIAL] {} request {} answered after {:.0f} ms'.format(command, request, (received - sent) * 1000))
+        return sent
+
+    def check_timeouts(self):
+        ''' Report requests that have gone unanswered for longer than
+        `timeout`, and forget those older than `expiry`. '''
+        now = time.perf_counter()
+        for request, (command, sent, expired) in list(self.pending.items()):
+            if now - sent > self.expiry:
+                del self.pending[request]
+            elif not expired and now - sent > self.timeout:
+                self.pending[request] = (command, sent, True)
+                metrics.inc('nxencoder_encoder_timeouts_total', command=command)
+                tracer.instant('timeout', tracer.TRACK_ENCODER, command=command, request=request)
+                self.sig_log_debug.emit('[SERIAL] No reply to {} request {} after {:.0f} ms'.format(command, request, self.timeout * 1000))
+                self.sig_timeout.emit(request)
 
     def disconnect(self):
         ''' Disconnect from the serial port. '''
+        self.timeout_timer.stop()
+        self.pending.clear()
         self.encoder.close()
+        self.sig_closed.emit()
 
     def error(self, error):
         ''' QSerialPort signalled an error. Report to the event log and
-        then signal the GUI to close the connection. '''
+        then signal the GUI to close the connection. If the port has gone
+        away, as when the encoder is unplugged or enumerates again, the
+        connection is closed here and reported as lost instead, so the GUI
+        can reconnect once it is back. '''
         if error == QSerialPort.NoError:
             return
+        if error == QSerialPort.ResourceError:
+            if not self.encoder.isOpen():
+                return
+            self.sig_log_debug.emit('[SERIAL] Error: QSerialPort reported error code: {}'.format(error))
+            self.disconnect()
+            self.sig_connection_lost.emit('{} is no longer available'.format(self.portname))
+            return
         self.sig_error.emit('The encoder connection reported an error and has been closed.')
         self.sig_log_debug.emit('[SERIAL] Error: QSerialPort reported error code: {}'.format(error))
         self.sig_force_close.emit()
 
-    def measure(self):
-        ''' Make the arduino report a measurement now. '''
-        self.encoder.write('MEASURE\n'.encode())
+    def measure(self, request=0):
+        ''' Make the arduino report a measurement now. The request ID is
+        normally chosen by the worker with next_request_id(), so that it
+        can pick out the reply. '''
+        if not request:
+            request = next_request_id()
+        command = 'COUNT' if self.raw else 'MEASURE'
+        metrics.inc('nxencoder_encoder_measure_total')
+        self.pending[request] = (command, time.perf_counter(), False)
+        self.encoder.write('{} {}\n'.format(command, request).encode())
+
+    def calibrate(self, distance):
+        ''' Have the firmware calculate and save the gear diameter, taking
+        distance as the length of filament moved since the last RESET. '''
+        metrics.inc('nxencoder_encoder_calibrate_total')
+        tracer.instant('CAL', tracer.TRACK_ENCODER, distance=distance)
+        self.encoder.write('CAL{:.6f}\n'.format(distance).encode())
 
-    def reset(self):
-        ''' Resets any acumulated value the arduino is tracking. '''
-        self.encoder.write('RESET\n'.encode())
+    def reset(self, request=0):
+        ''' Resets any acumulated value the arduino is tracking. Only
+        firmware that echoes request IDs acknowledges a RESET, so it is only
+        tracked as pending on those. In raw count mode the running position
+        is zeroed once the firmware acknowledges the RESET, so that a COUNT
+        answered before it is still measured from the old position. '''
+        if not request:
+            request = next_request_id()
+        metrics.inc('nxencoder_encoder_reset_total')
+        if self.echo:
+            self.pending[request] = ('RESET', time.perf_counter(), False)
+        else:
+            tracer.instant('RESET', tracer.TRACK_ENCODER)
+        self.encoder.write('RESET {}\n'.format(request).encode())
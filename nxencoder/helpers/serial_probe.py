@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+serial_probe.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject, QTimer
+from PyQt5.QtSerialPort import QSerialPort, QSerialPortInfo
+
+from helpers.metrics import metrics
+
+from dataclasses import dataclass
+from functools import partial
+
+import time
+
+
+@dataclass(frozen=True)
+class EncoderInfo:
+    ''' An encoder found by SerialProbe, with the details from its
+    handshake. '''
+    port: str
+    firmware_version: str
+    firmware_date: str
+    calibration: float
+
+
+class SerialProbe(QObject):
+    ''' Looks for encoders on a number of serial ports at once. Every port
+    is opened together and identified by the NXE| handshake the encoder
+    prints as it starts, so the whole probe takes as long as the slowest
+    port rather than the sum of them. Boards that do not reset when the
+    port is opened are sent VERSION once query_delay has passed. The probe
+    runs on the event loop of the thread it was created in, and does not
+    block it. '''
+    sig_found = pyqtSignal(object)
+    sig_finished = pyqtSignal(list)
+    sig_log_debug = pyqtSignal(str)
+
+    timeout = 3000
+    query_delay = 2000
+
+    def __init__(self, ports, parent=None):
+        super(SerialProbe, self).__init__(parent)
+        self.ports = list(ports)
+        self.probes = {}
+        self.found = []
+
+    def start(self):
+        ''' Open every port and start its timers. sig_finished is emitted
+        once every port has been identified or has timed out. '''
+        self.started = time.perf_counter()
+        for name in self.ports:
+            port = QSerialPort()
+            port.setPortName(name)
+            port.setBaudRate(QSerialPort.Baud9600)
+            port.setDataBits(QSerialPort.Data8)
+            port.setParity(QSerialPort.NoParity)
+            port.setStopBits(QSerialPort.OneStop)
+            port.setFlowControl(QSerialPort.NoFlowControl)
+            if not port.open(QSerialPort.ReadWrite):
+                self.sig_log_debug.emit('[SERIAL] Probe could not open {}: {}'.format(name, port.errorString()))
+                continue
+            port.readyRead.connect(partial(self.receive, name))
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.timeout.connect(partial(self.close, name))
+            timer.start(self.timeout)
+            QTimer.singleShot(self.query_delay, partial(self.query, name))
+            self.probes[name] = (port, timer)
+        if not self.probes:
+            self.finish()
+
+    def query(self, name):
+        if name in self.probes:
+            self.probes[name][0].write(b'VERSION\n')
+
+    def receive(self, name):
+        port = self.probes[name][0]
+        while port.canReadLine():
+            data = bytes(port.readLine().data()).decode(errors='replace').strip()
+            if not data.startswith('NXE|'):
+                continue
+            try:
+                _, version, date, calibration = data.split('|')
+                info = EncoderInfo(name, version, date, float(calibration))
+            except ValueError:
+                continue
+            metrics.observe('nxencoder_encoder_probe_seconds', time.perf_counter() - self.started)
+            self.sig_log_debug.emit('[SERIAL] Found encoder v{} on {}'.format(version, name))
+            self.found.append(info)
+            self.sig_found.emit(info)
+            self.close(name)
+            return
+
+    def close(self, name):
+        ''' Stop probing a port, either because it has been identified or
+        because it timed out. '''
+        if name not in self.probes:
+            return
+        port, timer = self.probes.pop(name)
+        timer.stop()
+        port.close()
+        port.deleteLater()
+        if not self.probes:
+            self.finish()
+
+    def finish(self):
+        self.sig_log_debug.emit('[SERIAL] Probed {} port(s) in {:.0f} ms'.format(len(self.ports), (time.perf_counter() - self.started) * 1000))
+        self.sig_finished.emit(sorted(self.found, key=lambda info: info.port))
+
+
+class SerialPortWatcher(QObject):
+    ''' Polls the system serial ports, as Qt has no notification of ports
+    being added or removed. sig_changed carries the names of the ports
+    which appeared and those which went away since the last poll. '''
+    sig_changed = pyqtSignal(list, list)
+
+    interval = 1000
+
+    def __init__(self, parent=None):
+        super(SerialPortWatcher, self).__init__(parent)
+        self.ports = set()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+
+    def start(self):
+        self.ports = set(port.portName() for port in QSerialPortInfo.availablePorts())
+        self.timer.start(self.interval)
+
+    def stop(self):
+        self.timer.stop()
+
+    def poll(self):
+        ports = set(port.portName() for port in QSerialPortInfo.availablePorts())
+        if ports == self.ports:
+            return
+        added, removed = sorted(ports - self.ports), sorted(self.ports - ports)
+        self.ports = ports
+        self.sig_changed.emit(added, removed)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+temperature_monitor.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from collections import deque
+
+import time
+
+
+class TemperatureMonitor(QObject):
+    ''' Keeps a bounded history of temperature samples for each heater and
+    decides when a heater has stabilised at its target: every sample in the
+    last `window` seconds is within `tolerance` degrees of the target, and
+    the temperature is no longer drifting by more than `max_slope` degrees
+    per second. sig_temp_stable is emitted once as the heater becomes
+    stable, and again only after it has left the band and settled again. '''
+    sig_temp_stable = pyqtSignal(int)
+
+    tolerance = 1.0
+    window = 10.0
+    max_slope = 0.1
+    history_length = 900
+    slope_samples = 60
+
+    def __init__(self, parent=None):
+        super(TemperatureMonitor, self).__init__(parent)
+        self.history = {}
+        self.targets = {}
+        self.entered = {}
+        self.stable = {}
+
+    def update(self, heater, current, target, timestamp=None):
+        ''' Add a sample for a heater. Called by the printer backends once
+        per status update. Every sample since the heater entered the
+        tolerance band is within it by definition, so only the slope needs
+        checking once the heater has been in the band for a full window. '''
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if heater not in self.history:
+            self.history[heater] = deque(maxlen=self.history_length)
+        self.history[heater].append((timestamp, float(current)))
+
+        if self.targets.get(heater) != target:
+            self.targets[heater] = target
+            self.entered[heater] = None
+            self.stable[heater] = False
+
+        if not target or abs(current - target) > self.tolerance:
+            self.entered[heater] = None
+            self.stable[heater] = False
+            return
+
+        if self.entered.get(heater) is None:
+            self.entered[heater] = timestamp
+        if self.stable[heater] or timestamp - self.entered[heater] < self.window:
+            return
+        if abs(self.slope(self.recent(heater, self.window))) <= self.max_slope:
+            self.stable[heater] = True
+            self.sig_temp_stable.emit(heater)
+
+    def recent(self, heater, window):
+        ''' Return the samples of the last `window` seconds, at most
+        slope_samples of them. '''
+        samples = self.history.get(heater)
+        if not samples:
+            return []
+        start = samples[-1][0] - window
+        recent = []
+        for sample in reversed(samples):
+            if sample[0] < start or len(recent) >= self.slope_samples:
+                break
+            recent.append(sample)
+        recent.reverse()
+        return recent
+
+    @staticmethod
+    def slope(samples):
+        ''' Least squares slope of the samples, in degrees per second. '''
+        n = len(samples)
+        if n < 2:
+            return 0.0
+        mean_t = sum(t for t, _ in samples) / n
+        mean_v = sum(v for _, v in samples) / n
+        var = sum((t - mean_t) ** 2 for t, _ in samples)
+        if var == 0:
+            return 0.0
+        return sum((t - mean_t) * (v - mean_v) for t, v in samples) / var
+
+    def is_stable(self, heater):
+        return self.stable.get(heater, False)
+
+    def eta(self, heater):
+        ''' Estimate the seconds until the heater is stable. The time to
+        reach the tolerance band is extrapolated from the recent rate of
+        change, then the settling window is added. Returns 0 when stable,
+        or None when there is no target or the heater is not approaching
+        it. '''
+        target = self.targets.get(heater)
+        samples = self.history.get(heater)
+        if not target or not samples:
+            return None
+        if self.is_stable(heater):
+            return 0.0
+
+        if self.entered.get(heater) is not None:
+            return max(0.0, self.window - (samples[-1][0] - self.entered[heater]))
+
+        error = target - samples[-1][1]
+        rate = self.slope(self.recent(heater, self.window))
+        if rate == 0 or (error > 0) != (rate > 0):
+            return None
+        return (abs(error) - self.tolerance) / abs(rate) + self.window
+
+    def settling(self):
+        ''' True while any heater has a target but is not yet stable at
+        it. '''
+        return any(target and not self.stable.get(heater, False) for heater, target in self.targets.items())
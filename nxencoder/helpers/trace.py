@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+trace.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import QThread
+
+from contextlib import contextmanager
+
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    ''' Records a calibration run as a timeline in the Chrome trace event
+    format, which can be opened in chrome://tracing or Perfetto. Each
+    QThread gets its own track, named after its objectName(), and serial
+    and network traffic are drawn on two extra tracks of their own. '''
+    TRACK_ENCODER = 'encoder serial'
+    TRACK_PRINTER = 'printer traffic'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = False
+        self.events = []
+        self.tracks = {self.TRACK_ENCODER: 1, self.TRACK_PRINTER: 2}
+        self.t0 = time.perf_counter()
+
+    def start(self):
+        ''' Discard any previous timeline and begin recording. '''
+        with self.lock:
+            self.events.clear()
+            self.t0 = time.perf_counter()
+            self.recording = True
+
+    def stop(self):
+        self.recording = False
+
+    def track(self, name=None):
+        ''' Return the track id for a named track, or for the calling
+        thread when no name is given. '''
+        if name is None:
+            name = QThread.currentThread().objectName() or threading.current_thread().name
+        if name not in self.tracks:
+            self.tracks[name] = len(self.tracks) + 1
+        return self.tracks[name]
+
+    def complete(self, name, start, end, track=None, cat='nxencoder', **args):
+        ''' Add a slice covering start to end, both taken from
+        time.perf_counter(). '''
+        if not self.recording:
+            return
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': round((start - self.t0) * 1000000, 3),
+                'dur': round((end - start) * 1000000, 3),
+                'pid': os.getpid(),
+                'tid': self.track(track),
+                'args': args
+            })
+
+    def instant(self, name, track=None, cat='nxencoder', **args):
+        ''' Add a zero length marker at the current time. '''
+        if not self.recording:
+            return
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'i',
+                's': 't',
+                'ts': round((time.perf_counter() - self.t0) * 1000000, 3),
+                'pid': os.getpid(),
+                'tid': self.track(track),
+                'args': args
+            })
+
+    @contextmanager
+    def span(self, name, track=None, cat='nxencoder', **args):
+        ''' Record the enclosed block as a slice. '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.perf_counter(), track, cat, **args)
+
+    def drain(self):
+        ''' Take the events recorded so far, for another process to add to
+        its timeline with merge(). Tracks are given by name, and times
+        from time.perf_counter(), which is the same in every process. '''
+        with self.lock:
+            events, self.events = self.events, []
+            names = {tid: name for name, tid in self.tracks.items()}
+            t0 = self.t0 * 1000000
+        for event in events:
+            event['track'] = names[event.pop('tid')]
+            event['ts'] = round(event['ts'] + t0, 3)
+        return events
+
+    def merge(self, events):
+        ''' Add events taken with drain() in another process, if a timeline
+        is being recorded. Those from before it started are dropped. '''
+        if not self.recording:
+            return
+        with self.lock:
+            t0 = self.t0 * 1000000
+            for event in events:
+                if event['ts'] < t0:
+                    continue
+                event = dict(event, pid=os.getpid(), tid=self.track(event['track']), ts=round(event['ts'] - t0, 3))
+                del event['track']
+                self.events.append(event)
+
+    def save(self, filename):
+        ''' Write the timeline to a JSON file, naming every track. '''
+        with self.lock:
+            events = list(self.events)
+            tracks = dict(self.tracks)
+        for name, tid in tracks.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}})
+            events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'sort_index': tid}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+tracer = Tracer()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Module
+worker_base.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject, QTimer
+
+from helpers.cache import checkpoint_cache
+from helpers.connection_manager import ConnectionGate, ConnectionInterrupted, ConnectionLost
+from helpers.metrics import metrics
+from helpers.serial_encoder import next_request_id
+from helpers.trace import tracer
+
+import threading
+import time
+
+
+class WorkerCancelled(Exception):
+    ''' Raised inside a worker when its test has been aborted. '''
+    pass
+
+
+class CancellationToken(QObject):
+    ''' Shared between the GUI and a worker. cancel() may be called from any
+    thread. sig_cancelled is connected to the worker's event loop, so a
+    pending wait returns straight away instead of running out its timer. '''
+    sig_cancelled = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(CancellationToken, self).__init__(parent)
+        self.event = threading.Event()
+        self.cancelled_at = None
+
+    def cancel(self):
+        if self.event.is_set():
+            return
+        self.cancelled_at = time.perf_counter()
+        self.event.set()
+        self.sig_cancelled.emit()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        ''' Raise WorkerCancelled if the token has been cancelled. '''
+        if self.event.is_set():
+            raise WorkerCancelled()
+
+
+class Worker(QObject):
+    ''' Base for the test workers. A test is written as a plain sequence of
+    steps in test(), waiting with wait() between them. Each wait runs the
+    thread's event loop, so measurements and printer signals are still
+    handled, and is the point at which an abort takes effect.
+
+    Steps which move filament and measure it are run through step(). If a
+    connection drops part way through, the step is held until MainWindow
+    has reconnected, and then repeated from the start, as the move and the
+    encoder count it left behind can not be trusted.
+
+    Workers which implement checkpoint_state() and restore_checkpoint() are
+    checkpointed after each iteration, under the parameters MainWindow sets
+    in checkpoint, so a run that never finished can be resumed. '''
+    sig_encoder_measure = pyqtSignal(int)
+    sig_encoder_reset = pyqtSignal(int)
+    sig_printer_send_gcode = pyqtSignal(str)
+    sig_printer_run_gcode = pyqtSignal(int, str)
+    sig_log_debug = pyqtSignal(str)
+    sig_log_event = pyqtSignal(str)
+    sig_finished = pyqtSignal()
+    sig_aborted = pyqtSignal()
+
+    name = 'worker'
+    tool = 0
+    temp_stable = False
+    measure_timeout = 2000
+    gcode_completion = False
+    # A step that fails while the connections are up, such as a move the
+    # printer rejected, is only repeated this many times.
+    retries = 3
+    retry_delay = 2000
+    # Seconds to wait for the tool temperature to stabilise.
+    stable_timeout = 900
+    checkpoint = None
+
+    def __init__(self, parent=None):
+        super(Worker, self).__init__(parent)
+        self.token = CancellationToken()
+        self.gate = ConnectionGate()
+        self.gcode_sent = None
+        self.awaiting = None
+        self.measurement = None
+        self.gcode_pending = None
+        self.gcode_result = None
+
+    def run(self):
+        ''' Main thread used for running the test. '''
+        self.loop = QEventLoop()
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.loop.quit)
+        self.token.sig_cancelled.connect(self.loop.quit)
+        self.gate.sig_interrupted.connect(self.loop.quit)
+        self.gate.sig_restored.connect(self.loop.quit)
+
+        try:
+            try:
+                self.step(self.wait_for_temperature)
+                self.test()
+                if self.checkpoint is not None:
+                    checkpoint_cache.clear()
+            except ConnectionInterrupted as e:
+                self.stop('{} during a part of the {} test which can not be repeated. Stopping the test.'.format(e, self.name))
+        except WorkerCancelled:
+            latency = time.perf_counter() - self.token.cancelled_at
+            metrics.inc('nxencoder_worker_aborts_total', worker=self.name)
+            metrics.observe('nxencoder_worker_abort_seconds', latency)
+            self.sig_log_debug.emit('[WORKER] {} test aborted after {:.1f} ms'.format(self.name, latency * 1000))
+            self.sig_aborted.emit()
+            return
+        self.sig_finished.emit()
+
+    def test(self):
+        raise NotImplementedError
+
+    def abort(self):
+        ''' Abort the test at its next wait. Safe to call from any thread. '''
+        self.token.cancel()
+
+    def stop(self, reason):
+        ''' Abort the test from inside the worker, logging why. '''
+        self.sig_log_event.emit(reason)
+        self.token.cancel()
+        raise WorkerCancelled()
+
+    def step(self, func):
+        ''' Run func as a step of the test, repeating it if it is
+        interrupted. Any number of dropped connections are waited out, but
+        a step that fails while the connections are up is given up on after
+        retries attempts. '''
+        failures = 0
+        interrupted = None
+        while True:
+            try:
+                if interrupted is not None:
+                    self.resume(isinstance(interrupted, ConnectionLost))
+                return func()
+            except ConnectionInterrupted as e:
+                if not isinstance(e, ConnectionLost):
+                    failures += 1
+                    if failures > self.retries:
+                        self.stop('{}. Stopping the test.'.format(e))
+                metrics.inc('nxencoder_worker_interruptions_total', worker=self.name)
+                self.sig_log_event.emit('{}. The step will be repeated.'.format(e))
+                interrupted = e
+
+    def save_checkpoint(self):
+        ''' Save the state of the test once an iteration has completed. '''
+        if self.checkpoint is None:
+            return
+        with metrics.span('nxencoder_worker_checkpoint', worker=self.name):
+            checkpoint_cache.store(self.checkpoint, self.checkpoint_state())
+
+    def checkpoint_state(self):
+        ''' Return what restore_checkpoint() needs to carry on from the last
+        completed iteration, as plain JSON types. '''
+        raise NotImplementedError
+
+    def restore_checkpoint(self, state):
+        ''' Take up the state saved by checkpoint_state(). Called before the
+        worker starts. '''
+        raise NotImplementedError
+
+    def resume(self, lost):
+        ''' Get back to where an interrupted step began. After a lost
+        connection the tool may have cooled, so its temperature has to be
+        reported stable again. Any move still running is let finish before
+        the encoder is reset. '''
+        self.awaiting = None
+        self.gcode_pending = None
+        if lost:
+            self.temp_stable = False
+            self.wait_for_reconnect()
+        else:
+            self.wait(self.retry_delay)
+        self.wait_for_temperature()
+        self.move('M400', 1000)
+        self.reset_encoder()
+
+    def wait_for_reconnect(self):
+        ''' Hold the test until every connection is back. '''
+        if self.gate.is_open():
+            return
+        self.sig_log_event.emit('Waiting to reconnect to the {}'.format(' and '.join(self.gate.links())))
+        with tracer.span('wait for reconnect'):
+            while not self.gate.is_open():
+                self.token.check()
+                self.run_loop(1000)
+        self.token.check()
+
+    def prime(self):
+        ''' Push some filament through to fill the nozzle, then zero the
+        encoder. '''
+        self.sig_log_event.emit('Priming the nozzle')
+        with metrics.span('nxencoder_worker_phase', worker=self.name, phase='prime'):
+            self.move('G1 E5 F600', 2000)
+        self.reset_encoder()
+
+    def send_gcode(self, gcode):
+        ''' Send gcode to the printer, noting when it was submitted. '''
+        self.gcode_sent = time.perf_counter()
+        self.sig_printer_send_gcode.emit(gcode)
+
+    def move(self, gcode, delay):
+        ''' Send a move and wait for the printer to finish it. Backends
+        which report completion (gcode_completion) are sent the move with an
+        M400, and the test carries on as soon as it has run. Otherwise the
+        test waits for delay milliseconds, which must cover the move. '''
+        if not self.gcode_completion:
+            self.send_gcode(gcode)
+            self.wait(delay)
+            return
+
+        request = next_request_id()
+        self.gcode_pending = request
+        self.gcode_result = None
+        self.gcode_sent = time.perf_counter()
+        self.sig_printer_run_gcode.emit(request, gcode + '\nM400')
+        deadline = self.gcode_sent + max(delay * 2, 10000) / 1000
+        while self.gcode_result is None:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.gcode_pending = None
+                self.stop('The printer did not finish {} in time. Stopping the test.'.format(gcode))
+            self.wait(remaining * 1000)
+        if not self.gcode_result:
+            raise ConnectionInterrupted('The printer failed to run {}'.format(gcode))
+        metrics.observe('nxencoder_worker_move_seconds', time.perf_counter() - self.gcode_sent, worker=self.name)
+
+    def handle_gcode_complete(self, request, success):
+        ''' Signalled by backends with gcode_completion as a command
+        finishes. '''
+        if request != self.gcode_pending:
+            return
+        self.gcode_pending = None
+        self.gcode_result = success
+        self.loop.quit()
+
+    def reset_encoder(self):
+        self.sig_encoder_reset.emit(next_request_id())
+
+    def measure(self, timeout=None):
+        ''' Ask the encoder for a measurement and wait for the reply to this
+        request, which is handled by handle_measurement() before returning.
+        Replies to earlier requests are discarded. Stops the test if there
+        is no reply within timeout milliseconds. '''
+        if timeout is None:
+            timeout = self.measure_timeout
+        request = next_request_id()
+        self.awaiting = request
+        self.measurement = None
+        self.sig_encoder_measure.emit(request)
+        deadline = time.perf_counter() + timeout / 1000
+        while self.measurement is None:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.awaiting = None
+                self.stop('No measurement received from the encoder for request {}. Stopping the test.'.format(request))
+            self.wait(remaining * 1000)
+        return self.measurement
+
+    def wait(self, ms):
+        ''' Run the event loop for ms milliseconds, or until something quits
+        it early. Raises WorkerCancelled if the test has been aborted, and
+        ConnectionLost if a connection is down as the wait starts. A drop
+        during the wait is left for the next one, so a measurement that has
+        already arrived is kept. '''
+        self.token.check()
+        self.gate.check()
+        self.run_loop(ms)
+        self.token.check()
+
+    def run_loop(self, ms):
+        with tracer.span('QTimer wait', ms=ms):
+            self.timer.start(int(ms))
+            self.loop.exec_()
+            self.timer.stop()
+
+    def wait_for_temperature(self):
+        ''' Hold off until the printer reports the tool temperature as
+        stable. Reaching the target is not enough, as the temperature
+        overshoots and settles for a while afterwards, which shows up as
+        noise in the first measurements. Stability is signalled once, as the
+        temperature settles, and is also read from each status update in
+        case that signal was missed. '''
+        if self.temp_stable:
+            return
+        self.sig_log_event.emit('Waiting for the temperature of tool {} to stabilise'.format(self.tool))
+        deadline = time.perf_counter() + self.stable_timeout
+        with tracer.span('wait for stable temperature'):
+            while not self.temp_stable:
+                if time.perf_counter() > deadline:
+                    self.stop('The temperature of tool {} did not stabilise within {} s. Stopping the test.'.format(self.tool, self.stable_timeout))
+                self.wait(1000)
+
+    def handle_status(self, status):
+        ''' Signalled by the printer with each status update. '''
+        if self.tool < len(status.tools) and status.tools[self.tool].stable:
+            self.temp_stable = True
+
+    def handle_temp_stable(self, tool):
+        ''' Signalled by the printer when a tool temperature has
+        stabilised. '''
+        if tool == self.tool:
+            self.temp_stable = True
+            self.loop.quit()
+
+    def receive_measurement(self, measurement):
+        ''' Signalled by the encoder. Only the reply to the request measure()
+        is waiting on is handled. Both timestamps come from the same clock,
+        so the time from submitting the last move to the encoder data
+        arriving is recorded before the test handles it. '''
+        if self.awaiting is None or measurement.request != self.awaiting:
+            metrics.inc('nxencoder_worker_discarded_measurements_total', worker=self.name)
+            self.sig_log_debug.emit('[WORKER] Discarded measurement {} for request {}'.format(measurement.value, measurement.request))
+            return
+        self.awaiting = None
+        if self.gcode_sent is not None:
+            metrics.observe('nxencoder_worker_move_to_measurement_seconds', measurement.received - self.gcode_sent, worker=self.name)
+        self.handle_measurement(measurement)
+        self.measurement = measurement
+        self.loop.quit()
+
+    def handle_measurement(self, measurement):
+        raise NotImplementedError
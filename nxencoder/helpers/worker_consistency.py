@@ -20,23 +20,21 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtCore import Qt, pyqtSignal, QEventLoop, QObject, QTimer
+from PyQt5.QtCore import Qt
 from PyQt5.QtChart import QChart, QLineSeries, QValueAxis
 
+from helpers.metrics import metrics
+from helpers.worker_base import Worker
 
-class WorkerConsistency(QObject):
-    sig_encoder_measure = pyqtSignal()
-    sig_encoder_reset = pyqtSignal()
-    sig_printer_send_gcode = pyqtSignal(str)
-    sig_log_event = pyqtSignal(str)
-    sig_finished = pyqtSignal()
 
-    cal_results = []
+class WorkerConsistency(Worker):
+    name = 'consistency'
 
     iteration = 0
 
     def __init__(self, parent=None):
         super(WorkerConsistency, self).__init__(parent)
+        self.cal_results = []
         self.series = QLineSeries()
 
         self.chart = QChart()
@@ -53,29 +51,34 @@ class WorkerConsistency(QObject):
         self.chart.setAxisX(self.xaxis, self.series)
         self.series.attachAxis(self.yaxis)
 
-    def run(self):
-        ''' Main thread used for running the consistency check iterations. '''
-        self.loop = QEventLoop()
-        self.series.clear()
+    def test(self):
+        ''' Run the consistency check iterations, carrying on after any
+        restored from a checkpoint. '''
+        self.step(self.prime)
 
-        self.sig_log_event.emit('Priming the nozzle')
-        self.sig_printer_send_gcode.emit('G1 E5 F600')
-        QTimer.singleShot(2000, self.loop.quit)
-        self.loop.exec_()
-        self.sig_encoder_reset.emit()
+        for self.iteration in range(len(self.cal_results) + 1, 21):
+            self.step(self.run_iteration)
+            self.save_checkpoint()
 
-        for self.iteration in range(1, 21):
-            self.sig_log_event.emit('Running iteration {} of 20'.format(self.iteration))
-            self.sig_printer_send_gcode.emit('G1 E20 F120')
-            QTimer.singleShot(12000, self.loop.quit)
-            self.loop.exec_()
+    def run_iteration(self):
+        ''' Extrude and measure once. '''
+        self.sig_log_event.emit('Running iteration {} of 20'.format(self.iteration))
+        with metrics.span('nxencoder_worker_phase', worker='consistency', phase='move'):
+            self.move('G1 E20 F120', 12000)
 
-            self.sig_encoder_measure.emit()
+        with metrics.span('nxencoder_worker_phase', worker='consistency', phase='settle'):
+            self.measure()
+        metrics.inc('nxencoder_worker_iterations_total', worker='consistency')
 
-            QTimer.singleShot(250, self.loop.quit)
-            self.loop.exec_()
+    def checkpoint_state(self):
+        return {'cal_results': self.cal_results}
 
-        self.sig_finished.emit()
+    def restore_checkpoint(self, state):
+        ''' Take up the deviations saved so far, and chart them again. '''
+        self.reset()
+        self.cal_results = [float(deviation) for deviation in state['cal_results']][:20]
+        for iteration, deviation in enumerate(self.cal_results, 1):
+            self.series.append(iteration, deviation)
 
     def reset(self):
         ''' Reset the chart to an empty state. '''
@@ -84,6 +87,6 @@ class WorkerConsistency(QObject):
     def handle_measurement(self, measurement):
         ''' Retrieve the measurements from the encoder signal, then
         add them to the chart. '''
-        deviation = round((-1 + (measurement / 20)) * 100, 2)
+        deviation = round((-1 + (measurement.value / 20)) * 100, 2)
         self.cal_results.append(deviation)
         self.series.append(self.iteration, float(deviation))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+nxEncoder Module
+worker_diameter.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtCore import pyqtSignal
+
+from helpers.metrics import metrics
+from helpers.worker_base import Worker
+
+import statistics
+
+
+class WorkerDiameter(Worker):
+    ''' Calibrate the effective diameter of the encoder's gear. A known
+    length of filament is pushed through the encoder several times, runs
+    that disagree with the rest are discarded, and the diameter is worked
+    out here from the remainder. The firmware derives the diameter it saves
+    from the count since the last RESET, so CAL is sent with the distance
+    that makes it arrive at the same value. '''
+    sig_encoder_calibrate = pyqtSignal(float)
+
+    name = 'diameter'
+
+    distance = 50
+    feedrate = 120
+    iterations = 8
+    delay = ((distance / (feedrate / 60)) + 2) * 1000
+
+    # Runs further than this many median absolute deviations from the
+    # median are rejected.
+    outlier_limit = 3.0
+    # Refuse to save a diameter that differs from the current calibration by
+    # more than this fraction, as the filament is most likely slipping.
+    max_change = 0.05
+    # The saved diameter must match the calculated one to within this
+    # fraction.
+    save_tolerance = 0.0001
+    save_timeout = 3000
+
+    def __init__(self, calibration, parent=None):
+        super(WorkerDiameter, self).__init__(parent)
+        self.calibration = calibration
+        self.cal_results = []
+        self.total = 0.0
+        self.diameter = None
+        self.iteration = 0
+        self.saved = None
+        self.save_error = None
+
+    def test(self):
+        ''' Run the calibration moves, then calculate and save the
+        diameter. '''
+        self.step(self.prime)
+
+        for self.iteration in range(self.iterations):
+            self.step(self.run_iteration)
+
+        accepted = self.reject_outliers(self.cal_results)
+        if len(accepted) < self.iterations / 2:
+            self.stop('The encoder readings were too inconsistent to calibrate from. Check the filament path and try again.')
+        self.sig_log_event.emit('Using {} of {} iterations, average {:.4f} mm'.format(len(accepted), self.iterations, statistics.mean(accepted)))
+
+        self.diameter = self.calibration * self.distance / statistics.mean(accepted)
+        change = self.diameter / self.calibration - 1
+        if abs(change) > self.max_change:
+            self.stop('The calculated diameter of {:.6f} differs from the current calibration of {:.6f} by {:.1f}%. '
+                      'Check the filament is engaged with the encoder. The calibration has not been saved.'
+                      .format(self.diameter, self.calibration, change * 100))
+
+        with metrics.span('nxencoder_worker_phase', worker='diameter', phase='save'):
+            self.sig_encoder_calibrate.emit(self.diameter * self.total / self.calibration)
+            waited = 0
+            while self.saved is None and self.save_error is None:
+                if waited >= self.save_timeout:
+                    self.stop('The encoder did not confirm the new calibration.')
+                self.wait(250)
+                waited += 250
+        if self.save_error is not None:
+            self.stop(self.save_error)
+        if abs(self.saved / self.diameter - 1) > self.save_tolerance:
+            self.stop('The encoder saved a diameter of {:.6f}, expected {:.6f}.'.format(self.saved, self.diameter))
+
+    def run_iteration(self):
+        ''' Push the calibration distance through the encoder once. '''
+        self.sig_log_event.emit('Running diameter calibration iteration {} of {}'.format(self.iteration + 1, self.iterations))
+        with metrics.span('nxencoder_worker_phase', worker='diameter', phase='move'):
+            self.move('G1 E{} F{}'.format(self.distance, self.feedrate), self.delay)
+        with metrics.span('nxencoder_worker_phase', worker='diameter', phase='settle'):
+            self.measure()
+        metrics.inc('nxencoder_worker_iterations_total', worker='diameter')
+
+    def reset_encoder(self):
+        ''' The firmware calibrates against the count since its last RESET,
+        so the total restarts with it, as when a step is repeated. '''
+        self.total = 0.0
+        super(WorkerDiameter, self).reset_encoder()
+
+    def reject_outliers(self, results):
+        ''' Return the results within outlier_limit median absolute
+        deviations of the median. '''
+        median = statistics.median(results)
+        deviation = statistics.median(abs(result - median) for result in results)
+        if deviation == 0:
+            return [result for result in results if result == median]
+        return [result for result in results if abs(result - median) / deviation <= self.outlier_limit]
+
+    def handle_measurement(self, measurement):
+        ''' Keep each run's distance, and the total since the RESET which
+        the firmware will calibrate against. '''
+        self.cal_results.append(measurement.value)
+        self.total += measurement.value
+
+    def receive_calibration(self, diameter):
+        ''' Signalled by the encoder once the new diameter is saved. '''
+        self.saved = diameter
+        self.loop.quit()
+
+    def receive_calibration_error(self, error):
+        ''' Signalled by the encoder if the diameter could not be saved. '''
+        self.save_error = error
+        self.loop.quit()
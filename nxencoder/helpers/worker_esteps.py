@@ -20,16 +20,16 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject, QTimer
+from PyQt5.QtCore import pyqtSignal
 
+from helpers.metrics import metrics
+from helpers.worker_base import Worker
 
-class WorkerEsteps(QObject):
-    sig_encoder_measure = pyqtSignal()
-    sig_encoder_reset = pyqtSignal()
-    sig_printer_send_gcode = pyqtSignal(str)
-    sig_log_event = pyqtSignal(str)
+
+class WorkerEsteps(Worker):
     sig_result_ready = pyqtSignal()
-    sig_finished = pyqtSignal()
+
+    name = 'esteps'
 
     distance_coarse = 20
     distance_fine = 50
@@ -38,46 +38,48 @@ class WorkerEsteps(QObject):
     delay_coarse = ((distance_coarse / (feedrate_coarse / 60)) + 2) * 1000
     delay_fine = ((distance_fine / (feedrate_fine / 60)) + 2) * 1000
 
-    cal_results = []
-
     iteration = 0
 
     def __init__(self, parent=None):
         super(WorkerEsteps, self).__init__(parent)
-
-    def run(self):
-        ''' Main thread used for running the eSteps calibration
-        iterations. '''
-        self.loop = QEventLoop()
-
-        self.sig_log_event.emit('Priming the nozzle')
-        self.sig_printer_send_gcode.emit('G1 E5 F600')
-        QTimer.singleShot(2000, self.loop.quit)
-        self.loop.exec_()
-        self.sig_encoder_reset.emit()
-
-        self.cal_results.clear()
-        for self.iteration in range(0, 20):
-            self.sig_log_event.emit('Running calibration iteration {} of 20'.format(self.iteration + 1))
+        self.cal_results = []
+        # The esteps of the tool as the calibration began, which the coarse
+        # correction is worked out from.
+        self.esteps = None
+
+    def test(self):
+        ''' Run the eSteps calibration iterations, carrying on after any
+        restored from a checkpoint. '''
+        self.step(self.prime)
+
+        for self.iteration in range(len(self.cal_results), 20):
+            self.step(self.run_iteration)
+            self.save_checkpoint()
+
+    def run_iteration(self):
+        ''' Extrude and measure once. '''
+        self.sig_log_event.emit('Running calibration iteration {} of 20'.format(self.iteration + 1))
+        with metrics.span('nxencoder_worker_phase', worker='esteps', phase='move'):
             if self.iteration <= 9:
-                self.sig_printer_send_gcode.emit('G1 E{} F{}'.format(self.distance_coarse, self.feedrate_coarse))
-                QTimer.singleShot(self.delay_coarse, self.loop.quit)
+                self.move('G1 E{} F{}'.format(self.distance_coarse, self.feedrate_coarse), self.delay_coarse)
 
             if self.iteration >= 10:
-                self.sig_printer_send_gcode.emit('G1 E{} F{}'.format(self.distance_fine, self.feedrate_fine))
-                QTimer.singleShot(self.delay_fine, self.loop.quit)
-
-            self.loop.exec_()
+                self.move('G1 E{} F{}'.format(self.distance_fine, self.feedrate_fine), self.delay_fine)
 
-            self.sig_encoder_measure.emit()
+        with metrics.span('nxencoder_worker_phase', worker='esteps', phase='settle'):
+            self.measure()
+        metrics.inc('nxencoder_worker_iterations_total', worker='esteps')
 
-            QTimer.singleShot(500, self.loop.quit)
-            self.loop.exec_()
+    def checkpoint_state(self):
+        return {'esteps': self.esteps, 'cal_results': self.cal_results}
 
-        self.sig_finished.emit()
+    def restore_checkpoint(self, state):
+        esteps = float(state['esteps'])
+        self.cal_results = [float(result) for result in state['cal_results']][:20]
+        self.esteps = esteps
 
     def handle_measurement(self, measurement):
         ''' Retrieve the measurements from the encoder signal, then
         add them to the results list. '''
-        self.cal_results.append(measurement)
+        self.cal_results.append(measurement.value)
         self.sig_result_ready.emit()
@@ -20,21 +20,20 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtCore import Qt, pyqtSignal, QEventLoop, QObject, QTimer
+from PyQt5.QtCore import Qt
 from PyQt5.QtChart import QChart, QChartView, QBarSeries, QBarSet, QBarCategoryAxis, QValueAxis
 
+from helpers.cache import checkpoint_cache
+from helpers.metrics import metrics
+from helpers.worker_base import Worker
 
-class WorkerVolumetric(QObject):
-    sig_encoder_measure = pyqtSignal()
-    sig_encoder_reset = pyqtSignal()
-    sig_printer_send_gcode = pyqtSignal(str)
-    sig_log_debug = pyqtSignal(str)
-    sig_log_event = pyqtSignal(str)
-    sig_finished = pyqtSignal()
+
+class WorkerVolumetric(Worker):
+    name = 'volumetric'
 
     under_extrusion = 0
     feedrate = 120
-    feedrate_limit = 0
+    feedrate_limit = 2400
     feedrate_step = 60
     distance = 100
 
@@ -64,28 +63,37 @@ class WorkerVolumetric(QObject):
 
         self.series.attachAxis(self.yaxis)
 
-    def run(self):
-        ''' Main thread used for running the maximum volumetric flow calculation. '''
-        self.loop = QEventLoop()
+    def test(self):
+        ''' Run the maximum volumetric flow calculation. The feedrate is
+        capped at feedrate_limit, so a tool that never shows the expected
+        under-extrusion does not keep extruding indefinitely. Reaching the
+        cap is not a result, so the test is stopped rather than finished,
+        and its checkpoint dropped as there is nothing left to resume. A run
+        restored from a checkpoint carries on from the feedrate it had
+        reached. '''
 
-        self.sig_log_event.emit('Priming the nozzle')
-        self.sig_printer_send_gcode.emit('G1 E5 F600')
-        QTimer.singleShot(2000, self.loop.quit)
-        self.loop.exec_()
-        self.sig_encoder_reset.emit()
+        self.step(self.prime)
 
         while self.running:
-            self.sig_encoder_reset.emit()
-
-            self.sig_log_event.emit('Running flow test at {} mm/min'.format(self.feedrate))
-            self.sig_printer_send_gcode.emit('G1 E{} F{}'.format(self.distance, self.feedrate))
+            if self.feedrate > self.feedrate_limit:
+                if self.checkpoint is not None:
+                    checkpoint_cache.clear()
+                self.stop('Reached the feedrate limit of {} mm/min without finding the flow limit of this tool. Stopping the test.'.format(self.feedrate_limit))
+            self.step(self.run_iteration)
+            self.save_checkpoint()
+
+    def run_iteration(self):
+        ''' Extrude and measure once at the current feedrate. '''
+        self.reset_encoder()
+
+        self.sig_log_event.emit('Running flow test at {} mm/min'.format(self.feedrate))
+        with metrics.span('nxencoder_worker_phase', worker='volumetric', phase='move'):
             delay = ((self.distance / (self.feedrate / 60)) + 2) * 1000
-            QTimer.singleShot(delay, self.loop.quit)
-            self.loop.exec_()
+            self.move('G1 E{} F{}'.format(self.distance, self.feedrate), delay)
 
-            self.sig_encoder_measure.emit()
-            QTimer.singleShot(250, self.loop.quit)
-            self.loop.exec_()
+        with metrics.span('nxencoder_worker_phase', worker='volumetric', phase='settle'):
+            self.measure()
+        metrics.inc('nxencoder_worker_iterations_total', worker='volumetric')
 
     def add(self, under_extrusion):
         ''' Add a data point to the chart, taking into account the existing
@@ -113,6 +121,34 @@ class WorkerVolumetric(QObject):
             self.barset.insert(self.barset.count() - 1, under_extrusion)
             return
 
+    def checkpoint_state(self):
+        ''' The search position, and the chart so far as pairs of feedrate
+        and under-extrusion. '''
+        points = []
+        if self.xaxis.at(0) != ' ':
+            points = [[self.xaxis.at(i), self.barset.at(i)] for i in range(self.barset.count())]
+        return {
+            'feedrate': self.feedrate,
+            'feedrate_step': self.feedrate_step,
+            'fine': self.fine,
+            'running': self.running,
+            'under_extrusion': self.under_extrusion,
+            'points': points
+        }
+
+    def restore_checkpoint(self, state):
+        ''' Take up the search where it stopped, and chart the results so
+        far again. Everything is read before any of it is used. '''
+        points = [(str(feedrate), float(under_extrusion)) for feedrate, under_extrusion in state['points']]
+        search = (int(state['feedrate']), int(state['feedrate_step']), bool(state['fine']), bool(state['running']), float(state['under_extrusion']))
+        self.feedrate, self.feedrate_step, self.fine, self.running, self.under_extrusion = search
+        if not points:
+            return
+        self.clear()
+        for feedrate, under_extrusion in points:
+            self.xaxis.append(feedrate)
+            self.barset.append(under_extrusion)
+
     def clear(self):
         ''' Remove all data from the chart. '''
         self.xaxis.clear()
@@ -121,7 +157,7 @@ class WorkerVolumetric(QObject):
     def handle_measurement(self, measurement):
         ''' Retrieve the measurements from the encoder signal, run calculations,
         adjust as needed, then add them to the chart. '''
-        self.under_extrusion = (100 - ((measurement / self.distance) * 100))
+        self.under_extrusion = (100 - ((measurement.value / self.distance) * 100))
         if self.under_extrusion < 0.25:
             self.under_extrusion = 0.0
         self.sig_log_event.emit('The result for {} mm/min is {:.2f}% of under-extrusion'.format(self.feedrate, self.under_extrusion))
@@ -144,7 +180,6 @@ class WorkerVolumetric(QObject):
             self.feedrate -= self.feedrate_step
             self.feedrate -= 5
             self.running = False
-            self.sig_finished.emit()
             return
 
         self.feedrate += self.feedrate_step
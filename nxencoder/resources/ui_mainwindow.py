@@ -195,6 +195,7 @@ class Ui_MainWindow(object):
         self.cbx_printer_fwtype.addItem("")
         self.cbx_printer_fwtype.addItem("")
         self.cbx_printer_fwtype.addItem("")
+        self.cbx_printer_fwtype.addItem("")
         self.layout_printer.setWidget(2, QtWidgets.QFormLayout.FieldRole, self.cbx_printer_fwtype)
         self.layout_printer_location = QtWidgets.QHBoxLayout()
         self.layout_printer_location.setObjectName("layout_printer_location")
@@ -980,6 +981,8 @@ class Ui_MainWindow(object):
         self.menubar.setObjectName("menubar")
         self.menuFile = QtWidgets.QMenu(self.menubar)
         self.menuFile.setObjectName("menuFile")
+        self.menuTools = QtWidgets.QMenu(self.menubar)
+        self.menuTools.setObjectName("menuTools")
         self.menuHelp = QtWidgets.QMenu(self.menubar)
         self.menuHelp.setObjectName("menuHelp")
         MainWindow.setMenuBar(self.menubar)
@@ -997,11 +1000,55 @@ class Ui_MainWindow(object):
         self.actn_verboselog = QtWidgets.QAction(MainWindow)
         self.actn_verboselog.setCheckable(True)
         self.actn_verboselog.setObjectName("actn_verboselog")
+        self.actn_metrics_export = QtWidgets.QAction(MainWindow)
+        self.actn_metrics_export.setObjectName("actn_metrics_export")
+        self.actn_metrics_server = QtWidgets.QAction(MainWindow)
+        self.actn_metrics_server.setCheckable(True)
+        self.actn_metrics_server.setObjectName("actn_metrics_server")
+        self.actn_control_server = QtWidgets.QAction(MainWindow)
+        self.actn_control_server.setCheckable(True)
+        self.actn_control_server.setObjectName("actn_control_server")
+        self.actn_trace_record = QtWidgets.QAction(MainWindow)
+        self.actn_trace_record.setCheckable(True)
+        self.actn_trace_record.setObjectName("actn_trace_record")
+        self.actn_batch_mode = QtWidgets.QAction(MainWindow)
+        self.actn_batch_mode.setCheckable(True)
+        self.actn_batch_mode.setObjectName("actn_batch_mode")
+        self.actn_batch_heater_limit = QtWidgets.QAction(MainWindow)
+        self.actn_batch_heater_limit.setObjectName("actn_batch_heater_limit")
+        self.actn_encoder_raw_counts = QtWidgets.QAction(MainWindow)
+        self.actn_encoder_raw_counts.setCheckable(True)
+        self.actn_encoder_raw_counts.setObjectName("actn_encoder_raw_counts")
+        self.actn_encoder_calibrate = QtWidgets.QAction(MainWindow)
+        self.actn_encoder_calibrate.setObjectName("actn_encoder_calibrate")
+        self.actn_printer_discover = QtWidgets.QAction(MainWindow)
+        self.actn_printer_discover.setObjectName("actn_printer_discover")
+        self.actn_printer_cache_clear = QtWidgets.QAction(MainWindow)
+        self.actn_printer_cache_clear.setObjectName("actn_printer_cache_clear")
+        self.actn_printer_process = QtWidgets.QAction(MainWindow)
+        self.actn_printer_process.setCheckable(True)
+        self.actn_printer_process.setObjectName("actn_printer_process")
         self.menuFile.addAction(self.actn_save)
         self.menuFile.addAction(self.actn_exit)
         self.menuHelp.addAction(self.actn_verboselog)
         self.menuHelp.addAction(self.actn_about)
+        self.menuTools.addAction(self.actn_metrics_export)
+        self.menuTools.addAction(self.actn_metrics_server)
+        self.menuTools.addAction(self.actn_control_server)
+        self.menuTools.addSeparator()
+        self.menuTools.addAction(self.actn_trace_record)
+        self.menuTools.addSeparator()
+        self.menuTools.addAction(self.actn_batch_mode)
+        self.menuTools.addAction(self.actn_batch_heater_limit)
+        self.menuTools.addSeparator()
+        self.menuTools.addAction(self.actn_encoder_raw_counts)
+        self.menuTools.addAction(self.actn_encoder_calibrate)
+        self.menuTools.addSeparator()
+        self.menuTools.addAction(self.actn_printer_discover)
+        self.menuTools.addAction(self.actn_printer_cache_clear)
+        self.menuTools.addAction(self.actn_printer_process)
         self.menubar.addAction(self.menuFile.menuAction())
+        self.menubar.addAction(self.menuTools.menuAction())
         self.menubar.addAction(self.menuHelp.menuAction())
 
         self.retranslateUi(MainWindow)
@@ -1019,7 +1066,7 @@ class Ui_MainWindow(object):
         self.lbl_encoder_port_static.setText(_translate("MainWindow", "Port"))
         self.btn_encoder_connect.setText(_translate("MainWindow", "Connect"))
         self.btn_encoder_disconnect.setText(_translate("MainWindow", "Disconnect"))
-        self.btn_encoder_refresh.setText(_translate("MainWindow", "Refresh"))
+        self.btn_encoder_refresh.setText(_translate("MainWindow", "Detect"))
         self.groupbox_printer.setTitle(_translate("MainWindow", "Printer Connection"))
         self.lbl_printer_status_static.setText(_translate("MainWindow", "Status"))
         self.lbl_printer_status.setText(_translate("MainWindow", "Disconnected"))
@@ -1033,6 +1080,7 @@ class Ui_MainWindow(object):
         self.cbx_printer_fwtype.setItemText(1, _translate("MainWindow", "RepRapFirmware v3 (SBC)"))
         self.cbx_printer_fwtype.setItemText(2, _translate("MainWindow", "Klipper (Moonraker)"))
         self.cbx_printer_fwtype.setItemText(3, _translate("MainWindow", "Marlin (Serial Connection)"))
+        self.cbx_printer_fwtype.setItemText(4, _translate("MainWindow", "Klipper (API Socket)"))
         self.groupbox_eventlog.setTitle(_translate("MainWindow", "Event Log"))
         self.groupbox_esteps_coarse.setTitle(_translate("MainWindow", "Coarse Calibration (20mm distance)"))
         self.lbl_esteps_coarse_10_static.setText(_translate("MainWindow", "Iteration 10"))
@@ -1079,10 +1127,22 @@ class Ui_MainWindow(object):
         self.btn_tool_run.setText(_translate("MainWindow", "Run Extruder Calibration"))
         self.btn_estop.setText(_translate("MainWindow", "Emergency Stop"))
         self.menuFile.setTitle(_translate("MainWindow", "File"))
+        self.menuTools.setTitle(_translate("MainWindow", "Tools"))
         self.menuHelp.setTitle(_translate("MainWindow", "Help"))
         self.actn_about.setText(_translate("MainWindow", "About"))
         self.actn_exit.setText(_translate("MainWindow", "Exit"))
         self.actn_save.setText(_translate("MainWindow", "Save Log"))
         self.actionVerbose_Logging.setText(_translate("MainWindow", "Verbose Logging"))
         self.actn_verboselog.setText(_translate("MainWindow", "Verbose Logging"))
+        self.actn_metrics_export.setText(_translate("MainWindow", "Export Metrics..."))
+        self.actn_metrics_server.setText(_translate("MainWindow", "Metrics Endpoint"))
+        self.actn_control_server.setText(_translate("MainWindow", "Control API..."))
+        self.actn_trace_record.setText(_translate("MainWindow", "Record Trace"))
+        self.actn_batch_mode.setText(_translate("MainWindow", "Run Test on All Tools"))
+        self.actn_batch_heater_limit.setText(_translate("MainWindow", "Batch Heater Limit..."))
+        self.actn_encoder_raw_counts.setText(_translate("MainWindow", "Raw Encoder Counts"))
+        self.actn_encoder_calibrate.setText(_translate("MainWindow", "Calibrate Encoder..."))
+        self.actn_printer_discover.setText(_translate("MainWindow", "Discover Printers..."))
+        self.actn_printer_cache_clear.setText(_translate("MainWindow", "Clear Printer Cache"))
+        self.actn_printer_process.setText(_translate("MainWindow", "Run Printer Backend in a Separate Process"))
 from PyQt5.QtChart import QChartView
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Utility Script
+benchmark.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Benchmarks for the parsing and polling hot paths. Parsers are fed the
+recorded fixtures directly, while the poll cycles run the real backends
+against the fake printers in fake_printers.py. Results are written as JSON
+so that runs from different versions can be compared:
+
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --compare before.json
+'''
+
+from PyQt5.QtCore import QCoreApplication, QStandardPaths
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPTS, '..', 'nxencoder'))
+
+from fake_printers import FakeKlippyServer, FakePrinterServer, FIXTURES, load_fixture
+from helpers.printer_klipper import Klipper
+from helpers.printer_klipper_socket import KlipperSocket
+from helpers.printer_marlin import Marlin
+from helpers.printer_reprapfirmware import RepRapFirmware3
+from helpers.printer_reprapfirmware_sbc import RepRapFirmware3_SBC
+from helpers.serial_encoder import SerialEncoder
+
+
+def app_version():
+    with open(os.path.join(SCRIPTS, '..', 'nxencoder', '__main__.pyw')) as f:
+        return re.search(r'^__version__ = (.+)$', f.read(), re.M).group(1).strip('\'"')
+
+
+def fixture_lines(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return [line for line in f.read().split(b'\n') if line]
+
+
+def measure(func, iterations, per_call=1):
+    ''' Run func repeatedly and return its timing statistics in
+    microseconds per call. per_call is the number of operations each call
+    to func performs. '''
+    for _ in range(min(iterations, 10)):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000000 / per_call)
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'mean_us': round(statistics.mean(samples), 3),
+        'median_us': round(statistics.median(samples), 3),
+        'p95_us': round(samples[int(len(samples) * 0.95) - 1], 3),
+        'min_us': round(samples[0], 3),
+        'stdev_us': round(statistics.pstdev(samples), 3)
+    }
+
+
+def bench_encoder(iterations):
+    lines = fixture_lines('encoder_lines.txt')
+    encoder = SerialEncoder()
+
+    def run():
+        for line in lines:
+            encoder.parse_line(line)
+    return {'encoder.parse_line': measure(run, iterations, len(lines))}
+
+
+def check_encoder_handshakes():
+    ''' The handshake of each firmware release must turn on the features
+    it supports and no others, as firmware never replies to a request it
+    does not understand. Returns the number of mismatches. '''
+    # Firmware version: whether request IDs are echoed, and whether raw
+    # counts are used when they are asked for
+    expected = {'1.10': (False, False), '1.20': (True, False), '1.30': (True, True), '1.40': (True, True)}
+    failures = 0
+    for line in fixture_lines('encoder_handshakes.txt'):
+        encoder = SerialEncoder(raw_counts=True)
+        encoder.parse_line(line)
+        if (encoder.echo, encoder.raw) != expected[encoder.firmware_version]:
+            print('Encoder firmware v{}: echo is {}, raw is {}'.format(encoder.firmware_version, encoder.echo, encoder.raw), file=sys.stderr)
+            failures += 1
+    return failures
+
+
+def bench_marlin(iterations):
+    lines = [line.decode() for line in fixture_lines('marlin_m105.txt')]
+    marlin = Marlin('nxencoder-benchmark')
+    marlin.cfg_tools = [{'stepsPerMm': 415.0, 'cur_temp': 0, 'max_temp': 260} for _ in range(2)]
+
+    def run():
+        for line in lines:
+            marlin.parse_temperature_report(line)
+    return {'marlin.parse_temperature_report': measure(run, iterations, len(lines))}
+
+
+def bench_json_decode(iterations):
+    ''' The JSON decoding done by the HTTP backends, on the recorded
+    response bodies. '''
+    klipper = load_fixture('klipper.json')['objects']
+    klipper_config = json.dumps({'result': {'eventtime': 1.0, 'status': {'configfile': klipper['configfile']}}})
+    klipper_extruder = json.dumps({'result': {'eventtime': 1.0, 'status': {'extruder': klipper['extruder']}}})
+    rr_status = json.dumps(load_fixture('rrf.json')['rr_status'])
+    machine_status = json.dumps(load_fixture('rrf_sbc.json'))
+    return {
+        'klipper.get_objectmodel.decode_configfile': measure(lambda: json.loads(klipper_config)['result']['status']['configfile'], iterations),
+        'klipper.get_objectmodel.decode_extruder': measure(lambda: json.loads(klipper_extruder)['result']['status']['extruder'], iterations),
+        'rrf3.run.decode_rr_status': measure(lambda: json.loads(rr_status), iterations),
+        'rrf3_sbc.get_objectmodel.decode_machine_status': measure(lambda: json.loads(machine_status)['heat'], iterations)
+    }
+
+
+def bench_poll_cycles(iterations):
+    ''' End-to-end discovery and poll cycles of each HTTP backend against
+    a local fake printer. '''
+    results = {}
+    for name, firmware, backend in (('klipper', 'klipper', Klipper),
+                                    ('rrf3', 'rrf', RepRapFirmware3),
+                                    ('rrf3_sbc', 'rrf_sbc', RepRapFirmware3_SBC)):
+        server = FakePrinterServer(firmware).start()
+        try:
+            printer = backend(server.host)
+            results['{}.discover'.format(name)] = measure(printer.discover, max(iterations // 10, 5))
+            results['{}.poll'.format(name)] = measure(printer.poll, iterations)
+        finally:
+            server.stop()
+    return results
+
+
+def bench_klipper_socket(iterations):
+    ''' Discovery, a status query and a gcode round trip over the Klipper
+    API socket, against the fake socket server. '''
+    server = FakeKlippyServer().start()
+    printer = KlipperSocket(server.host)
+    try:
+        printer.discover()
+        return {
+            'klipper_socket.poll': measure(printer.poll, iterations),
+            'klipper_socket.gcode': measure(lambda: printer.post_gcode('M83'), iterations)
+        }
+    finally:
+        printer.close()
+        server.stop()
+
+
+def compare(results, baseline, threshold):
+    ''' Report benchmarks whose median regressed by more than threshold
+    against a previous results file. Returns the number of regressions. '''
+    regressions = 0
+    for name, result in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median_us']
+        change = (result['median_us'] - before) / before if before else 0
+        flag = 'REGRESSION' if change > threshold else ''
+        regressions += 1 if flag else 0
+        print('{:<50} {:>12.3f} -> {:>12.3f} us {:>+8.1%} {}'.format(name, before, result['median_us'], change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the nxEncoder parsing and polling hot paths.')
+    parser.add_argument('--iterations', type=int, default=1000, help='iterations per parsing benchmark')
+    parser.add_argument('--poll-iterations', type=int, default=200, help='iterations per poll cycle benchmark')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='a previous JSON results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    app = QCoreApplication([])
+    # Keep the printer configuration cache out of the user's cache directory
+    QStandardPaths.setTestModeEnabled(True)
+    results = {
+        'version': app_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': {}
+    }
+    if check_encoder_handshakes():
+        sys.exit(1)
+    results['results'].update(bench_encoder(args.iterations))
+    results['results'].update(bench_marlin(args.iterations))
+    results['results'].update(bench_json_decode(args.iterations))
+    results['results'].update(bench_poll_cycles(args.poll_iterations))
+    results['results'].update(bench_klipper_socket(args.poll_iterations))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif not args.compare:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(results, json.load(f), args.threshold) else 0)
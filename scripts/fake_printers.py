@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+'''
+nxEncoder Utility Script
+fake_printers.py
+
+Copyright (c) 2021 Simon Davie <nexx@nexxdesign.co.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Local stand-ins for the HTTP interfaces of RepRapFirmware (standalone and
+via the SBC) and of Moonraker, and for Klipper's API socket. They serve the
+recorded responses from the fixtures directory, so the printer backends can
+be exercised and benchmarked without a printer. They can also be run by
+hand and connected to from the GUI, using host:port as the hostname:
+
+    python3 fake_printers.py klipper --port 7125
+
+klipper_socket stands in for Klipper's own API socket instead, connected to
+by its path:
+
+    python3 fake_printers.py klipper_socket --socket /tmp/klippy_uds
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import argparse
+import copy
+import json
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+class FakePrinterHandler(BaseHTTPRequestHandler):
+    ''' Shared request plumbing. Subclasses implement route(), returning
+    the object to send back as JSON, or None for a 404. The headers and
+    body go out in separate writes, so Nagle's algorithm is disabled to
+    keep kept-alive connections from stalling on delayed ACKs the way a
+    real printer's would not. '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_request(b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.handle_request(self.rfile.read(length))
+
+    def handle_request(self, body):
+        url = urlsplit(self.path)
+        self.delay = 0
+        with self.server.lock:
+            result = self.route(url.path, url.query, body)
+        if self.delay:
+            time.sleep(self.delay)
+        if result is None:
+            self.send_error(404)
+            return
+        data = result if isinstance(result, bytes) else json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+def klipper_gcode(server, script):
+    ''' Act on the gcode the backends rely on, for both of the Klipper
+    stand-ins. Returns the seconds the script takes, and the responses it
+    prints. Like Klipper, a script ending in M400 only completes once its
+    moves would have finished. '''
+    state = server.state
+    delay = 0
+    responses = []
+    if script.rstrip().endswith('M400'):
+        for m in re.finditer(r'G1 E(-?[\d.]+) F([\d.]+)', script):
+            delay += abs(float(m.group(1))) / (float(m.group(2)) / 60) * server.move_time_scale
+    m = re.match(r'SET_EXTRUDER_STEP_DISTANCE EXTRUDER=(\w+)$', script)
+    if m:
+        settings = state['objects']['configfile']['settings'][m.group(1)]
+        steps = int(settings['full_steps_per_rotation']) * int(settings['microsteps'])
+        responses.append("Extruder '{}' step distance is {:.6f}".format(m.group(1), float(settings['rotation_distance']) / steps))
+    m = re.match(r'M104 S([\d.]+) T(\d+)', script)
+    if m:
+        name = 'extruder' if m.group(2) == '0' else 'extruder{}'.format(m.group(2))
+        if name in state['objects']:
+            state['objects'][name]['target'] = float(m.group(1))
+            state['objects'][name]['temperature'] = float(m.group(1)) or 24.0
+    return delay, responses
+
+
+class FakeMoonrakerHandler(FakePrinterHandler):
+    def route(self, path, query, body):
+        state = self.server.state
+        if path == '/printer/info':
+            return {'result': state['printer_info']}
+        if path == '/printer/objects/query':
+            status = {}
+            for key, attrs in parse_qsl(query, keep_blank_values=True):
+                obj = state['objects'].get(key)
+                if obj is None:
+                    continue
+                if attrs:
+                    obj = {k: v for k, v in obj.items() if k in attrs.split(',')}
+                status[key] = obj
+            return {'result': {'eventtime': time.monotonic(), 'status': status}}
+        if path == '/printer/gcode/script':
+            script = dict(parse_qsl(query)).get('script', '')
+            self.server.gcodes.append(script)
+            self.gcode(script)
+            return {'result': 'ok'}
+        if path == '/server/gcode_store':
+            return {'result': {'gcode_store': state['gcode_store'][-1:]}}
+        if path == '/printer/emergency_stop':
+            return {'result': 'ok'}
+        return None
+
+    def gcode(self, script):
+        self.delay, responses = klipper_gcode(self.server, script)
+        for message in responses:
+            self.server.state['gcode_store'].append({'message': message, 'time': time.time(), 'type': 'response'})
+
+
+class FakeRepRapFirmwareHandler(FakePrinterHandler):
+    def route(self, path, query, body):
+        state = self.server.state
+        if path == '/rr_config':
+            return state['rr_config']
+        if path == '/rr_model':
+            key = dict(parse_qsl(query)).get('key', '')
+            if key not in state['rr_model']:
+                return None
+            return {'key': key, 'flags': '', 'result': state['rr_model'][key]}
+        if path == '/rr_status':
+            return state['rr_status']
+        if path == '/rr_gcode':
+            self.server.gcodes.append(dict(parse_qsl(query)).get('gcode', ''))
+            return {'buff': 255}
+        return None
+
+
+class FakeRepRapFirmwareSBCHandler(FakePrinterHandler):
+    def route(self, path, query, body):
+        if path == '/machine/status':
+            return self.server.state
+        if path == '/machine/code':
+            self.server.gcodes.append(body.decode())
+            return b''
+        return None
+
+
+class FakeKlippyHandler(socketserver.BaseRequestHandler):
+    ''' One client of Klipper's API socket. Requests and replies are JSON
+    terminated by 0x03. Scripts run on a thread of their own, so a long
+    move does not hold up the other requests on the connection, and
+    subscribed objects are checked for changes every update_interval. '''
+    update_interval = 0.25
+
+    def setup(self):
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.subscription = None
+        self.output = None
+        self.sent = {}
+
+    def handle(self):
+        threading.Thread(target=self.push, daemon=True).start()
+        buffer = b''
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            *messages, buffer = (buffer + data).split(b'\x03')
+            for raw in messages:
+                self.dispatch(json.loads(raw))
+        self.closed.set()
+
+    def send(self, message):
+        data = json.dumps(message).encode() + b'\x03'
+        try:
+            with self.write_lock:
+                self.request.sendall(data)
+        except OSError:
+            self.closed.set()
+
+    def dispatch(self, request):
+        params = request.get('params', {})
+        if request.get('method') == 'gcode/script':
+            threading.Thread(target=self.script, args=(request['id'], params['script']), daemon=True).start()
+            return
+        with self.server.lock:
+            result = self.route(request.get('method'), params)
+        if result is None:
+            self.send({'id': request['id'], 'error': {'error': 'WebRequestError', 'message': 'Invalid request'}})
+            return
+        self.send({'id': request['id'], 'result': result})
+
+    def route(self, method, params):
+        state = self.server.state
+        if method == 'info':
+            return state['printer_info']
+        if method == 'objects/query':
+            return {'eventtime': time.monotonic(), 'status': self.query(params['objects'])}
+        if method == 'objects/subscribe':
+            self.subscription = (params['objects'], params['response_template'])
+            self.sent = copy.deepcopy(self.query(params['objects']))
+            return {'eventtime': time.monotonic(), 'status': self.sent}
+        if method == 'gcode/subscribe_output':
+            self.output = params['response_template']
+            return {}
+        if method == 'emergency_stop':
+            return {}
+        return None
+
+    def query(self, objects):
+        status = {}
+        for key, attrs in objects.items():
+            obj = self.server.state['objects'].get(key)
+            if obj is None:
+                continue
+            status[key] = {k: copy.deepcopy(v) for k, v in obj.items() if attrs is None or k in attrs}
+        return status
+
+    def script(self, request, script):
+        with self.server.lock:
+            self.server.gcodes.append(script)
+            delay, responses = klipper_gcode(self.server, script)
+        if self.output is not None:
+            for message in responses:
+                self.send(dict(self.output, params={'response': message}))
+        time.sleep(delay)
+        self.send({'id': request, 'result': {}})
+
+    def push(self):
+        ''' Send the subscribed attributes which have changed. '''
+        while not self.closed.wait(self.update_interval):
+            if self.subscription is None:
+                continue
+            objects, template = self.subscription
+            with self.server.lock:
+                status = self.query(objects)
+            changes = {}
+            for key, values in status.items():
+                changed = {k: v for k, v in values.items() if self.sent.get(key, {}).get(k) != v}
+                if changed:
+                    changes[key] = changed
+                    self.sent.setdefault(key, {}).update(changed)
+            if changes:
+                self.send(dict(template, params={'eventtime': time.monotonic(), 'status': changes}))
+
+
+class FakeKlippyServer(socketserver.ThreadingUnixStreamServer):
+    ''' Runs the fake Klipper API socket on a background thread. Without
+    a path the socket is made in a temporary directory. self.host is the
+    path, to connect to as the hostname. '''
+    daemon_threads = True
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(tempfile.mkdtemp(prefix='nxencoder-'), 'klippy.sock')
+        super(FakeKlippyServer, self).__init__(path, FakeKlippyHandler)
+        self.firmware = 'klipper_socket'
+        self.state = copy.deepcopy(load_fixture('klipper.json'))
+        self.gcodes = []
+        self.move_time_scale = 1.0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, name='fake_klipper_socket', daemon=True)
+
+    @property
+    def host(self):
+        return self.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.server_address)
+
+
+class FakePrinterServer(ThreadingHTTPServer):
+    ''' Runs one of the fake printers on a background thread. Port 0
+    picks a free port, available afterwards as self.port. '''
+    daemon_threads = True
+    handlers = {
+        'klipper': (FakeMoonrakerHandler, 'klipper.json'),
+        'rrf': (FakeRepRapFirmwareHandler, 'rrf.json'),
+        'rrf_sbc': (FakeRepRapFirmwareSBCHandler, 'rrf_sbc.json'),
+    }
+
+    def __init__(self, firmware, port=0, host='127.0.0.1'):
+        handler, fixture = self.handlers[firmware]
+        super(FakePrinterServer, self).__init__((host, port), handler)
+        self.firmware = firmware
+        self.state = copy.deepcopy(load_fixture(fixture))
+        if firmware == 'klipper':
+            self.state.setdefault('gcode_store', [])
+        self.gcodes = []
+        self.move_time_scale = 1.0
+        self.lock = threading.Lock()
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, name='fake_' + firmware, daemon=True)
+
+    @property
+    def host(self):
+        return '{}:{}'.format(self.server_address[0], self.port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake printer for testing the nxEncoder utility.')
+    parser.add_argument('firmware', choices=sorted(FakePrinterServer.handlers) + ['klipper_socket'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', help='path of the klipper_socket socket, a temporary one by default')
+    parser.add_argument('--move-time-scale', type=float, default=1.0, help='scale the time moves take, 0 for instant')
+    args = parser.parse_args()
+
+    if args.firmware == 'klipper_socket':
+        server = FakeKlippyServer(args.socket)
+    else:
+        server = FakePrinterServer(args.firmware, args.port, args.host)
+    server.move_time_scale = args.move_time_scale
+    print('Fake {} printer listening on {}'.format(args.firmware, server.host))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        if args.firmware == 'klipper_socket':
+            os.unlink(server.host)